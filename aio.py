@@ -0,0 +1,409 @@
+# -*- coding: utf-8 *-*
+"""BBS1 asyncio device handling"""
+# A tool to communicate with Peterson's BBS-1 metronome
+# Copyright (C) 2012-2015 Raphaël Doursenaud <rdoursenaud@free.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Note: Python 3 only
+
+import asyncio
+import logging
+import threading
+import time
+
+from communication import CommunicationTimeout, Exchange, drop_stale
+from device import POST, REQUEST, RESULT, UPLOAD
+
+try:
+    # noinspection PyPackageRequirements,PyUnresolvedReferences
+    from gi.repository import GLib
+except ImportError:
+    # Only needed to integrate with the GUI
+    GLib = None
+
+
+class AsyncCommunication(object):
+    """asyncio MIDI communication on top of a connected Communication"""
+
+    def __init__(self, com, loop):
+        """
+        Initialize an asyncio communication channel
+
+        :param com: Connected communication channel
+        :param loop: Event loop running the device calls
+        :type com: communication.Communication
+        :type loop: asyncio.AbstractEventLoop
+        """
+        self.com = com
+        self.loop = loop
+        # Before Python 3.10 queues and locks bind to the event loop of the thread creating them:
+        # they are created in the event loop thread when first used
+        self._frames = None
+        self._lock = None
+        com.on_frame = self._frame_received
+
+    @property
+    def frames(self):
+        """
+        Incoming frames
+
+        Only to be used in the event loop thread.
+
+        :rtype: asyncio.Queue
+        """
+        if self._frames is None:
+            self._frames = asyncio.Queue()
+        return self._frames
+
+    @property
+    def lock(self):
+        """
+        One exchange at a time with the device
+
+        Only to be used in the event loop thread.
+
+        :rtype: asyncio.Lock
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def close(self):
+        """Hand incoming frames back to the synchronous channel"""
+        self.com.on_frame = None
+
+    def _frame_received(self, frame):
+        """
+        Queue a frame in the event loop
+
+        Called from the reader thread.
+
+        :param frame: Complete SysEx frame
+        :type frame: bytearray
+        """
+        self.loop.call_soon_threadsafe(self._put_frame, frame)
+
+    def _put_frame(self, frame):
+        """
+        Queue a frame
+
+        Runs in the event loop thread.
+
+        :param frame: Complete SysEx frame
+        :type frame: bytearray
+        """
+        self.frames.put_nowait(frame)
+
+    def send(self, msg):
+        """
+        Sends out SysEx message
+
+        :param msg: Message
+        :type msg: bytes | bytearray
+        """
+        self.com.send(msg)
+
+    async def post(self, msg):
+        """
+        Sends out SysEx message expecting no reply
+
+        Waits for any ongoing exchange to complete first.
+
+        :param msg: Message
+        :type msg: bytes | bytearray
+        """
+        async with self.lock:
+            self.send(msg)
+
+    async def get_data(self, msg, exit_callback=None):
+        """
+        Gets reply from the hardware after sending a message
+
+        See Exchange for replies matching and retries.
+
+        :param msg: Message
+        :type msg: bytes | bytearray
+        :param exit_callback: A callback function to stop listening to the device
+        :type exit_callback: function
+        :return: Device answer
+        :rtype: str, mixed | (str, mixed)[]
+        :raises CommunicationTimeout: The device did not answer in time
+        """
+        async with self.lock:
+            exchange = Exchange(msg, self.com.timeout, self.com.rtt, self.com.RETRIES, exit_callback)
+            drop_stale(self.frames)
+            self.send(exchange.request(time.time()))
+            while not exchange.done:
+                try:
+                    frame = await self._get_frame(exchange.timeout(time.time()))
+                except CommunicationTimeout:
+                    self.send(exchange.expire(time.time()))
+                else:
+                    exchange.receive(frame, time.time())
+        return exchange.result
+
+    async def receive_frame(self, timeout=None):
+        """
+        Gets the next frame from the hardware without sending anything
+
+        The caller should hold the lock.
+
+        :param timeout: Maximum time to wait (in seconds), defaults to the channel timeout
+        :type timeout: float
+        :return: Complete SysEx frame
+        :rtype: bytearray
+        :raises CommunicationTimeout: The device did not answer in time
+        """
+        return await self._get_frame(timeout)
+
+    async def _get_frame(self, timeout=None):
+        """
+        Wait for and get the next input frame
+
+        :param timeout: Maximum time to wait (in seconds), defaults to the channel timeout
+        :type timeout: float
+        :return: Complete SysEx frame
+        :rtype: bytearray
+        :raises CommunicationTimeout: The device did not answer in time
+        """
+        if timeout is None:
+            timeout = self.com.timeout
+        try:
+            return await asyncio.wait_for(self.frames.get(), timeout)
+        except asyncio.TimeoutError:
+            error = "No reply from the device after " + str(timeout) + "s"
+            logging.warning(error)
+            raise CommunicationTimeout(error)
+
+
+class AsyncBbs1(object):
+    """BBS1 device awaitable commands"""
+
+    def __init__(self, dev, loop):
+        """
+        Initialize awaitable device
+
+        :param dev: Connected device
+        :param loop: Event loop running the device calls
+        :type dev: device.Bbs1
+        :type loop: asyncio.AbstractEventLoop
+        """
+        self.dev = dev
+        self.com = AsyncCommunication(dev.com, loop)
+
+    def close(self):
+        """Go back to synchronous device calls"""
+        self.com.close()
+
+    async def present(self):
+        """Tests if the hardware is present and if communication is possible"""
+        return await self._run(self.dev._present())
+
+    async def get_mode(self):
+        """Gets the current mode (Normal/Firmware upload)"""
+        return await self._run(self.dev._get_mode())
+
+    async def get_hardware_version(self):
+        """Returns the hardware version in human readable form"""
+        return await self._run(self.dev._get_hardware_version())
+
+    async def get_firmware_version(self):
+        """Returns the firmware version in human readable form"""
+        return await self._run(self.dev._get_firmware_version())
+
+    async def identify(self):
+        """
+        Identify the connected device
+
+        :return: (mode, hardware version, firmware version) or None when not present
+        :rtype: (str, str, str) | None
+        """
+        return await self._run(self.dev._identify())
+
+    async def get_tempomaps(self, on_map=None):
+        """
+        Get tempo maps from the device
+
+        :param on_map: Called in the event loop with the map index and the map as soon as a map is received
+        :type on_map: function
+        :return: Tempo file
+        :rtype: tempo.File
+        :raises IOError: Communication failed, a dump interrupted midway keeps the maps received in its tempofile
+        :raises TypeError: Not tempo maps data, with the maps received in its tempofile
+        """
+        return await self._run(self.dev._get_tempomaps(on_map))
+
+    async def send_tempomaps(self, tempofile):
+        """
+        Send tempo maps to the device
+
+        :param tempofile: Tempo file
+        :type tempofile: tempo.File
+        :raises IOError: The device rejected a page too many times
+        :raises TypeError: Tempo maps too large
+        """
+        await self._run(self.dev._send_tempomaps(tempofile))
+
+    async def clear_tempomaps(self):
+        """Clear the device's tempo maps storage"""
+        await self._run(self.dev._clear_tempomaps())
+
+    async def send_firmware(self, image, journal=None):
+        """
+        Flash a firmware image
+
+        The device must be in firmware mode.
+        With a journal, an interrupted transfer of the same image resumes at the first unacknowledged page.
+
+        :param image: Firmware image
+        :param journal: Flashing progress journal
+        :type image: firmware.FirmwareImage
+        :type journal: firmware.FlashJournal
+        :raises IOError: The device is not in firmware mode or rejected a page too many times
+        """
+        await self._run(self.dev._send_firmware(image, journal))
+
+    async def _run(self, procedure):
+        """
+        Drive a device.Bbs1 command procedure
+
+        :param procedure: Command procedure
+        :type procedure: generator
+        :return: Command result
+        """
+        result = None
+        error = None
+        while True:
+            try:
+                operation = procedure.send(result) if error is None else procedure.throw(error)
+            except StopIteration:
+                return None
+            if operation[0] == RESULT:
+                procedure.close()
+                return operation[1]
+            result = error = None
+            try:
+                result = await self._perform(operation)
+            except Exception as failure:
+                error = failure
+
+    async def _perform(self, operation):
+        """
+        Perform a device operation
+
+        :param operation: Device operation
+        :type operation: tuple
+        :return: Operation result
+        """
+        if operation[0] == REQUEST:
+            return await self.com.get_data(operation[1], operation[2])
+        if operation[0] == POST:
+            return await self.com.post(operation[1])
+        if operation[0] == UPLOAD:
+            return await self._upload(operation[1])
+        return await self._run(operation[1])
+
+    async def _upload(self, upload):
+        """
+        Drive a pages upload
+
+        :param upload: Pages upload
+        :type upload: device.PageUpload
+        :raises IOError: The device rejected a page too many times
+        """
+        async with self.com.lock:
+            while not upload.done:
+                for msg in upload.next_pages(time.time()):
+                    self.com.send(msg)
+                try:
+                    frame = await self.com.receive_frame(upload.timeout(time.time()))
+                except CommunicationTimeout:
+                    upload.expire(time.time())
+                else:
+                    upload.receive(frame, time.time())
+
+
+class GLibEventLoop(object):
+    """
+    asyncio event loop running alongside the GLib main loop
+
+    Coroutines run in a dedicated thread.
+    Their results are handed back to the GLib main loop so callbacks may safely touch GTK widgets.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name='BBS1 asyncio loop')
+        self._thread.daemon = True
+
+    def start(self):
+        """Start running the event loop"""
+        logging.debug('Starting asyncio event loop')
+        self._thread.start()
+
+    def stop(self):
+        """Stop the event loop"""
+        logging.debug('Stopping asyncio event loop')
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+    def _run(self):
+        """Event loop thread"""
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro, callback=None, error_callback=None):
+        """
+        Schedule a coroutine
+
+        :param coro: Coroutine to run
+        :param callback: Called in the GLib main loop with the coroutine result
+        :param error_callback: Called in the GLib main loop with the raised exception
+        :type callback: function
+        :type error_callback: function
+        :return: Future of the coroutine result
+        :rtype: concurrent.futures.Future
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+        def done(f):
+            # Runs in the event loop thread
+            if GLib is None:
+                self._dispatch(f, callback, error_callback)
+            else:
+                GLib.idle_add(self._dispatch, f, callback, error_callback)
+
+        future.add_done_callback(done)
+        return future
+
+    @staticmethod
+    def _dispatch(future, callback, error_callback):
+        """
+        Deliver a coroutine outcome
+
+        :return: False to remove the GLib idle source
+        :rtype: bool
+        """
+        try:
+            result = future.result()
+        except Exception as error:
+            if error_callback is None:
+                logging.exception(error)
+            else:
+                error_callback(error)
+        else:
+            if callback is not None:
+                callback(result)
+        return False
@@ -28,10 +28,12 @@
 import logging
 import sys
 
+import tracing
 import ui
 
 if __name__ == "__main__":
     logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
+    tracing.subscribe(tracing.LogSink())
     logging.info('Application start')
     APP = ui.Bbs1App()
     APP.run(None)
@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 *-*
+"""BBS1 SysEx parsing benchmark and fuzzing"""
+# A tool to communicate with Peterson's BBS-1 metronome
+# Copyright (C) 2012-2015 Raphaël Doursenaud <rdoursenaud@free.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Usage: python benchmark.py [repeats]
+#
+# Decodes synthetic full storage dumps (9 maps of up to 1018 bars, versions 1 and 2)
+# then runs a deterministic fuzz corpus through the parser
+# and reads back files of 0, 1 and 9 maps.
+# Exits with an error when a malformed message is not rejected with TypeError
+# or when a file does not read back. Rejection times are reported only: they depend on the machine load.
+
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+import storage
+# noinspection PyProtectedMember
+from sysex import SysexFramer, SysexMessage, TempoMapsDecoder, _MIN_SIZE, STORAGE_SIZE, TM_BAR, _TM_PG
+from tempo import Bar, File, Map
+
+try:
+    # noinspection PyUnresolvedReferences
+    import tracemalloc
+except ImportError:
+    # We must be running Python 2: allocations are not reported
+    tracemalloc = None
+
+# Maximum bars in a map
+MAX_BARS = 1018
+# Fuzz corpus random seed
+SEED = 0x5bb51
+
+
+def full_dump(version):
+    """
+    Device answers of a full storage dump
+
+    :param version: Tempo maps structure version
+    :type version: int
+    :return: Parsed answers, raw frames
+    :rtype: (list, bytearray[])
+    """
+    rand = random.Random(SEED + version)
+    tempofile = File()
+    tempofile.set_version(version)
+    # Version 2 entries are larger: fewer bars fit in the storage
+    free = STORAGE_SIZE - SysexMessage.tempo_maps_size(tempofile)
+    count = min(MAX_BARS, free // TM_BAR.size // len(tempofile.maps))
+    for i, tempomap in enumerate(tempofile.maps):
+        tempomap.set_name('Map ' + str(i))
+        tempomap.looping = bool(i % 2)
+        tempomap.count_in = i % 9
+        tempomap.bars = [Bar(rand.randint(1, 15), 1 << rand.randint(1, 5), rand.randint(0, 255), rand.randint(10, 280))
+                         for _ in range(0, count)]
+    return dump(tempofile)
+
+
+def dump(tempofile):
+    """
+    Device answers of a storage dump
+
+    :param tempofile: Tempo file
+    :type tempofile: File
+    :return: Parsed answers, raw frames
+    :rtype: (list, bytearray[])
+    """
+    frames = []
+    for page in SysexMessage.iter_tempo_maps_pages(tempofile):
+        # Device pages announce their encoded data length in the reserved field
+        frame = bytearray(page)
+        frame[6] = len(frame) - 13
+        frame[7] = _TM_PG
+        frames.append(frame)
+    return [SysexMessage.parse(frame) for frame in frames], frames
+
+
+def measure(function, repeats):
+    """
+    Time and trace a function
+
+    :param function: Function to measure
+    :param repeats: Number of calls
+    :type function: function
+    :type repeats: int
+    :return: Best call time (in seconds), allocated blocks and peak memory (in bytes) of one call
+    :rtype: (float, int | None, int | None)
+    """
+    best = None
+    for _ in range(0, repeats):
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    if tracemalloc is None:
+        return best, None, None
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    function()
+    after = tracemalloc.take_snapshot()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename') if stat.count_diff > 0)
+    return best, blocks, peak
+
+
+def report(name, frames, size, result):
+    """
+    Print a benchmark result
+
+    :param name: Benchmark name
+    :param frames: Frames handled by one call
+    :param size: Bytes handled by one call
+    :param result: Measure
+    :type name: str
+    :type frames: int
+    :type size: int
+    :type result: (float, int | None, int | None)
+    """
+    elapsed, blocks, peak = result
+    line = "%-28s %8.2f ms %10.0f frames/s %8.2f MB/s" % (
+        name, elapsed * 1000, frames / elapsed, size / elapsed / 1000000)
+    if blocks is not None:
+        line += " %8d blocks %8.0f kB peak" % (blocks, peak / 1000.0)
+    print(line)
+
+
+def benchmark(repeats):
+    """
+    Benchmark parsing and decoding of full storage dumps
+
+    :param repeats: Calls of each benchmark, the best one is reported
+    :type repeats: int
+    """
+    for version in (1, 2):
+        answers, frames = full_dump(version)
+        size = sum(len(frame) for frame in frames)
+        stream = b''.join(bytes(frame) for frame in frames)
+
+        def frame():
+            SysexFramer().feed(bytearray(stream))
+
+        def parse():
+            for message in frames:
+                SysexMessage.parse(message)
+
+        def decode():
+            SysexMessage.parse_tempo_maps_pages(answers)
+
+        def feed():
+            decoder = TempoMapsDecoder()
+            for answer in answers:
+                decoder.feed(answer)
+
+        def transfer():
+            decoder = TempoMapsDecoder()
+            for message in SysexFramer().feed(bytearray(stream)):
+                decoder.feed(SysexMessage.parse(message))
+
+        print("Version " + str(version) + ": " + str(len(frames)) + " frames, " + str(size) + " bytes")
+        report("  framing", len(frames), size, measure(frame, repeats))
+        report("  parsing", len(frames), size, measure(parse, repeats))
+        report("  decoding", len(frames), size, measure(decode, repeats))
+        report("  incremental decoding", len(frames), size, measure(feed, repeats))
+        report("  framing to tempo file", len(frames), size, measure(transfer, repeats))
+
+
+def fuzz_corpus():
+    """
+    Malformed messages
+
+    The corpus is derived from valid messages with a fixed seed so runs are comparable.
+
+    :return: (kind, message)
+    :rtype: (str, bytearray)[]
+    """
+    rand = random.Random(SEED)
+    answers, frames = full_dump(2)
+    valid = [bytearray(SysexMessage.build_msg_req_con()),
+             bytearray(SysexMessage.build_msg_ack_ok()),
+             bytearray(b'\xf0\x00\x40\x70\x01\x02\x00\x14\x00\x00\x00\x00\x01\x01\x00\x00\x00\xf7'),
+             bytearray(b'\xf0\x00\x40\x70\x01\x02\x00\x23\x00\xf7'),
+             frames[0], frames[-1]]
+    corpus = []
+
+    # Truncated
+    for message in valid:
+        for length in range(0, len(message)):
+            corpus.append(('truncated', message[0:length]))
+        # Shorter ones are well formed messages without payload
+        for length in range(_MIN_SIZE, len(message) - 1):
+            corpus.append(('truncated', message[0:length] + b'\xf7'))
+
+    # Garbage
+    for _ in range(0, 500):
+        garbage = bytearray(rand.getrandbits(8) for _ in range(0, rand.randint(0, 64)))
+        corpus.append(('garbage', garbage))
+        corpus.append(('garbage', bytearray(b'\xf0') + garbage + b'\xf7'))
+    corpus.append(('garbage', bytearray(b'\xf0' + b'\x00' * 65536 + b'\xf7')))
+    corpus.append(('garbage', bytearray(b'\xf0\x00\x40\x70\x01\x02' + b'\x7f' * 65536 + b'\xf7')))
+
+    # Mis-framed
+    for message in valid:
+        corpus.append(('misframed', message[1:]))
+        corpus.append(('misframed', message[:-1]))
+        corpus.append(('misframed', message + message))
+        for position in range(1, 5):
+            wrong = bytearray(message)
+            wrong[position] ^= 0x01
+            corpus.append(('misframed', wrong))
+        for _ in range(0, 10):
+            wrong = bytearray(message)
+            wrong[rand.randint(1, len(message) - 2)] |= 0x80
+            corpus.append(('misframed', wrong))
+        wrong = bytearray(message)
+        wrong[5] = 0x7f
+        corpus.append(('misframed', wrong))
+    return corpus
+
+
+def fuzz():
+    """
+    Run the fuzz corpus through the parser and the tempo maps decoder
+
+    :return: Failures count
+    :rtype: int
+    """
+    failures = 0
+    counts = {}
+    slowest = 0.0
+    total = 0.0
+    corpus = fuzz_corpus()
+    for kind, message in corpus:
+        start = time.time()
+        try:
+            SysexMessage.parse(message)
+        except TypeError:
+            counts[kind] = counts.get(kind, 0) + 1
+        except Exception as error:
+            failures += 1
+            print("FAIL " + kind + " " + repr(error) + ": " + repr(bytes(message[0:32])))
+        else:
+            failures += 1
+            print("FAIL " + kind + " accepted: " + repr(bytes(message[0:32])))
+        elapsed = time.time() - start
+        slowest = max(slowest, elapsed)
+        total += elapsed
+    print("Rejected " + ", ".join(kind + ": " + str(count) for kind, count in sorted(counts.items()))
+          + " (%.3f ms on average, slowest in %.3f ms)" % (total / len(corpus) * 1000, slowest * 1000))
+
+    # Incomplete dumps
+    answers, frames = full_dump(2)
+    rand = random.Random(SEED)
+    dumps = [answers[0:length] for length in (0, 1, 2, len(answers) // 2, len(answers) - 1)]
+    for _ in range(0, 10):
+        dump = list(answers)
+        del dump[rand.randint(0, len(dump) - 1)]
+        dumps.append(dump)
+    for dump in dumps:
+        try:
+            SysexMessage.parse_tempo_maps_pages(dump)
+        except TypeError:
+            pass
+        except Exception as error:
+            failures += 1
+            print("FAIL incomplete dump of " + str(len(dump)) + " pages " + repr(error))
+    print("Rejected " + str(len(dumps)) + " incomplete dumps")
+    return failures
+
+
+def round_trip():
+    """
+    Read back files of 0, 1 and 9 maps from dumps and storage files
+
+    :return: Failures count
+    :rtype: int
+    """
+    failures = 0
+    rand = random.Random(SEED)
+    path = os.path.join(tempfile.mkdtemp(), 'round_trip' + storage.EXTENSION)
+    for count in (0, 1, 9):
+        for version in (1, 2):
+            original = File([Map() for _ in range(0, count)])
+            original.set_version(version)
+            for i, tempomap in enumerate(original.maps):
+                tempomap.set_name('Map ' + str(i))
+                tempomap.bars = [Bar(rand.randint(1, 16), 1 << rand.randint(1, 5), rand.randint(1, 255),
+                                     rand.randint(10, 280)) for _ in range(0, rand.randint(0, 40))]
+            answers = dump(original)[0]
+            storage.save(path, original)
+
+            def feed():
+                decoder = TempoMapsDecoder()
+                for answer in answers:
+                    decoder.feed(answer)
+                return decoder.tempofile
+
+            for name, read in (('dump', lambda: SysexMessage.parse_tempo_maps_pages(answers)),
+                               ('incremental dump', feed),
+                               ('storage file', lambda: storage.load(path))):
+                try:
+                    result = read()
+                except TypeError as error:
+                    result = error
+                if not isinstance(result, File) or result.digest != original.digest:
+                    failures += 1
+                    print("FAIL " + name + " of " + str(count) + " maps, version " + str(version) + ": "
+                          + repr(result))
+    os.remove(path)
+    os.rmdir(os.path.dirname(path))
+    print("Read back files of 0, 1 and 9 maps")
+    return failures
+
+
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stderr, level=logging.CRITICAL)
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
+    sys.exit(1 if fuzz() + round_trip() else 0)
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 *-*
+"""BBS1 SysEx sessions capture and replay"""
+# A tool to communicate with Peterson's BBS-1 metronome
+# Copyright (C) 2012-2015 Raphaël Doursenaud <rdoursenaud@free.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+import time
+from collections import deque
+
+import tracing
+from tracing import FRAME_IN, FRAME_OUT
+from transport import Transport
+
+"""
+Capture format
+==============
+
+::
+bytes 0-7
+    "BBS1CAP" magic number followed by the format version
+records
+    Binary trace records (see tracing.BinarySink) of frames only:
+    [timestamp (double), direction (FRAME_IN or FRAME_OUT), length (INT16u), frame]
+"""
+
+MAGIC = b'BBS1CAP\x01'
+
+
+class CaptureWriter(tracing.BinarySink):
+    """Timestamped capture of the frames exchanged with a device"""
+
+    def __init__(self, stream):
+        """
+        Start a capture
+
+        :param stream: Writable binary stream
+        :type stream: file
+        """
+        tracing.BinarySink.__init__(self, stream)
+        stream.write(MAGIC)
+
+    @classmethod
+    def create(cls, path):
+        """
+        Start a capture file
+
+        :param path: Capture file path
+        :type path: str
+        :rtype: CaptureWriter
+        """
+        return cls(open(path, 'wb'))
+
+    def record(self, direction, frame):
+        """
+        Record a frame
+
+        :param direction: FRAME_IN or FRAME_OUT
+        :param frame: Complete SysEx frame
+        :type direction: int
+        :type frame: list | bytearray
+        """
+        self(direction, frame)
+
+    def close(self):
+        """Finish the capture"""
+        with self._lock:
+            self.stream.close()
+
+
+def read_capture(stream):
+    """
+    Read a capture
+
+    :param stream: Readable binary stream
+    :type stream: file
+    :return: (timestamp, direction, frame) records
+    :rtype: (float, int, bytearray)[]
+    :raises TypeError: Not a capture
+    """
+    if stream.read(len(MAGIC)) != MAGIC:
+        raise TypeError("Not a BBS1 capture")
+    return [(timestamp, direction, fields[0])
+            for timestamp, direction, fields in tracing.BinarySink.read(stream)
+            if direction in (FRAME_IN, FRAME_OUT)]
+
+
+class ReplayTransport(Transport):
+    """
+    Device transport playing a capture back
+
+    Each message written is matched with the next captured outgoing frame.
+    The incoming frames captured after it are then delivered, with their original delays or as fast as possible.
+    """
+
+    def __init__(self, capture, realtime=False):
+        """
+        Load a capture
+
+        :param capture: Capture file path or records
+        :param realtime: Deliver frames with their original delays
+        :type capture: str | (float, int, bytearray)[]
+        :type realtime: bool
+        :raises TypeError: Not a capture
+        """
+        if isinstance(capture, str):
+            with open(capture, 'rb') as stream:
+                capture = read_capture(stream)
+        self.records = capture
+        self.realtime = realtime
+        self.diverged = 0  # Written messages not matching the capture
+        self._position = 0
+        self._replies = deque()  # (due time, frame)
+        self._lock = threading.Lock()
+
+    @property
+    def done(self):
+        """
+        Whole capture played back
+
+        :rtype: bool
+        """
+        return self._position >= len(self.records) and not self._replies
+
+    def open(self):
+        logging.debug('Replaying ' + str(len(self.records)) + ' captured frames')
+        self._position = 0
+        self.diverged = 0
+        # Frames received before the first request
+        self._deliver(time.time(), None)
+
+    def close(self):
+        with self._lock:
+            self._replies.clear()
+
+    def write(self, msg):
+        now = time.time()
+        if self._position >= len(self.records):
+            logging.warning('Replay past the end of the capture')
+            self.diverged += 1
+            return
+        timestamp, direction, frame = self.records[self._position]
+        self._position += 1
+        if bytearray(msg) != frame:
+            logging.warning('Replay diverged from the capture')
+            self.diverged += 1
+        self._deliver(now, timestamp)
+
+    def poll(self):
+        with self._lock:
+            return bool(self._replies) and self._replies[0][0] <= time.time()
+
+    def read(self, size):
+        data = bytearray()
+        now = time.time()
+        with self._lock:
+            while self._replies and self._replies[0][0] <= now and len(data) < size * 4:
+                data += self._replies.popleft()[1]
+        return data
+
+    def _deliver(self, now, sent):
+        """
+        Queue the incoming frames up to the next outgoing one
+
+        :param now: Replay time of the outgoing frame
+        :param sent: Capture time of the outgoing frame, None to deliver immediately
+        :type now: float
+        :type sent: float
+        """
+        with self._lock:
+            while self._position < len(self.records):
+                timestamp, direction, frame = self.records[self._position]
+                if direction != FRAME_IN:
+                    break
+                self._position += 1
+                due = now
+                if self.realtime and sent is not None:
+                    due += max(0.0, timestamp - sent)
+                self._replies.append((due, frame))
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 *-*
+"""BBS1 SysEx 7 bits data codec"""
+# A tool to communicate with Peterson's BBS-1 metronome
+# Copyright (C) 2012-2015 Raphaël Doursenaud <rdoursenaud@free.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from binascii import hexlify, unhexlify
+
+try:
+    # noinspection PyUnresolvedReferences
+    import numpy
+except ImportError:
+    # Only needed to speed up large buffers
+    numpy = None
+
+"""
+7 bits encoding
+===============
+
+Raw data is split in words of 4 bytes, the last one padded with zeros.
+Each word is sent as 5 bytes:
+
+::
+byte 0
+    Top bits: bit 3 is byte 1 MSB ... bit 0 is byte 4 MSB
+bytes 1-4
+    Lower 7 bits of the raw bytes
+
+A page holds 7 words: 28 raw bytes encoded as 35 bytes.
+
+Whole buffers are processed at once: every word byte position is a strided slice.
+Bits are moved with bytes.translate() and slices are merged as big integers.
+"""
+
+WORD_SIZE = 4
+ENCODED_WORD_SIZE = 5
+PAGE_SIZE = 28
+ENCODED_PAGE_SIZE = 35
+
+# Buffers from this size (in bytes) are handled by NumPy when available
+NUMPY_THRESHOLD = 1024
+
+
+def _table(function):
+    """
+    Build a bytes translation table
+
+    :param function: Byte value transformation
+    :type function: function
+    :rtype: bytes
+    """
+    return bytes(bytearray(function(byte) for byte in range(0, 256)))
+
+
+_LOW = _table(lambda byte: byte & 0x7f)
+# Raw byte MSB to its top bits byte position, by byte position in the word
+_TO_TOP = [_table(lambda byte, j=j: (byte >> 7) << (3 - j)) for j in range(0, WORD_SIZE)]
+# Top bits byte position to a raw byte MSB, by byte position in the word
+_FROM_TOP = [_table(lambda byte, j=j: ((byte >> (3 - j)) & 1) << 7) for j in range(0, WORD_SIZE)]
+
+if numpy is not None:
+    # Top bits byte position by byte position in the word
+    _SHIFTS = numpy.array([3, 2, 1, 0], dtype=numpy.uint8)
+
+try:
+    int.from_bytes
+
+    def _to_int(data):
+        return int.from_bytes(data, 'big')
+
+    def _to_bytes(value, length):
+        return value.to_bytes(length, 'big')
+except AttributeError:
+    # We must be running Python 2
+    def _to_int(data):
+        return int(hexlify(data), 16) if data else 0
+
+    def _to_bytes(value, length):
+        return unhexlify('%0*x' % (length * 2, value)) if length else b''
+
+
+def _bytes(data):
+    """
+    Immutable copy of a buffer
+
+    :type data: bytes | bytearray | memoryview
+    :rtype: bytes
+    """
+    if isinstance(data, bytes):
+        return data
+    return bytes(bytearray(data))
+
+
+def encoded_size(size):
+    """
+    Encoded size of raw data
+
+    :param size: Raw data size (in bytes)
+    :type size: int
+    :rtype: int
+    """
+    return (size + WORD_SIZE - 1) // WORD_SIZE * ENCODED_WORD_SIZE
+
+
+def encode(raw):
+    """
+    Pack raw bytes in 7 bits words
+
+    :param raw: Raw bytes
+    :type raw: bytes | bytearray | memoryview
+    :return: Words of 1 top bits byte followed by 4 bytes
+    :rtype: bytearray
+    """
+    raw = _bytes(raw)
+    padding = -len(raw) % WORD_SIZE
+    if padding:
+        raw += b'\x00' * padding
+    words = len(raw) // WORD_SIZE
+    if numpy is not None and len(raw) >= NUMPY_THRESHOLD:
+        return _encode_numpy(raw, words)
+
+    encoded = bytearray(words * ENCODED_WORD_SIZE)
+    top = 0
+    for j in range(0, WORD_SIZE):
+        column = raw[j::WORD_SIZE]
+        encoded[1 + j::ENCODED_WORD_SIZE] = column.translate(_LOW)
+        top |= _to_int(column.translate(_TO_TOP[j]))
+    encoded[0::ENCODED_WORD_SIZE] = _to_bytes(top, words)
+    return encoded
+
+
+def decode(encoded):
+    """
+    Unpack 7 bits words
+
+    A trailing incomplete word is ignored.
+
+    :param encoded: Words of 1 top bits byte followed by 4 bytes
+    :type encoded: bytes | bytearray | memoryview
+    :return: Raw bytes
+    :rtype: bytearray
+    """
+    words = len(encoded) // ENCODED_WORD_SIZE
+    encoded = _bytes(encoded[0:words * ENCODED_WORD_SIZE])
+    if numpy is not None and len(encoded) >= NUMPY_THRESHOLD:
+        return _decode_numpy(encoded, words)
+
+    raw = bytearray(words * WORD_SIZE)
+    top = encoded[0::ENCODED_WORD_SIZE]
+    for j in range(0, WORD_SIZE):
+        low = _to_int(encoded[1 + j::ENCODED_WORD_SIZE])
+        high = _to_int(top.translate(_FROM_TOP[j]))
+        raw[j::WORD_SIZE] = _to_bytes(low | high, words)
+    return raw
+
+
+def decode_pages(pages):
+    """
+    Unpack the data of consecutive pages in one go
+
+    Encoded pages always hold whole words: they are joined and decoded at once.
+
+    :param pages: Encoded data of each page
+    :type pages: list
+    :return: Raw bytes
+    :rtype: bytearray
+    """
+    return decode(b''.join(_bytes(page) for page in pages))
+
+
+def _encode_numpy(raw, words):
+    """NumPy encoder"""
+    data = numpy.frombuffer(raw, dtype=numpy.uint8).reshape(words, WORD_SIZE)
+    encoded = numpy.empty((words, ENCODED_WORD_SIZE), dtype=numpy.uint8)
+    encoded[:, 1:] = data & 0x7f
+    encoded[:, 0] = ((data >> 7) << _SHIFTS).sum(axis=1, dtype=numpy.uint8)
+    return bytearray(encoded.tobytes())
+
+
+def _decode_numpy(encoded, words):
+    """NumPy decoder"""
+    data = numpy.frombuffer(encoded, dtype=numpy.uint8).reshape(words, ENCODED_WORD_SIZE)
+    raw = data[:, 1:] | (((data[:, 0:1] >> _SHIFTS) & 1) << 7)
+    return bytearray(raw.tobytes())
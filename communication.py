@@ -17,148 +17,404 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-import re
-
-from sysex import SysexMessage
+import threading
+import time
 
 try:
-    # noinspection PyUnresolvedReferences
-    from pygame import midi
+    import queue
 except ImportError:
-    print("This script needs pygame to run")
-    raise
+    # We must be running Python 2
+    # noinspection PyUnresolvedReferences,PyPep8Naming
+    import Queue as queue
+
+import tracing
+from sysex import SysexFramer, SysexMessage
+from transport import PygameTransport
+
+
+class CommunicationTimeout(IOError):
+    """The device did not answer in time"""
+    pass
+
+
+class RttEstimator(object):
+    """
+    Round trip time estimation
+
+    Derives a reply timeout from measured round trip times (RFC 6298).
+    """
+
+    # Shortest timeout (in seconds)
+    MIN_TIMEOUT = 0.05
+
+    def __init__(self, maximum, initial=None):
+        """
+        Initialize estimation
+
+        :param maximum: Longest timeout (in seconds)
+        :param initial: Timeout until a round trip time is measured (in seconds), defaults to the longest
+        :type maximum: float
+        :type initial: float
+        """
+        self.maximum = maximum
+        self.timeout = maximum if initial is None else initial
+        self.srtt = None  # Smoothed round trip time
+        self.rttvar = None  # Round trip time variation
+
+    def update(self, rtt):
+        """
+        Account for a measured round trip time
+
+        :param rtt: Round trip time (in seconds)
+        :type rtt: float
+        """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.timeout = min(max(self.srtt + 4 * self.rttvar, self.MIN_TIMEOUT), self.maximum)
+
+    def backoff(self):
+        """Double the timeout after a lost reply"""
+        self.timeout = min(self.timeout * 2, self.maximum)
+
+
+def drop_stale(frames):
+    """
+    Drop frames nobody waited for
+
+    :param frames: Incoming frames
+    :type frames: queue.Queue | asyncio.Queue
+    """
+    while not frames.empty():
+        logging.debug("Dropping stale frame")
+        frames.get_nowait()
+
+
+class Exchange(object):
+    """
+    One request and its replies
+
+    Decides which frames are replies and when to send the request again, but does no I/O itself:
+    a driver sends request(), waits up to timeout() for each frame and feeds back frames and timeouts.
+    Replies are matched to the request by payload command and packet ID, anything else is dropped.
+    Idempotent requests are sent again when their reply does not come back in time.
+    """
+
+    def __init__(self, msg, timeout, rtt, retries, exit_callback=None):
+        """
+        Initialize an exchange
+
+        :param msg: Request message
+        :param timeout: Maximum time to wait for each reply (in seconds)
+        :param rtt: Round trip time estimation, updated by the exchange
+        :param retries: Transmissions of idempotent requests
+        :param exit_callback: Tells from each answer whether more answers are expected
+        :type msg: bytes | bytearray
+        :type timeout: float
+        :type rtt: RttEstimator
+        :type retries: int
+        :type exit_callback: function
+        """
+        self.msg = msg
+        self.timeout_max = timeout
+        self.rtt = rtt
+        self.retries = retries if SysexMessage.is_idempotent(msg) else 1
+        self.exit_callback = exit_callback
+        self.answers = []
+        self.done = False
+        self._command = SysexMessage.reply_command(msg)
+        self._packet_id = SysexMessage.packet_id(msg)
+        self._attempts = 0
+        self._sent = None  # Last transmission time
+        self._deadline = None  # All transmissions deadline
+        self._wait_until = None  # Next answer deadline
+
+    @property
+    def result(self):
+        """
+        Device answer
+
+        :return: Single answer or all answers
+        :rtype: str, mixed | (str, mixed)[]
+        """
+        if len(self.answers) == 1:
+            return self.answers[0]
+        return self.answers
+
+    def request(self, now):
+        """
+        Get the request to send
+
+        :param now: Current time
+        :type now: float
+        :return: Request message
+        :rtype: bytes | bytearray
+        """
+        if self._deadline is None:
+            self._deadline = now + self.timeout_max
+        self._attempts += 1
+        self._sent = now
+        remaining = self._deadline - now
+        if self._attempts < self.retries:
+            self._wait_until = now + min(self.rtt.timeout, remaining)
+        else:
+            self._wait_until = now + remaining
+        return self.msg
+
+    def timeout(self, now):
+        """
+        Time to wait for the next frame
+
+        :param now: Current time
+        :type now: float
+        :rtype: float
+        """
+        return max(0.0, self._wait_until - now)
+
+    def receive(self, frame, now):
+        """
+        Handle a frame from the device
+
+        :param frame: Complete SysEx frame
+        :param now: Current time
+        :type frame: bytearray
+        :type now: float
+        :return: Answer or None when the frame is not a reply
+        :rtype: (str, mixed) | None
+        """
+        if not SysexMessage.is_reply(frame, self._command, self._packet_id):
+            logging.debug("Dropping unexpected frame")
+            return None
+        answer = SysexMessage.parse(frame)
+        if not self.answers and self._attempts == 1 and self.retries > 1:
+            # Retried requests round trip times are ambiguous
+            self.rtt.update(now - self._sent)
+        self.answers.append(answer)
+        if self.exit_callback is None or self.exit_callback(answer):
+            self.done = True
+        else:
+            logging.debug("<-")
+            self._wait_until = now + self.timeout_max
+        return answer
+
+    def expire(self, now):
+        """
+        Handle a missing reply
+
+        :param now: Current time
+        :type now: float
+        :return: Request message to send again
+        :rtype: bytes | bytearray
+        :raises CommunicationTimeout: The device did not answer in time
+        """
+        if self.answers or self._attempts >= self.retries or now >= self._deadline:
+            raise CommunicationTimeout("No reply from the device after " + str(self.timeout_max) + "s")
+        logging.debug("Retrying request")
+        self.rtt.backoff()
+        return self.request(now)
 
 
 class Communication(object):
     """MIDI communication"""
 
-    def __init__(self):
-        """Initialize a MIDI communication channel"""
-        self.midi_in = None
-        self.midi_out = None
-        logging.debug('Initializing Pygame MIDI')
-        midi.init()
+    # Reply timeout (in seconds)
+    TIMEOUT = 2.0
+    # Polling backoff bounds (in seconds)
+    POLL_MIN = 0.001
+    POLL_MAX = 0.05
+    # Maximum number of MIDI events drained per read
+    READ_SIZE = 1024
+    # Transmissions of idempotent requests
+    RETRIES = 3
+
+    def __init__(self, timeout=TIMEOUT, transport=None, capture=None):
+        """
+        Initialize a MIDI communication channel
+
+        :param timeout: Maximum time to wait for a reply (in seconds)
+        :param transport: Device transport, defaults to pygame MIDI
+        :param capture: Records every frame sent and received
+        :type timeout: float
+        :type transport: transport.Transport
+        :type capture: capture.CaptureWriter
+        """
+        if transport is None:
+            transport = PygameTransport()
+        self.transport = transport
+        self.timeout = timeout
+        self.capture = capture
+        self.rtt = RttEstimator(timeout, timeout / self.RETRIES)
+        self.frames = queue.Queue()  # Complete incoming SysEx frames
+        self.on_frame = None  # Optional frame handler replacing the queue, called from the reader thread
+        self._framer = SysexFramer()
+        self._reader = None
+        self._running = False
+        self._wakeup = threading.Event()
 
     def __del__(self):
         """Destroy MIDI communication channel"""
-        logging.debug('Quitting Pygame MIDI')
-        midi.quit()
+        self.disconnect()
+        self.transport.close()
 
-    # noinspection PyUnboundLocalVariable
     def connect(self):
         """Connect to the first BBS-1"""
-        logging.debug('Attempting MIDI connection')
-
-        # Get number of MIDI devices
-        devices = midi.get_count()
-
-        # Search for the first BodyBeatSync input and output ports
-        for i in range(0, devices):
-            info = midi.get_device_info(i)
-            # Name
-            if re.match('.*BodyBeatSYNC.*', str(info[1])):
-                # Input
-                if info[2] >= 1:
-                    dev_in = i
-                # Output
-                if info[3] >= 1:
-                    dev_out = i
-
-        # Let's check if we got something usable
-        try:
-            dev_in
-        except NameError:
-            error = "Couldn't find BodyBeatSync's input port"
-            logging.warning(error)
-            raise IOError(error)
+        self.transport.open()
+        self._start_reader()
 
-        try:
-            dev_out
-        except NameError:
-            error = "Couldn't find BodyBeatSync's output port"
-            logging.warning(error)
-            raise IOError(error)
+    def reconnect(self):
+        """
+        Reconnect to the same BBS-1 after a communication loss
+
+        :raises IOError: The device could not be reached
+        """
+        logging.debug('Reconnecting')
+        self.disconnect()
+        # Drop replies received before the loss
+        drop_stale(self.frames)
+        self.transport.reopen()
+        self._start_reader()
+
+    def disconnect(self):
+        """Stop listening to the device"""
+        if self._reader is None:
+            return
+        logging.debug('Stopping MIDI reader')
+        self._running = False
+        self._wakeup.set()
+        if self._reader is not threading.current_thread():
+            self._reader.join()
+        self._reader = None
+
+    def _start_reader(self):
+        """Start the background MIDI reader thread"""
+        self.disconnect()
+        self._framer.reset()
+        self._running = True
+        self._reader = threading.Thread(target=self._read_loop, name='BBS1 MIDI reader')
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _read_loop(self):
+        """
+        Drain the MIDI input and queue complete SysEx frames
 
-        # Open input and output
-        logging.debug('Opening MIDI ports')
-        self.midi_in = midi.Input(dev_in)
-        self.midi_out = midi.Output(dev_out)
+        Runs in the reader thread.
+        Sleeps with an exponential backoff while the input is idle.
+        """
+        delay = self.POLL_MIN
+        while self._running:
+            try:
+                pending = self.transport.poll()
+                data = self.transport.read(self.READ_SIZE) if pending else None
+            except Exception as error:
+                # Device unplugged: stop reading, requests will time out
+                logging.warning("MIDI input lost: " + str(error))
+                self._running = False
+                break
+            if pending:
+                for frame in self._framer.feed(data):
+                    if tracing.enabled:
+                        tracing.emit(tracing.FRAME_IN, frame)
+                    if self.capture is not None:
+                        self.capture.record(tracing.FRAME_IN, frame)
+                    if self.on_frame is None:
+                        self.frames.put(frame)
+                    else:
+                        self.on_frame(frame)
+                delay = self.POLL_MIN
+            else:
+                self._wakeup.wait(delay)
+                if self._wakeup.is_set():
+                    # A request has just been sent: expect a reply soon
+                    self._wakeup.clear()
+                    delay = self.POLL_MIN
+                else:
+                    delay = min(delay * 2, self.POLL_MAX)
 
     def send(self, msg):
         """
         Sends out SysEx message
 
         :param msg: Message
-        :type msg: list
+        :type msg: bytes | bytearray
         """
 
-        logging.debug("->")
-        if logging.getLogger().getEffectiveLevel() == logging.DEBUG:
-            # Parse messages for debugging
-            SysexMessage.parse(msg)
+        if tracing.enabled:
+            tracing.emit(tracing.FRAME_OUT, msg)
+        if self.capture is not None:
+            self.capture.record(tracing.FRAME_OUT, msg)
 
-        try:
-            self.midi_out.write_sys_ex(0, msg)
-        except TypeError:
-            # We must be running Python 3, let's send bytes
-            self.midi_out.write_sys_ex(0, bytes(msg))
+        self.transport.write(msg)
+        self._wakeup.set()
 
     def get_data(self, msg, exit_callback=None):
         """
         Gets reply from the hardware after sending a message
 
+        See Exchange for replies matching and retries.
+
         :param msg: Message
-        :type msg: list
+        :type msg: bytes | bytearray
         :param exit_callback: A callback function to stop listening to the device
         :type exit_callback: function
         :return: Device answer
         :rtype: str, mixed | (str, mixed)[]
+        :raises CommunicationTimeout: The device did not answer in time
         """
-        self.send(msg)
-
-        answers = []
-        answer = None
-        condition = True
-        while condition:
-            logging.debug("<-")
-            answer = self._wait_for_data()
-            answers.append(answer)
-            if exit_callback is None:
-                condition = False
+        exchange = Exchange(msg, self.timeout, self.rtt, self.RETRIES, exit_callback)
+        drop_stale(self.frames)
+        self.send(exchange.request(time.time()))
+        while not exchange.done:
+            try:
+                frame = self._get_frame(exchange.timeout(time.time()))
+            except CommunicationTimeout:
+                self.send(exchange.expire(time.time()))
             else:
-                condition = not exit_callback(answer)
+                exchange.receive(frame, time.time())
+        return exchange.result
 
-        if len(answers) == 1:
-            return answer
+    def receive_frame(self, timeout=None):
+        """
+        Gets the next frame from the hardware without sending anything
 
-        return answers
+        :param timeout: Maximum time to wait (in seconds), defaults to the channel timeout
+        :type timeout: float
+        :return: Complete SysEx frame
+        :rtype: bytearray
+        :raises CommunicationTimeout: The device did not answer in time
+        """
+        return self._get_frame(timeout)
 
-    def _wait_for_data(self):
+    def _wait_for_data(self, timeout=None):
         """
         Wait for and get input data
 
+        :param timeout: Maximum time to wait (in seconds), defaults to the channel timeout
+        :type timeout: float
         :return: Answer
         :rtype: str, mixed
+        :raises CommunicationTimeout: The device did not answer in time
         """
-        # Wait for answer
-        while not self.midi_in.poll():
-            pass
-
-        # Read answer
-        raw_answers = list()
-        answer = list()
-
-        while self.midi_in.poll():
-            raw_answers.append(self.midi_in.read(1))
+        return SysexMessage.parse(self._get_frame(timeout))
 
-        for raw_answer in raw_answers:
-            for event in raw_answer:
-                for data in event[0]:
-                    answer.append(data)
-                    # Strip remaining garbage data after sysex end
-                    if data == 0xf7:
-                        break
-
-        # TODO: Timeout on no reply
+    def _get_frame(self, timeout=None):
+        """
+        Wait for and get the next input frame
 
-        return SysexMessage.parse(answer)
+        :param timeout: Maximum time to wait (in seconds), defaults to the channel timeout
+        :type timeout: float
+        :return: Complete SysEx frame
+        :rtype: bytearray
+        :raises CommunicationTimeout: The device did not answer in time
+        """
+        if timeout is None:
+            timeout = self.timeout
+        try:
+            return self.frames.get(timeout=timeout)
+        except queue.Empty:
+            error = "No reply from the device after " + str(timeout) + "s"
+            logging.warning(error)
+            raise CommunicationTimeout(error)
@@ -17,8 +17,282 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+import time
+from collections import deque
 
-from sysex import SysexMessage
+from communication import CommunicationTimeout, RttEstimator
+# noinspection PyProtectedMember
+from sysex import SysexMessage, TempoMapsDecoder, _FW_TX_CMP, _LAST_PAGE
+
+# Device operations yielded by Bbs1 commands procedures
+REQUEST = 'request'  # (REQUEST, message, exit callback): get the device answer
+POST = 'post'  # (POST, message): send a message expecting no answer
+UPLOAD = 'upload'  # (UPLOAD, upload): drive a PageUpload
+CALL = 'call'  # (CALL, procedure): run another procedure and get its result
+RESULT = 'result'  # (RESULT, value): end the procedure with its result
+
+
+class PageUpload(object):
+    """
+    Pipelined pages upload
+
+    Keeps a bounded window of pages in flight instead of waiting for each page acknowledgment.
+    The window grows by one page on each acknowledgment and shrinks when the device
+    rejects a page or stops answering, so sending adapts to what the device can buffer.
+    Only rejected or unacknowledged pages are sent again.
+
+    Does no I/O itself: a driver sends next_pages() and feeds back answers and timeouts.
+    With a completion notice, the upload is only done once the device sends it or fails to in time.
+    """
+
+    # Maximum pages in flight
+    WINDOW = 8
+    # Maximum transmissions of a page
+    RETRIES = 5
+
+    def __init__(self, pages, timeout, window=WINDOW, retries=RETRIES, count=None, first=0, on_acknowledged=None,
+                 notice=False):
+        """
+        Initialize upload
+
+        :param pages: Page messages or tuples of messages, the last one flagged with the last page ID
+        :param timeout: Longest acknowledgment timeout (in seconds)
+        :param window: Maximum pages in flight
+        :param retries: Maximum transmissions of a page
+        :param count: Number of pages, lets pages be generated only when first sent
+        :param first: Index of the first page, previous ones are already acknowledged
+        :param on_acknowledged: Called with the index of each acknowledged page
+        :param notice: Wait for a transfer completion notice after the last page
+        :type pages: list[] | generator
+        :type timeout: float
+        :type window: int
+        :type retries: int
+        :type count: int
+        :type first: int
+        :type on_acknowledged: function
+        :type notice: bool
+        """
+        if count is None:
+            pages = list(pages)
+            count = first + len(pages)
+        self.pages = {}  # Unacknowledged page messages by index, kept for retransmission
+        self.count = count
+        self.complete = False  # Transfer completion notice received
+        self.window = window
+        self.retries = retries
+        self.rtt = RttEstimator(timeout)
+        self.cwnd = 1.0  # Current window
+        self.on_acknowledged = on_acknowledged
+        self.notice = notice
+        self._notice_deadline = None  # Set once all pages are acknowledged
+        self._pages = iter(pages)
+        self._command = None  # Page acknowledgments payload command, known once a page is generated
+        self._generated = first
+        self._last = count - 1
+        self._todo = deque(range(first, self._last))  # Pages to send
+        self._in_flight = {}  # Sent time by page index
+        self._sent = [0] * count  # Transmissions by page index
+        self._acked = set(range(0, first))
+
+    @property
+    def acknowledged(self):
+        """
+        All pages acknowledged
+
+        :rtype: bool
+        """
+        return len(self._acked) == self.count
+
+    @property
+    def done(self):
+        """
+        Upload completion
+
+        :rtype: bool
+        """
+        return self.acknowledged and (not self.notice or self.complete or self._notice_deadline is None)
+
+    def _page(self, index):
+        """
+        Get a page, generating pages up to it as needed
+
+        :param index: Page index
+        :type index: int
+        :return: Page message or messages
+        :rtype: bytearray | tuple
+        """
+        while self._generated <= index:
+            page = next(self._pages)
+            self._command = SysexMessage.reply_command(page[-1] if isinstance(page, tuple) else page)
+            self.pages[self._generated] = page
+            self._generated += 1
+        return self.pages[index]
+
+    def next_pages(self, now):
+        """
+        Get the pages to send now
+
+        :param now: Current time
+        :type now: float
+        :return: Page messages
+        :rtype: list[]
+        :raises IOError: A page was rejected too many times
+        """
+        # The last page commits the upload: wait for all the others to be acknowledged
+        if (not self._todo and not self._in_flight
+                and self._last >= 0 and self._last not in self._acked):
+            self._todo.append(self._last)
+
+        messages = []
+        while self._todo and len(self._in_flight) < int(self.cwnd):
+            index = self._todo.popleft()
+            if self._sent[index] >= self.retries:
+                error = "Page #" + str(index) + " failed " + str(self.retries) + " times"
+                logging.warning(error)
+                raise IOError(error)
+            self._sent[index] += 1
+            self._in_flight[index] = now
+            page = self._page(index)
+            if isinstance(page, tuple):
+                messages.extend(page)
+            else:
+                messages.append(page)
+        return messages
+
+    def timeout(self, now):
+        """
+        Time to wait for an answer before the oldest page in flight expires
+
+        :param now: Current time
+        :type now: float
+        :rtype: float
+        """
+        if self.acknowledged and self._notice_deadline is not None:
+            return max(0.0, self._notice_deadline - now)
+        if not self._in_flight:
+            return self.rtt.timeout
+        return max(0.0, min(self._in_flight.values()) + self.rtt.timeout - now)
+
+    def receive(self, frame, now):
+        """
+        Handle a frame from the device
+
+        Only page acknowledgments and the transfer completion notice are handled, anything else is dropped.
+
+        :param frame: Complete SysEx frame
+        :param now: Current time
+        :type frame: bytearray
+        :type now: float
+        :return: Answer or None when the frame was dropped
+        :rtype: (str, mixed) | None
+        """
+        if not (SysexMessage.is_reply(frame, self._command)
+                or self.notice and SysexMessage.is_reply(frame, _FW_TX_CMP)):
+            logging.debug("Dropping unexpected frame")
+            return None
+        try:
+            answer = SysexMessage.parse(frame)
+        except TypeError as error:
+            logging.debug("Dropping invalid frame: " + str(error))
+            return None
+        self.acknowledge(answer, now)
+        return answer
+
+    def acknowledge(self, answer, now):
+        """
+        Handle an answer from the device
+
+        :param answer: Parsed answer
+        :param now: Current time
+        :type answer: str, mixed
+        :type now: float
+        """
+        if answer[1] == 'complete':
+            self.complete = True
+            return
+
+        page_id = SysexMessage.page_id(answer)
+        index = self._last if page_id == _LAST_PAGE else page_id
+        if index not in self._in_flight:
+            logging.debug("Ignoring stale answer")
+            return
+
+        sent = self._in_flight.pop(index)
+        if answer[0] == 'ok':
+            self._acked.add(index)
+            del self.pages[index]
+            if self.on_acknowledged is not None:
+                self.on_acknowledged(index)
+            if self._sent[index] == 1:
+                # Retransmitted pages round trip times are ambiguous
+                self.rtt.update(now - sent)
+            self.cwnd = min(float(self.window), self.cwnd + 1)
+            if self.notice and self.acknowledged and not self.complete:
+                self._notice_deadline = now + self.rtt.maximum
+        else:
+            logging.debug("Page #" + str(index) + " rejected")
+            self._todo.appendleft(index)
+            self.cwnd = max(1.0, self.cwnd / 2)
+
+    def expire(self, now):
+        """
+        Handle a missing answer: send expired pages again
+
+        :param now: Current time
+        :type now: float
+        """
+        if self.acknowledged:
+            if self._notice_deadline is not None and now >= self._notice_deadline:
+                logging.warning("No transfer completion notice")
+                self._notice_deadline = None
+            return
+        expired = sorted(index for index, sent in self._in_flight.items()
+                         if now - sent >= self.rtt.timeout)
+        if not expired:
+            return
+        logging.debug("Pages " + str(expired) + " unacknowledged")
+        for index in expired:
+            del self._in_flight[index]
+        self._todo.extendleft(reversed(expired))
+        self.cwnd = 1.0
+        self.rtt.backoff()
+
+
+class FirmwareUpload(PageUpload):
+    """
+    Firmware pages upload
+
+    With a journal, an interrupted transfer of the same image resumes at the first unacknowledged page.
+    The upload is done when the device notifies the transfer completion.
+    """
+
+    def __init__(self, image, timeout, journal=None):
+        """
+        Initialize upload
+
+        :param image: Firmware image
+        :param timeout: Longest acknowledgment timeout (in seconds)
+        :param journal: Flashing progress journal
+        :type image: firmware.FirmwareImage
+        :type timeout: float
+        :type journal: firmware.FlashJournal
+        """
+        self.journal = journal
+        if journal is None:
+            PageUpload.__init__(self, image.iter_pages(), timeout, count=image.count, notice=True)
+        else:
+            first = journal.resume(image)
+            PageUpload.__init__(self, image.iter_pages(first), timeout, count=image.count,
+                                first=first, on_acknowledged=journal.record, notice=True)
+
+    def close(self):
+        """Keep the progress of an interrupted upload, forget a finished one"""
+        if self.journal is None:
+            return
+        if self.acknowledged:
+            self.journal.remove()
+        else:
+            self.journal.close()
 
 
 class Bbs1(object):
@@ -44,51 +318,223 @@ class Bbs1(object):
 
     def present(self):
         """Tests if the hardware is present and if communication is possible"""
-        logging.debug("Hardware Present?")
-        reply = self.com.get_data(SysexMessage.build_msg_req_con())
-        if reply == ('ok', 'connected'):
-            return True
-        return False
+        return self._run(self._present())
 
     def get_mode(self):
         """Gets the current mode (Normal/Firmware upload)"""
+        return self._run(self._get_mode())
+
+    def get_hardware_version(self):
+        """Returns the hardware version in human readable form"""
+        return self._run(self._get_hardware_version())
+
+    def get_firmware_version(self):
+        """Returns the firmware version in human readable form"""
+        return self._run(self._get_firmware_version())
+
+    def identify(self):
+        """
+        Identify the connected device
+
+        :return: (mode, hardware version, firmware version) or None when not present
+        :rtype: (str, str, str) | None
+        """
+        return self._run(self._identify())
+
+    def get_tempomaps(self, on_map=None):
+        """
+        Get tempo maps from the device
+
+        Pages are decoded while the dump is still arriving.
+
+        :param on_map: Called with the map index and the map as soon as a map is received
+        :type on_map: function
+        :return: Tempo file
+        :rtype: tempo.File
+        :raises IOError: Communication failed, a dump interrupted midway keeps the maps received in its tempofile
+        :raises TypeError: Not tempo maps data, with the maps received in its tempofile
+        """
+        return self._run(self._get_tempomaps(on_map))
+
+    def send_tempomaps(self, tempofile):
+        """
+        Send tempo maps to the device
+
+        :param tempofile: Tempo file
+        :type tempofile: tempo.File
+        :raises IOError: The device rejected a page too many times
+        :raises TypeError: Tempo maps too large
+        """
+        self._run(self._send_tempomaps(tempofile))
+
+    def clear_tempomaps(self):
+        """Clear the device's tempo maps storage"""
+        self._run(self._clear_tempomaps())
+
+    def send_firmware(self, image, journal=None):
+        """
+        Flash a firmware image
+
+        The device must be in firmware mode.
+        With a journal, an interrupted transfer of the same image resumes at the first unacknowledged page.
+
+        :param image: Firmware image
+        :param journal: Flashing progress journal
+        :type image: firmware.FirmwareImage
+        :type journal: firmware.FlashJournal
+        :raises IOError: The device is not in firmware mode or rejected a page too many times
+        """
+        self._run(self._send_firmware(image, journal))
+
+    ##
+    # Commands procedures
+    #
+    # Procedures are generators yielding device operations and getting back their results,
+    # failed operations raise their exception in the procedure.
+    # They do no I/O themselves: _run() drives them with blocking calls, aio.AsyncBbs1 awaits them.
+    ##
+
+    def _present(self):
+        """present() procedure"""
+        logging.debug("Hardware Present?")
+        try:
+            reply = yield REQUEST, SysexMessage.build_msg_req_con(), None
+        except CommunicationTimeout:
+            reply = None
+        yield RESULT, reply == ('ok', 'connected')
+
+    def _get_mode(self):
+        """get_mode() procedure"""
         logging.debug("Get mode?")
-        reply = self.com.get_data(SysexMessage.build_msg_req_mode())
-        if reply[0] == 'ok':
-            return reply[1]
-        else:
+        reply = yield REQUEST, SysexMessage.build_msg_req_mode(), None
+        if reply[0] != 'ok':
             raise Warning
+        yield RESULT, reply[1]
 
     def _get_version(self, part):
-        """Returns the version in human readable form"""
-        reply = self.com.get_data(part)
-        if reply[0] == 'ok':
-            return reply[1]
-        else:
+        """Version request procedure"""
+        reply = yield REQUEST, part, None
+        if reply[0] != 'ok':
             raise Warning
+        yield RESULT, reply[1]
 
-    def get_hardware_version(self):
-        """Returns the hardware version in human readable form"""
+    def _get_hardware_version(self):
+        """get_hardware_version() procedure"""
         logging.debug("Get HW version?")
-        self.__hw_vers = self._get_version(SysexMessage.build_msg_req_hw_vers())
-        return self.__hw_vers
+        self.__hw_vers = yield CALL, self._get_version(SysexMessage.build_msg_req_hw_vers())
+        yield RESULT, self.__hw_vers
 
-    def get_firmware_version(self):
-        """Returns the firmware version in human readable form"""
+    def _get_firmware_version(self):
+        """get_firmware_version() procedure"""
         logging.debug("Get FW version?")
-        self.__fw_vers = self._get_version(SysexMessage.build_msg_req_fw_vers())
-        return self.__fw_vers
+        self.__fw_vers = yield CALL, self._get_version(SysexMessage.build_msg_req_fw_vers())
+        yield RESULT, self.__fw_vers
+
+    def _identify(self):
+        """identify() procedure"""
+        identity = None
+        if (yield CALL, self._present()):
+            mode = yield CALL, self._get_mode()
+            hw_vers = yield CALL, self._get_hardware_version()
+            fw_vers = yield CALL, self._get_firmware_version()
+            identity = mode, hw_vers, fw_vers
+        yield RESULT, identity
 
-    def get_tempomaps(self):
-        """Get tempo maps from the device"""
+    def _get_tempomaps(self, on_map):
+        """get_tempomaps() procedure"""
         logging.debug("Get tempo maps?")
-        infos = self.com.get_data(SysexMessage.build_msg_req_tm())
-        # TODO: decode infos (seem to always be 13 zeros)
-        tm = self.com.get_data(SysexMessage.build_msg_ack_ok(), SysexMessage.is_last_tm_page)
-        tempofile = SysexMessage.parse_tempo_maps_pages(tm)
-        return tempofile
+        infos = yield REQUEST, SysexMessage.build_msg_req_tm(), None
+        # TODO: decode infos (seem to always be 13 zeros)
+        decoder = TempoMapsDecoder(on_map)
+        try:
+            yield REQUEST, SysexMessage.build_msg_ack_ok(), decoder.feed
+        except (IOError, TypeError) as error:
+            # Only the first decoder.maps_done maps are complete
+            error.tempofile = decoder.tempofile
+            raise
+        yield RESULT, decoder.tempofile
 
-    def clear_tempomaps(self):
-        """Clear the device's tempo maps storage"""
+    def _send_tempomaps(self, tempofile):
+        """send_tempomaps() procedure"""
+        logging.debug("Send tempo maps")
+        SysexMessage.check_tempo_maps_size(tempofile)
+        yield UPLOAD, PageUpload(SysexMessage.iter_tempo_maps_pages(tempofile), self.com.timeout,
+                                 count=SysexMessage.tempo_maps_pages_count(tempofile))
+
+    def _clear_tempomaps(self):
+        """clear_tempomaps() procedure"""
         logging.debug("Clear tempo maps")
-        self.com.send(SysexMessage.build_msg_del_tm())
+        yield POST, SysexMessage.build_msg_del_tm()
+
+    def _send_firmware(self, image, journal):
+        """send_firmware() procedure"""
+        logging.debug("Send firmware")
+        if (yield CALL, self._get_mode()) != 'firmware':
+            raise IOError("BBS-1 is not in firmware mode")
+        upload = FirmwareUpload(image, self.com.timeout, journal)
+        try:
+            yield UPLOAD, upload
+        finally:
+            upload.close()
+
+    ##
+    # Blocking driver
+    ##
+
+    def _run(self, procedure):
+        """
+        Drive a command procedure
+
+        :param procedure: Command procedure
+        :type procedure: generator
+        :return: Command result
+        """
+        result = None
+        error = None
+        while True:
+            try:
+                operation = procedure.send(result) if error is None else procedure.throw(error)
+            except StopIteration:
+                return None
+            if operation[0] == RESULT:
+                procedure.close()
+                return operation[1]
+            result = error = None
+            try:
+                result = self._perform(operation)
+            except Exception as failure:
+                error = failure
+
+    def _perform(self, operation):
+        """
+        Perform a device operation
+
+        :param operation: Device operation
+        :type operation: tuple
+        :return: Operation result
+        """
+        if operation[0] == REQUEST:
+            return self.com.get_data(operation[1], operation[2])
+        if operation[0] == POST:
+            return self.com.send(operation[1])
+        if operation[0] == UPLOAD:
+            return self._upload(operation[1])
+        return self._run(operation[1])
+
+    def _upload(self, upload):
+        """
+        Drive a pages upload
+
+        :param upload: Pages upload
+        :type upload: PageUpload
+        :raises IOError: The device rejected a page too many times
+        """
+        while not upload.done:
+            for msg in upload.next_pages(time.time()):
+                self.com.send(msg)
+            try:
+                frame = self.com.receive_frame(upload.timeout(time.time()))
+            except CommunicationTimeout:
+                upload.expire(time.time())
+            else:
+                upload.receive(frame, time.time())
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 *-*
+"""BBS1 device discovery"""
+# A tool to communicate with Peterson's BBS-1 metronome
+# Copyright (C) 2012-2015 Raphaël Doursenaud <rdoursenaud@free.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import threading
+
+import transport
+from transport import PygameTransport
+
+# Sound devices nodes (Linux)
+_SND_DIR = '/dev/snd'
+
+
+def _hotplug_signature():
+    """
+    Cheap snapshot of the plugged sound devices
+
+    :return: Devices signature or None when unsupported on this platform
+    :rtype: tuple | None
+    """
+    try:
+        return tuple(sorted(os.listdir(_SND_DIR)))
+    except OSError:
+        return None
+
+
+class DeviceDiscovery(object):
+    """
+    BBS-1 discovery service
+
+    Keeps the BBS-1 ports table between connections so reconnecting does not scan every MIDI port again.
+    Optionally watches for devices being plugged or unplugged.
+    """
+
+    # Hotplug check interval (in seconds)
+    INTERVAL = 1.0
+
+    def __init__(self, interval=INTERVAL):
+        """
+        Initialize discovery
+
+        :param interval: Hotplug check interval (in seconds)
+        :type interval: float
+        """
+        self.interval = interval
+        self._ports = None  # Cached (input port ID, output port ID) pairs
+        self._plugged = False  # Devices changed since the last scan
+        self._lock = threading.Lock()
+        self._signature = _hotplug_signature()
+        self._callbacks = []
+        self._watcher = None
+        self._stop = threading.Event()
+
+    def ports(self):
+        """
+        BBS-1 ports, scanned on first use only
+
+        :return: (input port ID, output port ID) for each device
+        :rtype: (int, int)[]
+        """
+        with self._lock:
+            if self._ports is None:
+                if self._plugged:
+                    # Devices plugged while ports are in use only show up once they are closed
+                    self._plugged = not transport.midi_reinit()
+                self._ports = PygameTransport.find_ports()
+            return list(self._ports)
+
+    def refresh(self, current=None):
+        """
+        Rescan the BBS-1 ports
+
+        Restarts pygame MIDI so newly plugged devices show up, unless other transports have open ports.
+
+        :param current: Transport being reconnected, its ports are closed and must be reopened
+        :type current: transport.Transport
+        :return: (input port ID, output port ID) for each device
+        :rtype: (int, int)[]
+        """
+        with self._lock:
+            logging.debug('Rescanning MIDI ports')
+            self._plugged = not transport.midi_reinit(current)
+            self._ports = PygameTransport.find_ports()
+            return list(self._ports)
+
+    def transport(self, index=0):
+        """
+        Build a transport to a discovered BBS-1
+
+        :param index: Device index
+        :type index: int
+        :return: Transport bound to the device ports, or searching on open when no such device is known
+        :rtype: transport.PygameTransport
+        """
+        ports = self.ports()
+        if index < len(ports):
+            return PygameTransport(*ports[index])
+        return PygameTransport()
+
+    def reconnect(self, dev, index=0):
+        """
+        Reconnect a lost BBS-1
+
+        Reopens the cached ports first.
+        The ports are only rescanned if the device does not answer there anymore.
+
+        :param dev: Device to reconnect
+        :param index: Device index in the ports table
+        :type dev: device.Bbs1
+        :type index: int
+        :return: Reconnection status
+        :rtype: bool
+        """
+        try:
+            dev.com.reconnect()
+            if dev.present():
+                return True
+        except IOError as error:
+            logging.debug(error)
+
+        ports = self.refresh(dev.com.transport)
+        if index >= len(ports):
+            return False
+        dev.com.transport.dev_in, dev.com.transport.dev_out = ports[index]
+        try:
+            dev.com.reconnect()
+        except IOError as error:
+            logging.warning(error)
+            return False
+        return dev.present()
+
+    def watch(self, callback):
+        """
+        Get notified when devices are plugged or unplugged
+
+        The ports table is marked stale before calling back: it will be rescanned on next use.
+
+        :param callback: Called from the watcher thread without arguments
+        :type callback: function
+        """
+        self._callbacks.append(callback)
+        if self._watcher is not None:
+            return
+        if self._signature is None:
+            logging.info('Hotplug detection is not supported on this platform')
+            return
+        self._stop.clear()
+        self._watcher = threading.Thread(target=self._watch_loop, name='BBS1 hotplug watcher')
+        self._watcher.daemon = True
+        self._watcher.start()
+
+    def stop(self):
+        """Stop watching for devices"""
+        if self._watcher is None:
+            return
+        self._stop.set()
+        self._watcher.join()
+        self._watcher = None
+
+    def _watch_loop(self):
+        """Hotplug watcher thread"""
+        while not self._stop.wait(self.interval):
+            signature = _hotplug_signature()
+            if signature == self._signature:
+                continue
+            logging.debug('Sound devices changed')
+            self._signature = signature
+            with self._lock:
+                self._ports = None
+                self._plugged = True
+            for callback in self._callbacks:
+                callback()
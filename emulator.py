@@ -0,0 +1,315 @@
+# -*- coding: utf-8 *-*
+"""BBS1 device emulator"""
+# A tool to communicate with Peterson's BBS-1 metronome
+# Copyright (C) 2012-2015 Raphaël Doursenaud <rdoursenaud@free.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import random
+import struct
+import threading
+import time
+from collections import deque
+
+# noinspection PyProtectedMember
+from sysex import (SysexMessage, _SYX_START, _SYX_END, _MAN_ID1, _MAN_ID2, _MAN_ID3, _DEV_ID,
+                   _DATA, _ACK_OK, _ACK_ERR, _RESERVED, _FW_PG, _TX_FW_PG, _FW_TX_CMP,
+                   _REQ_HW_VERS, _ANS_HW_VERS, _REQ_FW_VERS, _ANS_FW_VERS,
+                   _REQ_TM, _TX_TM_PG, _TM_PG, _REQ_CON, _ACK_CON, _REQ_MODE, _ANS_MODE, _DEL_TM,
+                   _PAGE_SIZE, _LAST_PAGE)
+import codec
+import firmware
+from transport import Transport
+
+
+class Bbs1Emulator(Transport):
+    """
+    Software BBS-1
+
+    Answers the SysEx protocol from an in-memory tempo maps storage.
+    Replies become readable after a configurable latency.
+    """
+
+    STORAGE_SIZE = 36864  # 4kB * 9
+    MAPS_COUNT = 9
+    MODES = {'normal': 0x00, 'firmware': 0x01}
+
+    def __init__(self, latency=0.0, page_delay=0.0, mode='normal',
+                 hw_version=(1, 0, 0, 0, 0), fw_version=(1, 0, 0, 0, 0), image=None,
+                 buffer_pages=None, error_rate=0.0, seed=None):
+        """
+        Initialize emulated device
+
+        :param latency: Delay before a reply can be read (in seconds)
+        :param page_delay: Time to send or process a tempo map page (in seconds)
+        :param mode: Boot mode ('normal' or 'firmware')
+        :param hw_version: Hardware version digits (x.xx.xx)
+        :param fw_version: Firmware version digits (x.xx.xx)
+        :param image: Raw tempo maps storage content, defaults to an erased storage
+        :param buffer_pages: Received pages waiting for processing before overrun, unlimited by default
+        :param error_rate: Probability of rejecting a received page
+        :param seed: Random errors seed
+        :type latency: float
+        :type page_delay: float
+        :type mode: str
+        :type hw_version: (int, int, int, int, int)
+        :type fw_version: (int, int, int, int, int)
+        :type image: bytes | bytearray
+        :type buffer_pages: int
+        :type error_rate: float
+        """
+        self.latency = latency
+        self.page_delay = page_delay
+        self.buffer_pages = buffer_pages
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self.mode = mode
+        self.hw_version = hw_version
+        self.fw_version = fw_version
+        self.storage = bytearray(self.STORAGE_SIZE)
+        if image is None:
+            self.erase()
+        else:
+            self.storage[0:len(image)] = image
+        self._replies = deque()  # (due time, frame)
+        self._lock = threading.Lock()
+        self._tm_requested = False
+        self._upload = {}  # Received tempo map pages by index
+        self._backlog = deque()  # Received pages processing completion times
+        self.firmware = None  # Last flashed firmware image
+        self._fw_prepared = {}  # (page index, size, checksum) by packet ID
+        self._fw_pages = {}  # Received firmware pages by index
+
+    def open(self):
+        logging.debug('Emulated BBS-1 connected')
+
+    def close(self):
+        with self._lock:
+            self._replies.clear()
+
+    @property
+    def size(self):
+        """
+        Used storage size
+
+        :rtype: int
+        """
+        return struct.unpack_from('<H', self.storage, 4)[0]
+
+    def erase(self):
+        """Erase the tempo maps storage"""
+        logging.debug('Emulated BBS-1 erasing tempo maps')
+        self.storage[:] = bytearray(self.STORAGE_SIZE)
+        # Version 2 header followed by empty map entries
+        size = 8 + self.MAPS_COUNT * 24
+        struct.pack_into('<3sBHBx', self.storage, 0, b'BBS', 2, size, self.MAPS_COUNT)
+
+    def write(self, msg):
+        msg = bytearray(msg)
+        if (len(msg) < 8 or msg[0] != _SYX_START or msg[-1] != _SYX_END
+                or msg[1:5] != bytearray([_MAN_ID1, _MAN_ID2, _MAN_ID3, _DEV_ID])):
+            logging.warning('Emulated BBS-1 ignoring invalid message')
+            return
+
+        msg_type = msg[5]
+        command = msg[7] if len(msg) > 8 else None
+
+        if msg_type == _ACK_OK and self._tm_requested:
+            self._tm_requested = False
+            self._reply_tm_pages()
+        elif command == _REQ_CON:
+            self._reply(_ACK_OK, [_RESERVED, _ACK_CON])
+        elif command == _REQ_MODE:
+            self._reply(_ACK_OK, [_RESERVED, _ANS_MODE, self.MODES[self.mode]])
+        elif command == _REQ_HW_VERS:
+            self._reply(_ACK_OK, [_RESERVED, _ANS_HW_VERS, 0, 0, 0, 0] + list(self.hw_version))
+        elif command == _REQ_FW_VERS:
+            self._reply(_ACK_OK, [_RESERVED, _ANS_FW_VERS, 0, 0, 0, 0] + list(self.fw_version))
+        elif command == _REQ_TM:
+            self._tm_requested = True
+            self._reply(_DATA, [0] * 13)
+        elif command == _DEL_TM:
+            self.erase()
+        elif command == _TX_TM_PG:
+            self._receive_tm_page(msg)
+        elif command in (_FW_PG, _TX_FW_PG) and self.mode != 'firmware':
+            logging.warning('Emulated BBS-1 ignoring firmware page in normal mode')
+        elif command == _FW_PG:
+            self._prepare_fw_page(msg)
+        elif command == _TX_FW_PG:
+            self._receive_fw_page(msg)
+        else:
+            logging.warning('Emulated BBS-1 ignoring unknown command')
+
+    def poll(self):
+        with self._lock:
+            return bool(self._replies) and self._replies[0][0] <= time.time()
+
+    def read(self, size):
+        # MIDI events carry 4 SysEx bytes
+        data = bytearray()
+        now = time.time()
+        with self._lock:
+            while self._replies and self._replies[0][0] <= now and len(data) < size * 4:
+                data += self._replies.popleft()[1]
+        return data
+
+    def _reply(self, msg_type, payload, delay=0.0):
+        """
+        Queue a reply
+
+        :param msg_type: Message type
+        :param payload: Message payload
+        :param delay: Additional delay (in seconds)
+        :type msg_type: int
+        :type payload: list | bytearray
+        :type delay: float
+        """
+        frame = bytearray([_SYX_START, _MAN_ID1, _MAN_ID2, _MAN_ID3, _DEV_ID, msg_type])
+        frame += bytearray(payload)
+        frame.append(_SYX_END)
+        with self._lock:
+            self._replies.append((time.time() + self.latency + delay, frame))
+
+    def _reply_tm_pages(self):
+        """Queue the tempo maps storage content as pages"""
+        size = self.size
+        pages = (size + _PAGE_SIZE - 1) // _PAGE_SIZE
+        for page in range(0, pages):
+            if page == pages - 1:
+                page_id = _LAST_PAGE
+            else:
+                page_id = page
+            raw = self.storage[page * _PAGE_SIZE:(page + 1) * _PAGE_SIZE]
+            encoded = SysexMessage.encode_data(raw)
+            payload = bytearray([len(encoded), _TM_PG, page_id >> 7, page_id & 0x7f, 0, 0])
+            self._reply(_DATA, payload + encoded, page * self.page_delay)
+
+    def _admit_page(self, ack):
+        """
+        Queue a received page for processing
+
+        Pages are processed one at a time.
+        A page arriving while the input buffer is full is rejected, as are random pages.
+
+        :param ack: Page acknowledgment payload
+        :type ack: list
+        :return: Delay until the page is processed (in seconds) or None when rejected
+        :rtype: float | None
+        """
+        now = time.time()
+        while self._backlog and self._backlog[0] <= now:
+            self._backlog.popleft()
+        if self.buffer_pages is not None and len(self._backlog) >= self.buffer_pages:
+            logging.debug('Emulated BBS-1 input buffer overrun')
+            self._reply(_ACK_ERR, ack)
+            return None
+        done = max([now] + list(self._backlog)) + self.page_delay
+        self._backlog.append(done)
+
+        if self._random.random() < self.error_rate:
+            self._reply(_ACK_ERR, ack, done - now)
+            return None
+        return done - now
+
+    def _receive_tm_page(self, msg):
+        """
+        Store a received tempo map page
+
+        The last page commits the received pages to the storage.
+
+        :param msg: Transmit tempo map page message
+        :type msg: bytearray
+        """
+        page_id = (msg[8] << 7) | msg[9]
+        ack = [_RESERVED, _TX_TM_PG, msg[8], msg[9]]
+        delay = self._admit_page(ack)
+        if delay is None:
+            return
+
+        raw = SysexMessage.decode_data(msg[12:-1])
+        if page_id != _LAST_PAGE:
+            self._upload[page_id] = raw
+        else:
+            count = len(self._upload)
+            if sorted(self._upload) != list(range(0, count)):
+                logging.warning('Emulated BBS-1 missing tempo map pages')
+                self._reply(_ACK_ERR, ack, delay)
+                return
+            image = bytearray()
+            for page in range(0, count):
+                image += self._upload[page]
+            image += raw
+            self._upload = {}
+            self.storage[:] = bytearray(self.STORAGE_SIZE)
+            self.storage[0:len(image)] = image[0:self.STORAGE_SIZE]
+            logging.debug('Emulated BBS-1 stored ' + str(self.size) + ' bytes of tempo maps')
+        self._reply(_ACK_OK, ack, delay)
+
+    def _prepare_fw_page(self, msg):
+        """
+        Get ready for a firmware page
+
+        :param msg: Prepare for firmware page message
+        :type msg: bytearray
+        """
+        page_id = (msg[8] << 7) | msg[9]
+        data = msg[12:-1]
+        index = (data[0] << 7) | data[1]
+        size = (data[2] << 7) | data[3]
+        checksum = struct.unpack('>I', bytes(codec.decode(data[4:9])))[0]
+        self._fw_prepared[page_id] = (index, size, checksum)
+
+    def _receive_fw_page(self, msg):
+        """
+        Store a received firmware page
+
+        The page must match its preparation.
+        The last page completes the firmware transfer.
+
+        :param msg: Transmit firmware page message
+        :type msg: bytearray
+        """
+        page_id = (msg[8] << 7) | msg[9]
+        ack = [_RESERVED, _TX_FW_PG, msg[8], msg[9]]
+        delay = self._admit_page(ack)
+        if delay is None:
+            return
+
+        prepared = self._fw_prepared.pop(page_id, None)
+        if prepared is None:
+            logging.warning('Emulated BBS-1 received an unprepared firmware page')
+            self._reply(_ACK_ERR, ack, delay)
+            return
+        index, size, checksum = prepared
+        raw = codec.decode(msg[12:-1])[0:size]
+        if len(raw) != size or firmware.checksum(raw) != checksum:
+            logging.warning('Emulated BBS-1 firmware page #' + str(index) + ' checksum mismatch')
+            self._reply(_ACK_ERR, ack, delay)
+            return
+        self._fw_pages[index] = raw
+
+        if page_id == _LAST_PAGE:
+            if sorted(self._fw_pages) != list(range(0, index + 1)):
+                logging.warning('Emulated BBS-1 missing firmware pages')
+                self._reply(_ACK_ERR, ack, delay)
+                return
+            self.firmware = b''.join(bytes(self._fw_pages[page]) for page in range(0, index + 1))
+            self._fw_pages = {}
+            logging.debug('Emulated BBS-1 flashed ' + str(len(self.firmware)) + ' bytes of firmware')
+            self._reply(_ACK_OK, ack, delay)
+            self._reply(_DATA, [_RESERVED, _FW_TX_CMP], delay)
+            return
+        self._reply(_ACK_OK, ack, delay)
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 *-*
+"""BBS1 firmware images"""
+# A tool to communicate with Peterson's BBS-1 metronome
+# Copyright (C) 2012-2015 Raphaël Doursenaud <rdoursenaud@free.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import time
+from array import array
+
+# noinspection PyProtectedMember
+from sysex import SysexMessage, _LAST_PAGE, _PAGE_SIZE
+
+try:
+    # noinspection PyUnresolvedReferences
+    import numpy
+except ImportError:
+    # Only needed to speed up checksums
+    numpy = None
+
+"""
+Flashing journal format
+=======================
+
+::
+bytes 0-7
+    "BBS1FWJ" magic number followed by the format version
+bytes 8-39
+    Image SHA-256 digest
+bytes 40-41
+    [LSB, MSB] image path length
+bytes 42-n
+    Image path (UTF-8)
+records
+    [LSB, MSB] acknowledged page index
+"""
+
+
+def checksum(raw):
+    """
+    Firmware page checksum
+
+    :param raw: Raw page data
+    :type raw: bytes | bytearray
+    :return: Sum of the page bytes (INT32u)
+    :rtype: int
+    """
+    return sum(bytearray(raw)) & 0xffffffff
+
+
+class FirmwareImage(object):
+    """
+    Memory mapped firmware image
+
+    The image is split in pages of one packet.
+    Checksums of all pages are computed up front, pages are only read and encoded when sent.
+    """
+
+    def __init__(self, path):
+        """
+        Map a firmware image file
+
+        :param path: Firmware image path
+        :type path: str
+        :raises IOError: The image could not be read
+        """
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self.size = os.fstat(self._file.fileno()).st_size
+            if self.size == 0:
+                raise IOError("Empty firmware image: " + path)
+            if (self.size + _PAGE_SIZE - 1) // _PAGE_SIZE > _LAST_PAGE:
+                raise IOError("Firmware image too large: " + path)
+            self.data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            self._file.close()
+            raise
+        self.count = (self.size + _PAGE_SIZE - 1) // _PAGE_SIZE
+        self.checksums = self._checksums()
+        self._digest = None
+        logging.debug("Firmware image of " + str(self.size) + " bytes in " + str(self.count) + " pages")
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        """Unmap the image"""
+        self.data.close()
+        self._file.close()
+
+    @property
+    def digest(self):
+        """
+        Image hash
+
+        :return: SHA-256 digest
+        :rtype: bytes
+        """
+        if self._digest is None:
+            self._digest = hashlib.sha256(self.data).digest()
+        return self._digest
+
+    def _checksums(self):
+        """
+        Compute all pages checksums
+
+        :return: Checksum by page index
+        :rtype: array.array
+        """
+        checksums = array('L')
+        full = self.size // _PAGE_SIZE
+        if numpy is not None:
+            pages = numpy.frombuffer(self.data, dtype=numpy.uint8, count=full * _PAGE_SIZE)
+            checksums.extend(int(total) for total in pages.reshape(full, _PAGE_SIZE).sum(axis=1, dtype=numpy.uint32))
+        else:
+            checksums.extend(checksum(self.data[offset:offset + _PAGE_SIZE])
+                             for offset in range(0, full * _PAGE_SIZE, _PAGE_SIZE))
+        if full < self.count:
+            checksums.append(checksum(self.data[full * _PAGE_SIZE:]))
+        return checksums
+
+    def page(self, index):
+        """
+        Read a page
+
+        :param index: Page index
+        :type index: int
+        :return: Raw page data
+        :rtype: bytes
+        """
+        return self.data[index * _PAGE_SIZE:(index + 1) * _PAGE_SIZE]
+
+    def iter_pages(self, start=0):
+        """
+        Stream page messages
+
+        Each page is a prepare for firmware page message followed by the transmit firmware page message.
+        The last page is flagged with the last page ID.
+
+        :param start: First page index
+        :type start: int
+        :return: Generator of (prepare message, transmit message)
+        :rtype: (bytearray, bytearray)
+        """
+        for index in range(start, self.count):
+            page_id = _LAST_PAGE if index == self.count - 1 else index
+            raw = self.page(index)
+            yield (SysexMessage.build_msg_fw_pg(page_id, index, len(raw), self.checksums[index]),
+                   SysexMessage.build_msg_tx_fw_pg(page_id, raw))
+
+
+class FlashJournal(object):
+    """
+    Firmware flashing progress
+
+    Records acknowledged pages so an interrupted transfer can resume where it stopped.
+    The journal is only trusted for the very same image.
+    """
+
+    # Pages acknowledged between writes to the disk are sent again after a crash
+    SYNC_INTERVAL = 0.5  # in seconds
+    MAGIC = b'BBS1FWJ\x01'
+    _RECORD = struct.Struct('<H')
+
+    def __init__(self, path):
+        """
+        Initialize journal
+
+        :param path: Journal file path
+        :type path: str
+        """
+        self.path = path
+        self._file = None
+        self._synced = 0.0
+
+    def pending(self):
+        """
+        Image of an interrupted transfer
+
+        :return: Image path or None when no transfer was interrupted
+        :rtype: str | None
+        """
+        header = self._read()
+        if header is None:
+            return None
+        return header[1]
+
+    def resume(self, image):
+        """
+        Start journaling a transfer
+
+        :param image: Firmware image
+        :type image: FirmwareImage
+        :return: First page to send
+        :rtype: int
+        """
+        acked = set()
+        header = self._read()
+        if header is not None:
+            digest, path, acked = header
+            if digest != image.digest:
+                logging.info("Firmware journal is for another image")
+                acked = set()
+        first = 0
+        while first in acked and first < image.count - 1:
+            first += 1
+        if first:
+            logging.info("Resuming firmware transfer at page #" + str(first))
+
+        # Compact the journal
+        path = image.path.encode('utf-8')
+        self.close()
+        self._file = open(self.path, 'wb')
+        self._file.write(self.MAGIC + image.digest + struct.pack('<H', len(path)) + path)
+        for index in range(0, first):
+            self._file.write(self._RECORD.pack(index))
+        self._sync()
+        return first
+
+    def record(self, index):
+        """
+        Record an acknowledged page
+
+        :param index: Page index
+        :type index: int
+        """
+        self._file.write(self._RECORD.pack(index))
+        if time.time() - self._synced >= self.SYNC_INTERVAL:
+            self._sync()
+
+    def close(self):
+        """Write the journal to the disk and close it"""
+        if self._file is None:
+            return
+        self._sync()
+        self._file.close()
+        self._file = None
+
+    def remove(self):
+        """Forget a completed transfer"""
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def _sync(self):
+        """Write the journal to the disk"""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._synced = time.time()
+
+    def _read(self):
+        """
+        Read the journal
+
+        :return: (image digest, image path, acknowledged pages) or None when there is no valid journal
+        :rtype: (bytes, str, set) | None
+        """
+        try:
+            with open(self.path, 'rb') as journal:
+                data = journal.read()
+        except (IOError, OSError):
+            return None
+        start = len(self.MAGIC) + 32 + 2
+        if len(data) < start or data[0:len(self.MAGIC)] != self.MAGIC:
+            logging.warning("Invalid firmware journal: " + self.path)
+            return None
+        digest = data[len(self.MAGIC):len(self.MAGIC) + 32]
+        length = struct.unpack_from('<H', data, start - 2)[0]
+        path = data[start:start + length].decode('utf-8')
+        records = data[start + length:]
+        # A torn last record is ignored
+        count = len(records) // self._RECORD.size
+        acked = set(struct.unpack_from('<' + str(count) + 'H', records, 0))
+        return digest, path, acked
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 *-*
+"""BBS1 multiple devices handling"""
+# A tool to communicate with Peterson's BBS-1 metronome
+# Copyright (C) 2012-2015 Raphaël Doursenaud <rdoursenaud@free.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+from collections import namedtuple
+
+from communication import Communication
+from device import Bbs1
+from discovery import DeviceDiscovery
+from transport import PygameTransport
+
+Outcome = namedtuple('Outcome', ['device', 'result', 'error'])
+"""Result of a command on one device of a pool"""
+
+
+class DevicePool(object):
+    """
+    Sessions with every connected BBS-1
+
+    Each device gets its own communication channel and reader thread.
+    Commands run concurrently on all devices and a failing device does not affect the others.
+    """
+
+    def __init__(self, timeout=Communication.TIMEOUT, discovery=None):
+        """
+        Initialize an empty pool
+
+        :param timeout: Maximum time to wait for a reply (in seconds)
+        :param discovery: Device discovery service
+        :type timeout: float
+        :type discovery: discovery.DeviceDiscovery
+        """
+        self.timeout = timeout
+        if discovery is None:
+            discovery = DeviceDiscovery()
+        self.discovery = discovery
+        self.devices = []
+
+    def __del__(self):
+        """Delete pool"""
+        self.close()
+
+    def __len__(self):
+        return len(self.devices)
+
+    def open(self, transports=None):
+        """
+        Open a session with each device
+
+        :param transports: Device transports, defaults to every BBS-1 found on pygame MIDI
+        :type transports: transport.Transport[]
+        :return: Number of connected devices
+        :rtype: int
+        """
+        if transports is None:
+            transports = [PygameTransport(dev_in, dev_out)
+                          for dev_in, dev_out in self.discovery.ports()]
+
+        for transport in transports:
+            com = Communication(self.timeout, transport)
+            try:
+                self.devices.append(Bbs1(com))
+            except IOError:
+                logging.warning("Failed to connect to a BBS-1")
+                com.__del__()
+
+        logging.debug("Connected to " + str(len(self.devices)) + " BBS-1")
+        return len(self.devices)
+
+    def close(self):
+        """Close all sessions"""
+        for dev in self.devices:
+            dev.__del__()
+        self.devices = []
+
+    def run(self, command, *args):
+        """
+        Run a device command on all devices concurrently
+
+        :param command: Device command name
+        :param args: Command arguments
+        :type command: str
+        :return: One outcome per device, in pool order
+        :rtype: Outcome[]
+        """
+        outcomes = [None] * len(self.devices)
+
+        def worker(index, dev):
+            try:
+                outcomes[index] = Outcome(dev, getattr(dev, command)(*args), None)
+            except Exception as error:
+                logging.warning("BBS-1 #" + str(index) + " " + command + " failed: " + str(error))
+                outcomes[index] = Outcome(dev, None, error)
+
+        threads = [threading.Thread(target=worker, args=(i, dev), name='BBS1 #' + str(i))
+                   for i, dev in enumerate(self.devices)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return outcomes
+
+    def get_tempomaps(self):
+        """
+        Get tempo maps from all devices
+
+        :rtype: Outcome[]
+        """
+        return self.run('get_tempomaps')
+
+    def clear_tempomaps(self):
+        """
+        Clear all devices tempo maps storage
+
+        :rtype: Outcome[]
+        """
+        return self.run('clear_tempomaps')
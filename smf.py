@@ -0,0 +1,390 @@
+# -*- coding: utf-8 *-*
+"""BBS1 tempo maps Standard MIDI Files conversion"""
+# A tool to communicate with Peterson's BBS-1 metronome
+# Copyright (C) 2012-2015 Raphaël Doursenaud <rdoursenaud@free.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import struct
+
+import tempo
+
+"""
+Conversion
+==========
+
+Each map is a track of meta events only:
+a track name, then time signature and set tempo events where they change, then the end of track.
+
+The BBS-1 tempo counts beats of the bar beat value, SMF tempos are in microseconds per quarter note.
+A held bar (0 repeats) is written once and ends the track:
+like on the BBS-1, the following bars are never reached and are not written.
+Looping and count-in are not stored.
+
+Reading only looks at the conductor track of format 0 and 1 files: other tracks are skipped without parsing.
+Format 2 files hold one map per track. Tempo changes inside a bar apply from the next bar.
+The BBS-1 has no partial bars: a bar cut by a time signature change or by the end of the track is played whole,
+so the map lasts longer than the SMF. Tempos the BBS-1 can not store are rejected.
+"""
+
+# Ticks per quarter note
+DIVISION = 480
+
+_HEADER = struct.Struct('>4sIHHH')
+_CHUNK = struct.Struct('>4sI')
+
+# Meta events
+_META = 0xff
+_TRACK_NAME = 0x03
+_END_OF_TRACK = 0x2f
+_SET_TEMPO = 0x51
+_TIME_SIGNATURE = 0x58
+
+# Default SMF tempo and time signature
+_DEFAULT_TEMPO = 500000  # in microseconds per quarter note
+_DEFAULT_SIGNATURE = (4, 2)  # beats per bar, log2(beat value)
+
+# Microseconds per quarter note at 1 BBS-1 beat of value 1 per minute * 100
+_TEMPO_SCALE = 60 * 1000000 * 100 // 4
+
+# Data bytes count of channel messages by status high nibble
+_DATA_BYTES = {0x80: 2, 0x90: 2, 0xa0: 2, 0xb0: 2, 0xc0: 1, 0xd0: 1, 0xe0: 2}
+
+
+def _vlq(value):
+    """
+    Variable length quantity
+
+    :type value: int
+    :rtype: bytearray
+    """
+    data = bytearray([value & 0x7f])
+    value >>= 7
+    while value:
+        data.insert(0, 0x80 | (value & 0x7f))
+        value >>= 7
+    return data
+
+
+def _read_vlq(data, index):
+    """
+    Read a variable length quantity
+
+    :param data: SMF data
+    :param index: Quantity offset
+    :type data: bytearray
+    :type index: int
+    :return: (value, next offset)
+    :rtype: (int, int)
+    """
+    value = 0
+    while True:
+        byte = data[index]
+        index += 1
+        value = (value << 7) | (byte & 0x7f)
+        if byte < 0x80:
+            return value, index
+
+
+class SmfWriter(object):
+    """
+    Streaming Standard MIDI File writer
+
+    Events are written to the stream as they come.
+    Chunk lengths are written when the track ends, by seeking back: the stream must be seekable.
+    """
+
+    def __init__(self, stream, smf_format=1, division=DIVISION):
+        """
+        Start a file
+
+        :param stream: Writable and seekable binary stream
+        :param smf_format: SMF format (0, 1 or 2)
+        :param division: Ticks per quarter note
+        :type stream: file
+        :type smf_format: int
+        :type division: int
+        """
+        self.stream = stream
+        self.division = division
+        self.tracks = 0
+        self._start = stream.tell()
+        self._track = None  # Track data offset
+        self._format = smf_format
+        stream.write(_HEADER.pack(b'MThd', 6, smf_format, 0, division))
+
+    def begin_track(self):
+        """Start a track"""
+        self.stream.write(_CHUNK.pack(b'MTrk', 0))
+        self._track = self.stream.tell()
+
+    def meta(self, delta, meta_type, data=b''):
+        """
+        Write a meta event
+
+        :param delta: Ticks since the previous event
+        :param meta_type: Meta event type
+        :param data: Meta event data
+        :type delta: int
+        :type meta_type: int
+        :type data: bytes | bytearray
+        """
+        self.stream.write(_vlq(delta) + bytearray([_META, meta_type]) + _vlq(len(data)) + bytes(data))
+
+    def end_track(self, delta=0):
+        """
+        End the current track
+
+        :param delta: Ticks since the previous event
+        :type delta: int
+        """
+        self.meta(delta, _END_OF_TRACK)
+        end = self.stream.tell()
+        self.stream.seek(self._track - 4)
+        self.stream.write(struct.pack('>I', end - self._track))
+        self.stream.seek(end)
+        self._track = None
+        self.tracks += 1
+
+    def close(self):
+        """Finish the file"""
+        end = self.stream.tell()
+        self.stream.seek(self._start)
+        self.stream.write(_HEADER.pack(b'MThd', 6, self._format, self.tracks, self.division))
+        self.stream.seek(end)
+
+
+def write_map(writer, tempomap):
+    """
+    Write a tempo map as a track
+
+    :param writer: SMF writer
+    :param tempomap: Tempo map
+    :type writer: SmfWriter
+    :type tempomap: tempo.Map
+    :raises TypeError: A tempo does not fit the SMF format
+    """
+    writer.begin_track()
+    writer.meta(0, _TRACK_NAME, tempomap.name.rstrip('\x00').encode('latin-1', 'replace'))
+    signature = None
+    smf_tempo = None
+    delta = 0
+    raw = tempomap.bars.tobytes()
+    values = struct.unpack('<' + str(len(raw) // 4) + 'I', raw)
+    for index, value in enumerate(values):
+        beats = (value >> 4 & 0x0f) or 16
+        log2 = value & 0x0f
+        repeats = value >> 8 & 0xff
+        bar_tempo = value >> 16
+        if value & 0xff != signature:
+            signature = value & 0xff
+            writer.meta(delta, _TIME_SIGNATURE, bytearray([beats, log2, 96 >> log2 or 1, 8]))
+            delta = 0
+        if not bar_tempo:
+            raise TypeError("Null tempo")
+        bar_tempo = ((_TEMPO_SCALE << log2) + bar_tempo // 2) // bar_tempo
+        if bar_tempo > 0xffffff:
+            raise TypeError("Tempo out of the SMF range")
+        if bar_tempo != smf_tempo:
+            smf_tempo = bar_tempo
+            writer.meta(delta, _SET_TEMPO, struct.pack('>I', bar_tempo)[1:])
+            delta = 0
+        ticks = beats * writer.division * 4 >> log2
+        if not repeats:
+            # Held bar
+            delta += ticks
+            if index < len(values) - 1:
+                logging.warning("Not writing " + str(len(values) - index - 1) + " bars never reached after a held bar")
+            break
+        delta += ticks * repeats
+    writer.end_track(delta)
+
+
+def save(path, tempomaps):
+    """
+    Save tempo maps to a Standard MIDI File
+
+    A single map is saved as a format 0 file, several maps as a format 2 file.
+
+    :param path: File path
+    :param tempomaps: Tempo maps
+    :type path: str
+    :type tempomaps: list[tempo.Map]
+    :raises TypeError: A tempo does not fit the SMF format
+    """
+    with open(path, 'wb') as stream:
+        writer = SmfWriter(stream, 0 if len(tempomaps) == 1 else 2)
+        for tempomap in tempomaps:
+            write_map(writer, tempomap)
+        writer.close()
+
+
+def _read_track(data, index, end):
+    """
+    Extract the tempo events of a track
+
+    :param data: SMF data
+    :param index: Track data offset
+    :param end: Track data end
+    :type data: bytearray
+    :type index: int
+    :type end: int
+    :return: (name, [(tick, meta type, meta data)], end tick)
+    :rtype: (str, list, int)
+    """
+    name = None
+    events = []
+    tick = 0
+    status = 0
+    while index < end:
+        delta, index = _read_vlq(data, index)
+        tick += delta
+        byte = data[index]
+        if byte == _META:
+            meta_type = data[index + 1]
+            length, index = _read_vlq(data, index + 2)
+            if meta_type == _SET_TEMPO or meta_type == _TIME_SIGNATURE:
+                events.append((tick, meta_type, data[index:index + length]))
+            elif meta_type == _TRACK_NAME and name is None:
+                name = data[index:index + length].decode('latin-1')
+            elif meta_type == _END_OF_TRACK:
+                break
+            index += length
+        elif byte == 0xf0 or byte == 0xf7:
+            # SysEx
+            length, index = _read_vlq(data, index + 1)
+            index += length
+            status = 0
+        else:
+            if byte & 0x80:
+                status = byte
+                index += 1
+            elif not status:
+                raise TypeError("Invalid SMF track data")
+            # Running status
+            index += _DATA_BYTES.get(status & 0xf0, 0)
+    return name or '', events, tick
+
+
+def _build_map(name, events, end, division):
+    """
+    Build a tempo map from tempo events
+
+    :param name: Track name
+    :param events: (tick, meta type, meta data) in time order
+    :param end: Track end tick
+    :param division: Ticks per quarter note
+    :type name: str
+    :type events: list
+    :type end: int
+    :type division: int
+    :rtype: tempo.Map
+    :raises TypeError: A time signature or a tempo does not fit the BBS-1 or the time division
+    """
+    beats, log2 = _DEFAULT_SIGNATURE
+    smf_tempo = _DEFAULT_TEMPO
+    records = []  # [signature, repeats, tempo]
+    bar_start = 0  # Next bar tick
+    if events:
+        # At least one bar after the last change
+        end = max(end, events[-1][0] + 1)
+
+    position = 0
+    while position < len(events) or bar_start < end:
+        tick = events[position][0] if position < len(events) else end
+
+        # Bars starting before the next change
+        ticks = beats * division * 4 >> log2
+        if not ticks:
+            raise TypeError("Time signature " + str(beats) + "/" + str(1 << log2) + " bars are shorter than a tick")
+        count = (tick - bar_start + ticks - 1) // ticks
+        if count > 0:
+            bar_start += count * ticks
+            bar_tempo = (_TEMPO_SCALE * (1 << log2) + smf_tempo // 2) // smf_tempo
+            if bar_tempo > 0xffff:
+                raise TypeError("Tempo out of the BBS-1 range")
+            signature = ((beats & 0x0f) << 4) | log2
+            if records and records[-1][0] == signature and records[-1][2] == bar_tempo:
+                count += records.pop()[1]
+            while count:
+                repeats = min(count, 255)
+                records.append((signature, repeats, bar_tempo))
+                count -= repeats
+
+        # Changes
+        while position < len(events) and events[position][0] == tick:
+            meta_type, meta = events[position][1:]
+            if meta_type == _TIME_SIGNATURE and len(meta) >= 2:
+                beats, log2 = meta[0], meta[1]
+                if not 1 <= beats <= 16 or log2 > 15:
+                    raise TypeError("Unsupported time signature " + str(beats) + "/" + str(1 << log2))
+                # Time signatures start a bar
+                if bar_start != tick:
+                    logging.warning("Bar cut by a time signature change at tick " + str(tick) + " played whole")
+                bar_start = tick
+            elif meta_type == _SET_TEMPO and len(meta) >= 3:
+                smf_tempo = (meta[0] << 16) | (meta[1] << 8) | meta[2] or _DEFAULT_TEMPO
+            position += 1
+
+    raw = b''.join(struct.pack('<BBH', *record) for record in records)
+    tempomap = tempo.Map(tempo.Bars.frombytes(raw))
+    tempomap.set_name(name[0:16])
+    return tempomap
+
+
+def load(path):
+    """
+    Load tempo maps from a Standard MIDI File
+
+    :param path: File path
+    :type path: str
+    :return: One map for format 0 and 1 files, one map per track for format 2 files
+    :rtype: list[tempo.Map]
+    :raises TypeError: Not a supported SMF
+    """
+    with open(path, 'rb') as stream:
+        header = stream.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            raise TypeError("Not a SMF")
+        magic, length, smf_format, tracks, division = _HEADER.unpack(header)
+        if magic != b'MThd' or length < 6:
+            raise TypeError("Not a SMF")
+        if division & 0x8000:
+            raise TypeError("SMPTE time division is not supported")
+        stream.seek(8 + length)
+
+        tempomaps = []
+        for track in range(0, tracks):
+            chunk = stream.read(_CHUNK.size)
+            if len(chunk) < _CHUNK.size:
+                logging.warning("Truncated SMF")
+                break
+            magic, length = _CHUNK.unpack(chunk)
+            if magic != b'MTrk':
+                # Unknown chunk
+                stream.seek(length, 1)
+                continue
+            data = bytearray(stream.read(length))
+            if len(data) < length:
+                raise TypeError("Truncated SMF track")
+            try:
+                name, events, end = _read_track(data, 0, len(data))
+            except IndexError:
+                raise TypeError("Truncated SMF track")
+            tempomaps.append(_build_map(name, events, end, division))
+            if smf_format != 2:
+                # Tempo events are in the conductor track
+                break
+        return tempomaps
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 *-*
+"""BBS1 tempo maps storage files"""
+# A tool to communicate with Peterson's BBS-1 metronome
+# Copyright (C) 2012-2015 Raphaël Doursenaud <rdoursenaud@free.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import mmap
+import os
+import struct
+
+from sysex import SysexMessage, TM_HEADER, TM_ENTRY, TM_ENTRY_V2, TM_BAR
+import tempo
+
+"""
+Storage file format
+===================
+
+Files hold the raw tempo maps storage data of the device, unencoded:
+header, map entries then bars records.
+See SysexMessage.parse_tempo_maps_pages() for the format.
+"""
+
+# Storage file extension
+EXTENSION = '.bbs'
+
+
+def save(path, tempofile):
+    """
+    Save a tempo file
+
+    Records are written as they are serialized.
+
+    :param path: File path
+    :param tempofile: Tempo file
+    :type path: str
+    :type tempofile: tempo.File
+    :raises IOError: The file could not be written
+    :raises TypeError: Tempo maps too large
+    """
+    # Checked before truncating an existing file
+    SysexMessage.check_tempo_maps_size(tempofile)
+    with open(path, 'wb') as stream:
+        for record in SysexMessage.iter_tempo_maps_records(tempofile):
+            stream.write(record)
+
+
+def load(path):
+    """
+    Load a tempo file
+
+    :param path: File path
+    :type path: str
+    :rtype: tempo.File
+    :raises IOError: The file could not be read
+    :raises TypeError: Not tempo maps data
+    """
+    storage = StorageFile(path)
+    try:
+        return storage.tempofile()
+    finally:
+        storage.close()
+
+
+class StorageFile(object):
+    """
+    Memory mapped tempo maps storage file
+
+    Only the header is decoded when opening.
+    Map entries and bars are decoded from the mapping when accessed,
+    so listing map names only reads the start of the file.
+    """
+
+    def __init__(self, path):
+        """
+        Map a storage file
+
+        :param path: Storage file path
+        :type path: str
+        :raises IOError: The file could not be read
+        :raises TypeError: Not tempo maps data
+        """
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            size = os.fstat(self._file.fileno()).st_size
+            if size < TM_HEADER.size:
+                raise TypeError("Not tempo maps data: " + path)
+            self.data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, TypeError, ValueError):
+            self._file.close()
+            raise
+        try:
+            self._header = tempo.File()
+            SysexMessage.parse_file_header(self.data, self._header)
+            self._entry = TM_ENTRY_V2 if self._header.version == 2 else TM_ENTRY
+            self.maps_count = self._header.entries_count
+            if not 0 <= self.maps_count <= 9 or TM_HEADER.size + self.maps_count * self._entry.size > size:
+                raise TypeError("Invalid tempo maps entries")
+        except TypeError:
+            self.close()
+            raise
+        self._maps = [None] * self.maps_count
+        logging.debug("Storage file of " + str(self.maps_count) + " tempo maps")
+
+    def __len__(self):
+        return self.maps_count
+
+    @property
+    def version(self):
+        """
+        Tempo maps structure version
+
+        :rtype: int
+        """
+        return self._header.version
+
+    def close(self):
+        """Unmap the file"""
+        self.data.close()
+        self._file.close()
+
+    def _entry_offset(self, index):
+        """
+        Map entry offset
+
+        :param index: Map index
+        :type index: int
+        :rtype: int
+        :raises IndexError: No such map
+        """
+        if not 0 <= index < self.maps_count:
+            raise IndexError("No tempo map #" + str(index))
+        return TM_HEADER.size + index * self._entry.size
+
+    def name(self, index):
+        """
+        Read a map name
+
+        Only the map entry is read.
+
+        :param index: Map index
+        :type index: int
+        :rtype: str
+        :raises IndexError: No such map
+        """
+        return self._entry.unpack_from(self.data, self._entry_offset(index))[2].decode('latin-1')
+
+    @property
+    def names(self):
+        """
+        Read all maps names
+
+        :rtype: list[str]
+        """
+        return [self.name(i) for i in range(0, self.maps_count)]
+
+    def map(self, index):
+        """
+        Decode a map
+
+        Bars follow all entries, in maps order.
+        Decoded maps are kept: the same map is returned until the file is closed.
+
+        :param index: Map index
+        :type index: int
+        :rtype: tempo.Map
+        :raises IndexError: No such map
+        :raises TypeError: Truncated tempo maps data
+        """
+        offset = self._entry_offset(index)
+        if self._maps[index] is None:
+            tempomap = SysexMessage.parse_map(self.data, offset, self._header)[1]
+            # Preceding maps lengths only
+            start = TM_HEADER.size + self.maps_count * self._entry.size
+            for i in range(0, index):
+                length = struct.unpack_from('<H', self.data, self._entry_offset(i) + 2)[0]
+                start += length // TM_BAR.size * TM_BAR.size
+            end = start + tempomap.length // TM_BAR.size * TM_BAR.size
+            if end > len(self.data):
+                raise TypeError("Truncated tempo maps data")
+            # Bars are kept in the storage format
+            tempomap.bars = tempo.Bars.frombytes(self.data[start:end])
+            self._maps[index] = tempomap
+        return self._maps[index]
+
+    def tempofile(self):
+        """
+        Decode all maps
+
+        :rtype: tempo.File
+        :raises TypeError: Truncated tempo maps data
+        """
+        tempofile = tempo.File([self.map(i) for i in range(0, self.maps_count)])
+        tempofile.set_version(self.version)
+        tempofile.size = self._header.size
+        return tempofile
@@ -17,9 +17,12 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+import struct
 from binascii import hexlify
 
+import codec
 import tempo
+import tracing
 
 """
 BBS1 SysEx protocol
@@ -67,6 +70,8 @@ for each page till complete:
 ##
 _SYX_START = 0xf0
 _SYX_END = 0xf7
+# Shortest message: start, manufacturer, device, command, reserved and end bytes
+_MIN_SIZE = 8
 
 ##
 # IDs
@@ -137,139 +142,482 @@ _DEL_TM = 0x24
 _VKEY = 0x40
 _VENC = 0x41
 
+##
+# Packets
+##
+_PAGE_SIZE = 28  # Raw data bytes per packet (7 words)
+_LAST_PAGE = 0x3fff  # Last packet ID
 
-class SysexMessage(object):
-    """BBS1 System exclusive message"""
+##
+# Exchanges
+##
+# Reply payload command by request payload command
+_REPLIES = {
+    _REQ_CON: _ACK_CON,
+    _REQ_MODE: _ANS_MODE,
+    _REQ_HW_VERS: _ANS_HW_VERS,
+    _REQ_FW_VERS: _ANS_FW_VERS,
+    _REQ_TM: _RESERVED,  # Tempo maps informations (seem to always be zeros)
+    _TX_TM_PG: _TX_TM_PG,
+    _TX_FW_PG: _TX_FW_PG,
+}
+# Requests that can safely be sent again
+_IDEMPOTENT = (_REQ_CON, _REQ_MODE, _REQ_HW_VERS, _REQ_FW_VERS)
 
-    @staticmethod
-    def _build_msg_preamble():
-        """
-        Build BBS1 SysEx message preamble
-        """
-        return [_SYX_START, _MAN_ID1, _MAN_ID2, _MAN_ID3, _DEV_ID]
+##
+# Precompiled messages
+##
+if bytes is str:
+    # We must be running Python 2, bytes items are not integers
+    def _template(items):
+        return bytes(bytearray(items))
 
-    @staticmethod
-    def _build_msg_send_command():
-        """
-        Start send command message
+    _octets = bytearray
+else:
+    _template = bytes
 
-        Note: this seem to never work
-        """
-        message = SysexMessage._build_msg_preamble()
-        message.append(_CMD)
-        message.append(_RESERVED)
+    def _octets(message):
         return message
 
-    @staticmethod
-    def _build_msg_send_data():
-        """
-        Start send data message
-        """
-        message = SysexMessage._build_msg_preamble()
-        message.append(_DATA)
-        message.append(_RESERVED)
-        return message
+_PREAMBLE = [_SYX_START, _MAN_ID1, _MAN_ID2, _MAN_ID3, _DEV_ID]
+# Send command does not work, requests are sent as data
+_MSG_ACK_OK = _template(_PREAMBLE + [_ACK_OK, _RESERVED, _SYX_END])
+_MSG_DEL_TM = _template(_PREAMBLE + [_DATA, _RESERVED, _DEL_TM, _SYX_END])
+_MSG_REQ_CON = _template(_PREAMBLE + [_DATA, _RESERVED, _REQ_CON, _SYX_END])
+_MSG_REQ_MODE = _template(_PREAMBLE + [_DATA, _RESERVED, _REQ_MODE, _SYX_END])
+_MSG_REQ_HW_VERS = _template(_PREAMBLE + [_DATA, _RESERVED, _REQ_HW_VERS, _SYX_END])
+_MSG_REQ_FW_VERS = _template(_PREAMBLE + [_DATA, _RESERVED, _REQ_FW_VERS, _SYX_END])
+_MSG_REQ_TM = _template(_PREAMBLE + [_DATA, _RESERVED, _REQ_TM, _SYX_END])
+# Page messages header up to the packet ID
+_MSG_TX_TM_PG = _template(_PREAMBLE + [_DATA, 0, _TX_TM_PG])
+_MSG_FW_PG = _template(_PREAMBLE + [_DATA, 0, _FW_PG])
+_MSG_TX_FW_PG = _template(_PREAMBLE + [_DATA, 0, _TX_FW_PG])
 
-    @staticmethod
-    def _build_msg_send_ack_ok():
-        """
-        Start send acknowlege OK
-        """
-        message = SysexMessage._build_msg_preamble()
-        message.append(_ACK_OK)
-        message.append(_RESERVED)
-        return message
+##
+# Tempo maps storage records (see parse_tempo_maps_pages()), also used by storage files
+##
+TM_HEADER = struct.Struct('<3sBHBx')
+TM_ENTRY = struct.Struct('<HH16s')
+TM_ENTRY_V2 = struct.Struct('<HH16sB3x')
+TM_BAR = struct.Struct('<BBH')
+# Device tempo maps storage size (in bytes)
+STORAGE_SIZE = 36864
 
-    @staticmethod
-    def _build_msg_send_ack_err():
+
+# Search needles, Python 2 can't search bytes for an int
+_FRAME_START = bytearray([_SYX_START])
+_FRAME_END = bytearray([_SYX_END])
+
+
+class SysexFramer(object):
+    """
+    Streaming SysEx frame reassembly
+
+    Raw MIDI input bytes are fed as they are read.
+    Frames may be split across several reads and a single read may hold several frames.
+    Bytes found outside of a frame are discarded.
+    """
+
+    # Longest frame we accept. Anything longer is garbage.
+    MAX_FRAME = 256
+
+    def __init__(self):
+        self._frame = None  # Incomplete frame or None when outside of a frame
+
+    def reset(self):
+        """Drop any incomplete frame"""
+        self._frame = None
+
+    def feed(self, data):
         """
-        Start send acknowlege error
+        Feed raw input data
+
+        :param data: Raw MIDI bytes
+        :type data: bytearray
+        :return: Complete frames, from start to end byte included
+        :rtype: bytearray[]
         """
-        message = SysexMessage._build_msg_preamble()
-        message.append(_ACK_ERR)
-        message.append(_RESERVED)
-        return message
+        frames = []
+        index = 0
+        length = len(data)
+        while index < length:
+            scan = index
+            if self._frame is None:
+                # Look for the next frame start, skipping garbage
+                start = data.find(_FRAME_START, index)
+                if start < 0:
+                    break
+                self._frame = bytearray()
+                index = start
+                scan = start + 1
+            end = data.find(_FRAME_END, index)
+            stop = length if end < 0 else end + 1
+            # A new start byte before the end aborts the current frame
+            restart = data.rfind(_FRAME_START, scan, stop)
+            if restart >= 0:
+                logging.warning("Incomplete SysEx frame dropped")
+                self._frame = bytearray()
+                index = restart
+            self._frame += data[index:stop]
+            if len(self._frame) > self.MAX_FRAME:
+                logging.warning("Oversized SysEx frame dropped")
+                self._frame = None
+            elif end >= 0:
+                frames.append(self._frame)
+                self._frame = None
+            index = stop
+        return frames
+
+
+class SysexMessage(object):
+    """BBS1 System exclusive message"""
 
     @staticmethod
     def build_msg_ack_ok():
         """
-        Build a request tempo maps message
+        Build an acknowledge OK message
+
+        BBS1 happily sends data whatever the message type.
+
+        :rtype: bytes
         """
-        message = SysexMessage._build_msg_send_ack_ok()  # BBS1 happily sends data whatever the message type
-        message.append(_SYX_END)
-        return message
+        return _MSG_ACK_OK
 
     @staticmethod
     def build_msg_del_tm():
         """
         Build a delete tempo maps message
+
+        :rtype: bytes
         """
-        # Send command does not work
-        message = SysexMessage._build_msg_send_data()
-        message.append(_DEL_TM)
-        message.append(_SYX_END)
-        return message
+        return _MSG_DEL_TM
 
     @staticmethod
     def build_msg_req_con():
         """
         Build a request connection status message
+
+        :rtype: bytes
         """
-        # Send command does not work
-        message = SysexMessage._build_msg_send_data()
-        message.append(_REQ_CON)
         # Unused 4 padding bytes ignored
-        message.append(_SYX_END)
-        return message
+        return _MSG_REQ_CON
 
     @staticmethod
     def build_msg_req_mode():
         """
         Build a request mode status message
+
+        :rtype: bytes
         """
-        # Send command does not work
-        message = SysexMessage._build_msg_send_data()
-        message.append(_REQ_MODE)
         # Unused 4 padding bytes ignored
-        message.append(_SYX_END)
-        return message
+        return _MSG_REQ_MODE
 
     @staticmethod
     def build_msg_req_hw_vers():
         """
         Build a request hardware version message
+
+        :rtype: bytes
         """
-        # Send command does not work
-        message = SysexMessage._build_msg_send_data()
-        message.append(_REQ_HW_VERS)
         # Unused 4 padding bytes ignored
-        message.append(_SYX_END)
-        return message
+        return _MSG_REQ_HW_VERS
 
     @staticmethod
     def build_msg_req_fw_vers():
         """
         Build a request firmware version message
+
+        :rtype: bytes
         """
-        # Send command does not work
-        message = SysexMessage._build_msg_send_data()
-        message.append(_REQ_FW_VERS)
         # Unused 4 padding bytes ignored
-        message.append(_SYX_END)
-        return message
+        return _MSG_REQ_FW_VERS
 
     @staticmethod
     def build_msg_req_tm():
         """
         Build a request tempo maps informations message
+
+        :rtype: bytes
         """
-        # Send command does not work
-        message = SysexMessage._build_msg_send_data()
-        message.append(_REQ_TM)
         # Unused 4 padding bytes ignored
-        message.append(_SYX_END)
+        return _MSG_REQ_TM
+
+    @staticmethod
+    def build_msg_tx_tm_pg(page_id, raw):
+        """
+        Build a transmit tempo map page message
+
+        :param page_id: Page ID (0x3FFF for the last page)
+        :param raw: Raw page data (up to 28 bytes)
+        :type page_id: int
+        :type raw: bytearray
+        :rtype: bytearray
+        """
+        return SysexMessage._build_msg_packet(_MSG_TX_TM_PG, page_id, SysexMessage.encode_data(raw))
+
+    @staticmethod
+    def build_msg_fw_pg(page_id, index, size, checksum):
+        """
+        Build a prepare for firmware page message
+
+        :param page_id: Packet ID (0x3FFF for the last page)
+        :param index: Page index
+        :param size: Page size (in bytes)
+        :param checksum: Page checksum
+        :type page_id: int
+        :type index: int
+        :type size: int
+        :type checksum: int
+        :rtype: bytearray
+        """
+        # [INT16u page id] [INT16u totalbytes] [INT32u checksum]
+        data = bytearray([index >> 7, index & 0x7f, size >> 7, size & 0x7f])
+        data += codec.encode(struct.pack('>I', checksum))
+        return SysexMessage._build_msg_packet(_MSG_FW_PG, page_id, data)
+
+    @staticmethod
+    def build_msg_tx_fw_pg(page_id, raw):
+        """
+        Build a transmit firmware page message
+
+        :param page_id: Page ID (0x3FFF for the last page)
+        :param raw: Raw page data (up to 28 bytes)
+        :type page_id: int
+        :type raw: bytearray
+        :rtype: bytearray
+        """
+        return SysexMessage._build_msg_packet(_MSG_TX_FW_PG, page_id, SysexMessage.encode_data(raw))
+
+    @staticmethod
+    def _build_msg_packet(header, page_id, encoded):
+        """
+        Build a packet message
+
+        Pages are kept until acknowledged: each message gets its own buffer.
+
+        :param header: Precompiled message header up to the packet ID
+        :param page_id: Packet ID
+        :param encoded: Encoded packet data
+        :type header: bytes
+        :type page_id: int
+        :type encoded: bytearray
+        :rtype: bytearray
+        """
+        message = bytearray(len(header) + 4 + len(encoded) + 1)
+        message[0:len(header)] = header
+        index = len(header)
+        message[6] = len(encoded)
+        message[index] = page_id >> 7
+        message[index + 1] = page_id & 0x7f
+        message[index + 2] = _RESERVED
+        message[index + 3] = _RESERVED
+        message[index + 4:-1] = encoded
+        message[-1] = _SYX_END
         return message
 
+    @staticmethod
+    def iter_tempo_maps_pages(tempofile):
+        """
+        Stream transmit tempo map page messages
+
+        Pages are encoded one at a time as the storage records are serialized,
+        the whole raw storage data is never built.
+        The last page is flagged with the last page ID.
+
+        :param tempofile: Tempo file
+        :type tempofile: tempo.File
+        :return: Generator of messages
+        :rtype: bytearray
+        :raises TypeError: Tempo maps too large
+        """
+        count = SysexMessage.tempo_maps_pages_count(tempofile)
+        page_id = 0
+        raw = bytearray()
+        for record in SysexMessage.iter_tempo_maps_records(tempofile):
+            raw += record
+            while len(raw) >= _PAGE_SIZE and page_id < count - 1:
+                yield SysexMessage.build_msg_tx_tm_pg(page_id, raw[0:_PAGE_SIZE])
+                del raw[0:_PAGE_SIZE]
+                page_id += 1
+        yield SysexMessage.build_msg_tx_tm_pg(_LAST_PAGE, raw)
+
+    @staticmethod
+    def tempo_maps_size(tempofile):
+        """
+        Tempo maps raw storage data size
+
+        :param tempofile: Tempo file
+        :type tempofile: tempo.File
+        :return: Size (in bytes)
+        :rtype: int
+        """
+        entry = TM_ENTRY_V2 if tempofile.version == 2 else TM_ENTRY
+        bars = sum(len(tempomap.bars) for tempomap in tempofile.maps)
+        return TM_HEADER.size + len(tempofile.maps) * entry.size + bars * TM_BAR.size
+
+    @staticmethod
+    def check_tempo_maps_size(tempofile):
+        """
+        Check that tempo maps fit in the device storage
+
+        The device silently truncates larger data.
+
+        :param tempofile: Tempo file
+        :type tempofile: tempo.File
+        :return: Size (in bytes)
+        :rtype: int
+        :raises TypeError: Tempo maps too large
+        """
+        size = SysexMessage.tempo_maps_size(tempofile)
+        if size > STORAGE_SIZE:
+            raise TypeError("Tempo maps too large: " + str(size) + " bytes, the device stores " +
+                            str(STORAGE_SIZE))
+        return size
+
+    @staticmethod
+    def tempo_maps_pages_count(tempofile):
+        """
+        Number of pages needed to transmit tempo maps
+
+        :param tempofile: Tempo file
+        :type tempofile: tempo.File
+        :rtype: int
+        """
+        return (SysexMessage.tempo_maps_size(tempofile) + _PAGE_SIZE - 1) // _PAGE_SIZE
+
+    @staticmethod
+    def iter_tempo_maps_records(tempofile):
+        """
+        Serialize tempo maps storage records in order
+
+        :param tempofile: Tempo file
+        :type tempofile: tempo.File
+        :return: Generator of header, entries then bars records
+        :rtype: bytes
+        :raises TypeError: Tempo maps too large
+        """
+        size = SysexMessage.check_tempo_maps_size(tempofile)
+        yield TM_HEADER.pack(bytes(bytearray(tempofile.MAGIC)), tempofile.version, size, len(tempofile.maps))
+
+        # Bars are stored after all entries
+        entry = TM_ENTRY_V2 if tempofile.version == 2 else TM_ENTRY
+        offset = TM_HEADER.size + len(tempofile.maps) * entry.size
+        for tempomap in tempofile.maps:
+            length = len(tempomap.bars) * TM_BAR.size
+            name = tempomap.name.encode('latin-1', 'replace')[0:16]
+            if tempofile.version == 2:
+                flags = (0x80 if tempomap.looping else 0x00) | tempomap.count_in
+                yield TM_ENTRY_V2.pack(offset, length, name, flags)
+            else:
+                yield TM_ENTRY.pack(offset, length, name)
+            offset += length
+
+        # Bars are kept in the storage format
+        for tempomap in tempofile.maps:
+            yield tempomap.bars.tobytes()
+
+    @staticmethod
+    def encode_data(raw):
+        """
+        Pack raw bytes in 7 bits words
+
+        :param raw: Raw bytes
+        :type raw: bytearray
+        :return: Words of 1 top bits byte followed by 4 bytes
+        :rtype: bytearray
+        """
+        return codec.encode(raw)
+
+    @staticmethod
+    def decode_data(encoded):
+        """
+        Unpack 7 bits words
+
+        :param encoded: Words of 1 top bits byte followed by 4 bytes
+        :type encoded: bytearray
+        :return: Raw bytes
+        :rtype: bytearray
+        """
+        return codec.decode(encoded)
+
+    @staticmethod
+    def command(message):
+        """
+        Get a message payload command
+
+        :param message: Raw message
+        :type message: list | bytearray
+        :return: Payload command or None when the message has no payload
+        :rtype: int | None
+        """
+        if len(message) > 8:
+            return message[7]
+        return None
+
+    @staticmethod
+    def packet_id(message):
+        """
+        Get a message packet ID
+
+        :param message: Raw message
+        :type message: list | bytes | bytearray
+        :return: Packet ID or None when the message has no packet ID
+        :rtype: int | None
+        """
+        if len(message) > 10:
+            message = _octets(message)
+            return (message[8] << 7) | message[9]
+        return None
+
+    @staticmethod
+    def reply_command(message):
+        """
+        Get the payload command of the expected reply to a message
+
+        :param message: Raw request message
+        :type message: list | bytes | bytearray
+        :return: Reply payload command or None when unknown
+        :rtype: int | None
+        """
+        message = _octets(message)
+        if message[5] == _ACK_OK:
+            # Acknowledging tempo maps informations starts the pages transfer
+            return _TM_PG
+        return _REPLIES.get(SysexMessage.command(message))
+
+    @staticmethod
+    def is_idempotent(message):
+        """
+        Check if a message can safely be sent again
+
+        :param message: Raw request message
+        :type message: list | bytes | bytearray
+        :rtype: bool
+        """
+        message = _octets(message)
+        return message[5] == _DATA and SysexMessage.command(message) in _IDEMPOTENT
+
+    @staticmethod
+    def is_reply(message, command, packet_id=None):
+        """
+        Check if a message is the expected reply
+
+        :param message: Raw message
+        :param command: Expected payload command, None matches any
+        :param packet_id: Expected packet ID, None matches any
+        :type message: bytearray
+        :type command: int | None
+        :type packet_id: int | None
+        :rtype: bool
+        """
+        if command is not None and SysexMessage.command(message) != command:
+            return False
+        if packet_id is not None:
+            message_id = SysexMessage.packet_id(message)
+            if message_id is not None and message_id != packet_id:
+                return False
+        return True
+
     @staticmethod
     def parse(message):
         """
@@ -279,8 +627,13 @@ class SysexMessage(object):
         :type message: list
         :return: 'command', payload
         :rtype: str, mixed
+        :raises TypeError: Truncated, oversized or invalid message
         """
-        logging.debug(hexlify(bytearray(message)))
+        # Cheap checks first: garbage is rejected before scanning it
+        if len(message) < _MIN_SIZE:
+            raise TypeError("Truncated SysEx message")
+        if len(message) > SysexFramer.MAX_FRAME:
+            raise TypeError("Oversized SysEx message")
 
         start = message[0]
         end = message[-1]
@@ -290,7 +643,7 @@ class SysexMessage(object):
 
         man_id = message[1:4]
 
-        if man_id != [_MAN_ID1, _MAN_ID2, _MAN_ID3]:
+        if list(man_id) != [_MAN_ID1, _MAN_ID2, _MAN_ID3]:
             raise TypeError("Wrong manufacturer")
 
         dev_id = message[4]
@@ -298,10 +651,15 @@ class SysexMessage(object):
         if dev_id != _DEV_ID:
             raise TypeError("Wrong device")
 
-        logging.debug("Valid BBS1 SysEx message")
+        # SysEx data bytes are 7 bits
+        if max(message[5:-1]) > 0x7f:
+            raise TypeError("Not a valid SysEx message")
 
         msg_type = message[5]
 
+        if tracing.enabled:
+            tracing.emit(tracing.MESSAGE, msg_type, SysexMessage.command(message))
+
         if msg_type == _CMD:
             logging.debug("Command")
             payload = SysexMessage.parse_payload(message[6:-1])
@@ -320,6 +678,7 @@ class SysexMessage(object):
             return 'err', payload
         else:
             logging.error("Unknown message type")
+            raise TypeError("Unknown message type")
 
     @staticmethod
     def parse_payload(data):
@@ -330,6 +689,7 @@ class SysexMessage(object):
         :type data: list
         :return: Parsed payload data
         :rtype: mixed
+        :raises TypeError: Truncated payload
         """
         if data[0] == 0x23:
             logging.debug("Tempo map payload")
@@ -368,35 +728,42 @@ class SysexMessage(object):
         # Bidir
         elif data[1] == _FW_PG:
             logging.debug("Firmware page")
-            # TODO: code/decode
-            return
+            if len(data) not in (4, 15):
+                raise TypeError("Truncated page")
+            return data[2:]
         elif data[1] == _TX_FW_PG:
             logging.debug("Transmit firware page")
-            # TODO: code/decode
-            return
+            SysexMessage._check_page(data)
+            return data[2:]
         elif data[1] == _TX_TM_PG:
             logging.debug("Transmit tempo map page")
-            # TODO: code/decode
-            return
+            SysexMessage._check_page(data)
+            return data[2:]
         elif data[1] == _TM_PG:
             logging.debug("Tempo map page")
-            # TODO: try to code/decode from here
+            SysexMessage._check_page(data)
             return data[2:]
 
         # Answers
         elif data[1] == _FW_TX_CMP:
             logging.debug("Firmware transmit complete")
-            # TODO: decode
+            return 'complete'
         elif data[1] == _ANS_HW_VERS:
             logging.debug("Answer hardware version")
+            if len(data) < 11:
+                raise TypeError("Truncated version")
             # Ignore 4 bytes padding
             return SysexMessage.parse_version(data[5:])
         elif data[1] == _ANS_FW_VERS:
             logging.debug("Answer firmware version")
+            if len(data) < 11:
+                raise TypeError("Truncated version")
             # Ignore 4 bytes padding
             return SysexMessage.parse_version(data[5:])
         elif data[1] == _ANS_MODE:
             logging.debug("Answer mode")
+            if len(data) < 3:
+                raise TypeError("Truncated mode")
             return SysexMessage.parse_mode(data[2:])
 
         # Acnowledgments
@@ -409,6 +776,25 @@ class SysexMessage(object):
         logging.debug(hexlify(bytearray(data[2:])))
         return data[2:]
 
+    @staticmethod
+    def _check_page(data):
+        """
+        Reject truncated pages
+
+        Page acknowledgments only hold the page ID.
+        Pages hold whole encoded words and pages from the device announce their length in the reserved field.
+
+        :param data: Raw payload data
+        :type data: list | bytearray
+        :raises TypeError: Truncated page
+        """
+        if len(data) == 4 and data[0] == _RESERVED:
+            return
+        size = len(data) - 6
+        if (size < 0 or size > codec.ENCODED_PAGE_SIZE or size % codec.ENCODED_WORD_SIZE
+                or (data[0] != _RESERVED and data[0] != size)):
+            raise TypeError("Truncated page")
+
     @staticmethod
     def parse_version(raw_version):
         """
@@ -458,14 +844,11 @@ class SysexMessage(object):
         """
         logging.debug("Parse tempo maps pages")
 
-        # FIXME: MIDI SysEx is coded on 7 bits
-        # Bit shifting occurs in tempomaps data!!!
-
         """
         Tempo maps format
         =================
 
-        IMPORTANT NOTE: wire protocol introduce 1 padding byte after every 4 bytes
+        IMPORTANT NOTE: pages data is 7 bits encoded (see codec), offsets below are in decoded data
 
         Pages
         -----
@@ -560,226 +943,331 @@ class SysexMessage(object):
 
         tempofile = tempo.File()
 
-        # Parse header
-        maps = []
-        for p in pages:
-            # p[0]?
-            page_num = int(p[1])
-            logging.debug("Received page #" + str(page_num))
-            # p[2] always 0
-            # p[3] always 0
-            maps += p[4:]
+        if tracing.enabled:
+            for p in pages:
+                tracing.emit(tracing.PAGE, (p[0] << 7) | p[1])
 
-        logging.debug('Raw data:' + str(hexlify(bytearray(maps))))
+        # p[0:2] page ID
+        # p[2] always 0
+        # p[3] always 0
+        raw = codec.decode_pages([p[4:] for p in pages])
 
-        SysexMessage._parse_file_header(maps[0:10], tempofile)
+        # Records are read in place from the decoded data
+        try:
+            SysexMessage.parse_file_header(raw, tempofile)
 
-        index = SysexMessage._parse_maps(maps[10:], tempofile)
+            offset = SysexMessage._parse_maps(raw, TM_HEADER.size, tempofile)
 
-        SysexMessage._parse_bars(maps[index:], tempofile)
+            SysexMessage._parse_bars(raw, offset, tempofile)
+        except struct.error:
+            raise TypeError("Truncated tempo maps data")
 
         return tempofile
 
     @staticmethod
-    def _parse_file_header(header, tempofile):
+    def parse_file_header(data, tempofile):
         """
         Parse tempo map file informations
 
-        :parm tempofile:
+        :param data: Raw tempo maps data
+        :param tempofile: Tempo file
+        :type data: bytearray
         :type tempofile: tempo.File
+        :raises TypeError: Not tempo maps data
         """
-
-        # 4 bytes padding
-        # file_info[0]
+        magic, version, size, entries_count = TM_HEADER.unpack_from(data, 0)
 
         # Magic number
-        if header[1:4] != tempofile.MAGIC:
+        if list(bytearray(magic)) != tempofile.MAGIC:
             raise TypeError("Not tempo maps data")
         else:
             logging.debug("Valid tempo maps data found")
 
         # Version
-        tempofile.set_version(int(header[4]))
-
-        # 4 bytes padding
-        # file_info[5]
+        tempofile.set_version(version)
 
-        # File size (in bits)
-        tempofile.size = header[6] + header[7] * 256
+        # File size (in bytes)
+        tempofile.size = size
         logging.debug("Detected size " + str(tempofile.size) + " bytes")
 
         # Tempo map entries
-        tempofile.entries_count = header[8]
+        if entries_count > 9:
+            raise TypeError("Invalid tempo maps entries")
+        tempofile.entries_count = entries_count
+        tempofile.maps = [tempo.Map() for _ in range(0, entries_count)]
+        tempofile.maps_count = entries_count
         logging.debug("Found " + str(tempofile.entries_count) + " tempo maps")
 
-        # Padding!
-        # file_info[9]
-
     @staticmethod
-    def _parse_maps(maps_data, tempofile):
+    def _parse_maps(data, offset, tempofile):
         """
-        Parse maps data
+        Parse maps entries
 
-        :param maps_data: Raw maps data
+        :param data: Raw tempo maps data
+        :param offset: Entries offset
         :param tempofile: Tempo file
-        :type maps_data: list
+        :type data: bytearray
+        :type offset: int
         :type tempofile: tempo.File
-        :return: Next data index
+        :return: Next data offset
         :rtype: int
         """
-
-        index = 0
         for i in range(0, tempofile.maps_count):
             logging.debug("Parsing map #" + str(i))
-            inc, tempomap = SysexMessage._parse_map(maps_data[index:], tempofile)
-            index += inc
-            tempofile.maps[i] = tempomap
+            offset, tempomap = SysexMessage.parse_map(data, offset, tempofile)
+            tempofile.set_map(i, tempomap)
 
-        return index
+        return offset
 
     @staticmethod
-    def _parse_map(mapdata, tempofile):
+    def parse_map(data, offset, tempofile):
         """
-        Parse one map from raw data
+        Parse one map entry
 
-        :param mapdata: Raw map data
+        :param data: Raw tempo maps data
+        :param offset: Entry offset
         :param tempofile: Tempo file
-        :type mapdata: list
+        :type data: bytearray
+        :type offset: int
         :type tempofile: tempo.file
-        :return: (index, tempomap)
+        :return: (next data offset, tempomap)
         :rtype: (int, tempo.Map)
         """
         tempomap = tempo.Map()
 
-        # 4 bytes padding
-        # mapdata[0]
+        if tempofile.version == 2:
+            start_offset, length, name, flags = TM_ENTRY_V2.unpack_from(data, offset)
+            offset += TM_ENTRY_V2.size
+        else:
+            start_offset, length, name = TM_ENTRY.unpack_from(data, offset)
+            flags = None
+            offset += TM_ENTRY.size
 
         # Start offset
-        tempomap.start_offset = mapdata[1] + mapdata[2] * 256
+        tempomap.start_offset = start_offset
         logging.debug("Start offset: " + str(tempomap.start_offset))
 
         # Length (in bytes)
-        tempomap.length = mapdata[3] + mapdata[4] * 256
+        tempomap.length = length
         logging.debug("Map length: " + str(tempomap.length) + " bytes")
 
-        # 4 bytes padding
-        # mapdata[5]
-
-        # Name (1)
-        try:
-            tempomap.name = ''.join(unichr(c) for c in mapdata[6:10])
-        except NameError:
-            # We must be running Python 3
-            tempomap.name = ''.join(chr(c) for c in mapdata[6:10])
-
-        # 4 bytes padding
-        # mapping[10]
-
-        # Name (2)
-        try:
-            tempomap.name += ''.join(unichr(c) for c in mapdata[11:15])
-        except NameError:
-            # We must be running Python 3
-            tempomap.name += ''.join(chr(c) for c in mapdata[11:15])
-
-        # 4 bytes padding
-        # mapping[15]
-
-        # Name (3)
-        try:
-            tempomap.name += ''.join(unichr(c) for c in mapdata[16:20])
-        except NameError:
-            # We must be running Python 3
-            tempomap.name += ''.join(chr(c) for c in mapdata[16:20])
-
-        # 4 bytes padding
-        # mapping[20]
-
-        # Name (4)
-        try:
-            tempomap.name += ''.join(unichr(c) for c in mapdata[21:25])
-        except NameError:
-            # We must be running Python 3
-            tempomap.name += ''.join(chr(c) for c in mapdata[21:25])
-
+        # Name
+        tempomap.name = name.decode('latin-1')
         logging.debug("Map name: " + tempomap.name)
 
-        index = 25
-        if tempofile.version == 2:
+        if flags is not None:
             # Loop
-            tempomap.looping = mapdata[25] == 8
+            tempomap.looping = bool(flags & 0x80)
             logging.debug("Looping is " + str(tempomap.looping))
 
             # Count-in
-            tempomap.count_in = mapdata[26]
+            tempomap.count_in = flags & 0x7f
             logging.debug("Count-in " + str(tempomap.count_in) + " bars")
 
-            # Padding!
-            # mapdata[27:30]
-            index = 30
+        return offset, tempomap
 
-        return index, tempomap
+    @staticmethod
+    def _parse_bars(data, offset, tempofile):
+        """
+        Parse bars of all maps
+
+        :param data: Raw tempo maps data
+        :param offset: First bar offset
+        :param tempofile: Tempo file
+        :type data: bytearray
+        :type offset: int
+        :type tempofile: tempo.File
+        :return: Next data offset
+        :rtype: int
+        """
+        for i in range(0, tempofile.maps_count):
+            offset = SysexMessage._parse_map_bars(data, offset, tempofile, i)
+        return offset
 
     @staticmethod
-    def _parse_bars(bars_data, tempofile):
+    def _parse_map_bars(data, offset, tempofile, i):
         """
-        Parse bars from raw data
+        Parse bars of one map
 
-        :param bars_data: Raw bars data
-        :type bars_data: list
+        :param data: Raw tempo maps data
+        :param offset: First bar offset
+        :param tempofile: Tempo file
+        :param i: Map index
+        :type data: bytearray
+        :type offset: int
+        :type tempofile: tempo.File
+        :type i: int
+        :return: Next data offset
+        :rtype: int
         """
-        index = 10
-        for i in range(0, tempofile.maps_count - 1):
-            logging.debug('Parsing bars from map #' + str(i))
-            for b in range(0, int(tempofile.maps[i].length / 4)):
-                logging.debug('Parsing bar #' + str(b))
-                tempofile.maps[i].bars.append(SysexMessage._parse_bar(bars_data[index:]))
-                index += 5
+        logging.debug('Parsing bars from map #' + str(i))
+        tempomap = tempofile.maps[i]
+        end = offset + tempomap.length // TM_BAR.size * TM_BAR.size
+        if end > len(data):
+            raise struct.error("Truncated bars")
+        # Bars are kept in the storage format
+        tempomap.bars = tempo.Bars.frombytes(data[offset:end])
+        if tracing.enabled:
+            for b, bar in enumerate(tempomap.bars):
+                tracing.emit(tracing.BAR, i, b, bar.beats_per_bar, bar.beat_value, bar.repeats, bar.tempo)
+        return end
 
     @staticmethod
-    def _parse_bar(bardata):
+    def page_id(answer):
         """
-        Parse one bar from raw data
+        Get the page ID of a page or page acknowledgment
 
-        :param bardata: Raw bar data
-        :type bardata: list
-        :return: Decoded bar
-        :rtype: tempo.Bar
+        :param answer: Answer data
+        :type answer: str, list
+        :return: Page ID or None when not a page
+        :rtype: int | None
         """
-        logging.debug("Bar data:" + str(hexlify(bytearray(bardata[0:5]))))
+        payload = answer[1]
+        if isinstance(payload, (list, bytearray)) and len(payload) > 1:
+            return (payload[0] << 7) | payload[1]
+        return None
 
-        bar = tempo.Bar()
-        # Padding!
-        # bardata[0]
 
-        # Time signature
-        bar.beats_per_bar = int(bardata[1] >> 4)
-        logging.debug("Signature top: " + str(bar.beats_per_bar))
-        bar.beat_value = int(1 << (bardata[1] & 0b00001111))
-        logging.debug("Signature bottom: " + str(bar.beat_value))
+class TempoMapsDecoder(object):
+    """
+    Incremental tempo maps dump decoding
 
-        # Repeats
-        bar.repeats = bardata[2]
-        logging.debug("Repeats: " + str(bar.repeats))
+    Pages are fed as they are received and decoded right away.
+    Each map is complete as soon as its bars are available, before the end of the dump.
+    Duplicate pages are ignored and out of order pages are held until the missing ones arrive.
+    """
 
-        # Tempo
-        bar.tempo = bardata[3] + bardata[4] * 256
-        logging.debug("Tempo: " + str(bar.tempo / 100))
+    def __init__(self, on_map=None):
+        """
+        Initialize decoding
 
-        return bar
+        :param on_map: Called with the map index and the map as soon as a map is complete
+        :type on_map: function
+        """
+        self.tempofile = tempo.File()
+        self.on_map = on_map
+        self.complete = False
+        self.maps_done = 0  # Number of complete maps
+        self.pages_count = None  # Known once the header is decoded
+        self._raw = bytearray()  # Decoded data of consecutive pages
+        self._next = 0  # Next page index
+        self._pending = {}  # Out of order pages data by index
+        self._last = None  # Last page data, when received early
+        self._offset = None  # Next bars offset, once entries are decoded
+
+    @property
+    def missing(self):
+        """
+        Pages not received yet, as far as we can tell
 
-    @staticmethod
-    def is_last_tm_page(answer):
+        :rtype: int[]
         """
-        Check if it is the last tempo maps page
+        if self.complete:
+            return []
+        if self.pages_count is not None:
+            end = self.pages_count - 1
+        else:
+            end = max(self._pending) + 1 if self._pending else self._next
+        return [index for index in range(self._next, end) if index not in self._pending]
 
-        :param answer: Answer data
+    def feed(self, answer):
+        """
+        Feed a tempo map page
+
+        :param answer: Parsed tempo map page
         :type answer: str, list
-        :return: Last tempo map page status
+        :return: Dump completion
         :rtype: bool
+        :raises TypeError: Not tempo maps data
         """
-        if answer[1] is not None:
-            if len(answer[1]) > 1:
-                if answer[1][0:2] == [0x7f, 0x7f]:
-                    return True
-        return False
+        page_id = SysexMessage.page_id(answer)
+        if page_id is None:
+            logging.warning("Not a tempo map page")
+            return self.complete
+        if tracing.enabled:
+            tracing.emit(tracing.PAGE, page_id)
+
+        # p[0:2] page ID
+        # p[2] always 0
+        # p[3] always 0
+        data = answer[1][4:]
+        if page_id == _LAST_PAGE:
+            if self.complete or self._last is not None:
+                logging.debug("Duplicate last page")
+                return self.complete
+            self._last = data
+        elif page_id < self._next or page_id in self._pending:
+            logging.debug("Duplicate page #" + str(page_id))
+            return self.complete
+        elif page_id > self._next:
+            logging.debug("Out of order page #" + str(page_id))
+            self._pending[page_id] = data
+            return self.complete
+        else:
+            self._append(data)
+
+        while self._next in self._pending:
+            self._append(self._pending.pop(self._next))
+
+        if self._last is not None and not self._pending and self._last_due():
+            self._append(self._last)
+            self._last = None
+            self.complete = True
+            if self.maps_done < self.tempofile.maps_count:
+                raise TypeError("Truncated tempo maps data")
+        return self.complete
+
+    def _last_due(self):
+        """
+        Check if the last page is the next one
+
+        :rtype: bool
+        """
+        if self.pages_count is not None:
+            return self._next == self.pages_count - 1
+        if self._next > 0:
+            return False
+        # Before page 0, only a single page dump header makes the last page the first one
+        raw = codec.decode(bytearray(self._last))
+        if len(raw) < TM_HEADER.size:
+            return False
+        magic, version, size, entries_count = TM_HEADER.unpack_from(raw, 0)
+        return list(bytearray(magic)) == tempo.File.MAGIC and size <= _PAGE_SIZE
+
+    def _append(self, data):
+        """
+        Decode the next page data
+
+        :param data: Encoded page data
+        :type data: list | bytearray
+        """
+        self._raw += codec.decode(bytearray(data))
+        self._next += 1
+        try:
+            self._decode()
+        except struct.error:
+            raise TypeError("Truncated tempo maps data")
+
+    def _decode(self):
+        """Decode whatever the received data allows"""
+        raw = self._raw
+        tempofile = self.tempofile
+        if self._offset is None:
+            if self.pages_count is None:
+                if len(raw) < TM_HEADER.size:
+                    return
+                SysexMessage.parse_file_header(raw, tempofile)
+                self.pages_count = max(1, (tempofile.size + _PAGE_SIZE - 1) // _PAGE_SIZE)
+            entry = TM_ENTRY_V2 if tempofile.version == 2 else TM_ENTRY
+            if len(raw) < TM_HEADER.size + tempofile.maps_count * entry.size:
+                return
+            self._offset = SysexMessage._parse_maps(raw, TM_HEADER.size, tempofile)
+
+        while self.maps_done < tempofile.maps_count:
+            i = self.maps_done
+            if self._offset + tempofile.maps[i].length > len(raw):
+                return
+            self._offset = SysexMessage._parse_map_bars(raw, self._offset, tempofile, i)
+            self.maps_done += 1
+            if self.on_map is not None:
+                self.on_map(i, tempofile.maps[i])
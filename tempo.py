@@ -16,7 +16,67 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
 import logging
+import numbers
+import struct
+import sys
+from array import array
+from collections import deque
+
+# One unsigned 32 bits integer per bar
+_TYPECODE = 'I' if array('I').itemsize == 4 else 'L'
+
+
+def _pack(beats_per_bar, beat_value, repeats, tempo):
+    """
+    Pack a bar in its storage format
+
+    Bytes are, from the least significant:
+    time signature (beats per bar << 4 | log2(beat value)), repeats and tempo (INT16u)
+    16 beats per bar are stored as 0.
+
+    :param beats_per_bar: Beats per bar (1-16)
+    :param beat_value: Beat value (power of 2)
+    :param repeats: Repeats (0-255)
+    :param tempo: Tempo (BPM * 100)
+    :type beats_per_bar: int
+    :type beat_value: int
+    :type repeats: int
+    :type tempo: int
+    :rtype: int
+    :raises TypeError: A value does not fit the storage format
+    """
+    if not isinstance(beats_per_bar, numbers.Integral) or not 1 <= beats_per_bar <= 16:
+        raise TypeError("Beats per bar must be an integer between 1 and 16")
+    if not isinstance(beat_value, numbers.Integral) or beat_value <= 0:
+        raise TypeError("Beat value must be a power of 2")
+    log2 = beat_value.bit_length() - 1
+    if beat_value != 1 << log2 or log2 > 15:
+        raise TypeError("Beat value must be a power of 2")
+    if not isinstance(repeats, numbers.Integral) or not 0 <= repeats <= 255:
+        raise TypeError("Repeats must be an integer between 0 and 255")
+    if not isinstance(tempo, numbers.Integral):
+        raise TypeError("Tempo must be an integer number of hundredths of BPM")
+    if not 0 <= tempo <= 0xffff:
+        raise TypeError("Tempo out of range")
+    return ((beats_per_bar & 0x0f) << 4) | log2 | (repeats << 8) | (tempo << 16)
+
+
+def _file_digest(version, digests):
+    """
+    Tempo file content hash
+
+    :param version: Tempo maps structure version
+    :param digests: Maps digests
+    :type version: int
+    :type digests: list[bytes]
+    :rtype: bytes
+    """
+    content = hashlib.sha1(struct.pack('<BB', version, len(digests)))
+    for digest in digests:
+        content.update(digest)
+    return content.digest()
 
 
 class Bar(object):
@@ -27,40 +87,486 @@ class Bar(object):
         self.beats_per_bar = beats_per_bar
         self.beat_value = beat_value
         self.repeats = repeats
-        self.tempo = bpm * 100
+        # Stored in hundredths of BPM
+        self.tempo = int(round(bpm * 100))
+
+    def __eq__(self, other):
+        return (isinstance(other, (Bar, BarView))
+                and (self.beats_per_bar, self.beat_value, self.repeats, self.tempo)
+                == (other.beats_per_bar, other.beat_value, other.repeats, other.tempo))
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
+class BarView(object):
+    """
+    Bar stored in a Bars container
+
+    Reads and writes go to the container. Like a list index, a view follows a position, not a bar.
+    """
+    __slots__ = ('_bars', '_index')
+
+    def __init__(self, bars, index):
+        self._bars = bars
+        self._index = index
+
+    @property
+    def beats_per_bar(self):
+        return (self._bars._data[self._index] >> 4 & 0x0f) or 16
+
+    @beats_per_bar.setter
+    def beats_per_bar(self, beats_per_bar):
+        self._set(beats_per_bar=beats_per_bar)
+
+    @property
+    def beat_value(self):
+        return 1 << (self._bars._data[self._index] & 0x0f)
+
+    @beat_value.setter
+    def beat_value(self, beat_value):
+        self._set(beat_value=beat_value)
+
+    @property
+    def repeats(self):
+        return self._bars._data[self._index] >> 8 & 0xff
+
+    @repeats.setter
+    def repeats(self, repeats):
+        self._set(repeats=repeats)
+
+    @property
+    def tempo(self):
+        return self._bars._data[self._index] >> 16
+
+    @tempo.setter
+    def tempo(self, tempo):
+        self._set(tempo=tempo)
+
+    def _set(self, **values):
+        """Update some of the bar values"""
+        bar = dict(beats_per_bar=self.beats_per_bar, beat_value=self.beat_value,
+                   repeats=self.repeats, tempo=self.tempo)
+        bar.update(values)
+        self._bars._own()
+        self._bars._data[self._index] = _pack(**bar)
+        self._bars.revision += 1
+
+    def copy(self):
+        """
+        Detached copy
+
+        :rtype: Bar
+        """
+        bar = Bar(self.beats_per_bar, self.beat_value, self.repeats)
+        bar.tempo = self.tempo
+        return bar
+
+    def __eq__(self, other):
+        return (isinstance(other, (Bar, BarView))
+                and (self.beats_per_bar, self.beat_value, self.repeats, self.tempo)
+                == (other.beats_per_bar, other.beat_value, other.repeats, other.tempo))
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    __hash__ = None
+
+
+class Bars(object):
+    """
+    Compact bars container
+
+    Behaves like a list of bars but stores each bar in 4 bytes, in the device storage format.
+    Items are BarView instances. Bar-like objects can be stored.
+    Copies, comparisons and slices of Bars are done on the whole buffer at once.
+    The revision is incremented on every modification.
+
+    Copies share their buffer until one of them is modified (copy-on-write).
+    """
+    __slots__ = ('_data', '_shared', 'revision')
+
+    def __init__(self, bars=None):
+        """
+        Initialize container
+
+        :param bars: Bar-like objects
+        :type bars: list[Bar] | Bars
+        """
+        self.revision = 0
+        self._shared = False
+        if isinstance(bars, Bars):
+            self._data = bars._data
+            self._shared = bars._shared = True
+        else:
+            self._data = array(_TYPECODE, [self._pack(bar) for bar in bars or []])
+
+    def _own(self):
+        """Get a private buffer before a modification"""
+        if self._shared:
+            self._data = array(_TYPECODE, self._data)
+            self._shared = False
+
+    @staticmethod
+    def _pack(bar):
+        if isinstance(bar, BarView):
+            return bar._bars._data[bar._index]
+        return _pack(bar.beats_per_bar, bar.beat_value, bar.repeats, bar.tempo)
+
+    @classmethod
+    def frombytes(cls, raw):
+        """
+        Load bars in the device storage format
+
+        :param raw: Raw bars data, 4 bytes per bar
+        :type raw: bytes | bytearray
+        :rtype: Bars
+        """
+        bars = cls()
+        try:
+            bars._data.frombytes(bytes(raw))
+        except AttributeError:
+            # We must be running Python 2
+            bars._data.fromstring(bytes(raw))
+        if sys.byteorder == 'big':
+            bars._data.byteswap()
+        return bars
+
+    def tobytes(self):
+        """
+        Bars in the device storage format
+
+        :return: Raw bars data, 4 bytes per bar
+        :rtype: bytes
+        """
+        data = self._data
+        if sys.byteorder == 'big':
+            data = array(_TYPECODE, data)
+            data.byteswap()
+        try:
+            return data.tobytes()
+        except AttributeError:
+            # We must be running Python 2
+            return data.tostring()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        for index in range(0, len(self._data)):
+            yield BarView(self, index)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            bars = Bars()
+            bars._data = self._data[index]
+            return bars
+        if index < 0:
+            index += len(self._data)
+        if not 0 <= index < len(self._data):
+            raise IndexError("Bar index out of range")
+        return BarView(self, index)
+
+    def __setitem__(self, index, bar):
+        self._own()
+        if isinstance(index, slice):
+            if isinstance(bar, Bars):
+                self._data[index] = bar._data
+            else:
+                self._data[index] = array(_TYPECODE, [self._pack(item) for item in bar])
+        else:
+            self._data[index] = self._pack(bar)
+        self.revision += 1
+
+    def __delitem__(self, index):
+        self._own()
+        del self._data[index]
+        self.revision += 1
 
     def __eq__(self, other):
-        return isinstance(other, self.__class__) and self.__dict__ == other.__dict__
+        if isinstance(other, Bars):
+            return self._data == other._data
+        try:
+            return len(self) == len(other) and all(bar == otherbar for bar, otherbar in zip(self, other))
+        except TypeError:
+            return False
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    __hash__ = None
+
+    def __copy__(self):
+        # Copies keep the revision: cached digests stay consistent
+        bars = Bars(self)
+        bars.revision = self.revision
+        return bars
+
+    def __deepcopy__(self, memo):
+        return self.__copy__()
+
+    def __repr__(self):
+        return 'Bars(' + str(len(self)) + ' bars)'
+
+    def append(self, bar):
+        """
+        Add a bar at the end
+
+        :type bar: Bar | BarView
+        """
+        self._own()
+        self._data.append(self._pack(bar))
+        self.revision += 1
+
+    def extend(self, bars):
+        """
+        Add bars at the end
+
+        :type bars: list[Bar] | Bars
+        """
+        self[len(self):] = bars
+
+    def insert(self, index, bar):
+        """
+        Insert a bar
+
+        :type index: int
+        :type bar: Bar | BarView
+        """
+        self._own()
+        self._data.insert(index, self._pack(bar))
+        self.revision += 1
+
+    def pop(self, index=-1):
+        """
+        Remove a bar
+
+        :type index: int
+        :return: Removed bar
+        :rtype: Bar
+        """
+        bar = self[index].copy()
+        del self[index]
+        return bar
+
+    def optimize(self):
+        """
+        Fold runs of equal bars into repeats
+
+        Consecutive bars with the same time signature and tempo become one bar with their total repeats,
+        split every 255 repeats. A held bar is played until the metronome is stopped (see timeline):
+        folding stops there and the following bars, never reached, are kept unchanged. See prune().
+        Playback is unchanged. Each bar is visited once.
+
+        :return: Number of removed bars
+        :rtype: int
+        """
+        folded = array(_TYPECODE)
+        run = None  # Bar value without repeats
+        count = 0  # Run repeats
+        for index, value in enumerate(self._data):
+            repeats = value >> 8 & 0xff
+            if repeats and value & ~0xff00 == run:
+                count += repeats
+                continue
+            self._append_run(folded, run, count)
+            if not repeats:
+                # Held bar and the following ones
+                folded.extend(self._data[index:])
+                break
+            run = value & ~0xff00
+            count = repeats
+        else:
+            self._append_run(folded, run, count)
+
+        removed = len(self._data) - len(folded)
+        if folded != self._data:
+            self._data = folded
+            self._shared = False
+            self.revision += 1
+        return removed
+
+    def prune(self):
+        """
+        Remove the bars following the first held bar
+
+        They are never reached: playback is unchanged.
+
+        :return: Number of removed bars
+        :rtype: int
+        """
+        for index, value in enumerate(self._data):
+            if not value >> 8 & 0xff:
+                removed = len(self._data) - index - 1
+                if removed:
+                    del self[index + 1:]
+                return removed
+        return 0
+
+    @staticmethod
+    def _append_run(folded, run, count):
+        """
+        Store a run of equal bars, at most 255 repeats per bar
+
+        :param folded: Bars values
+        :param run: Bar value without repeats
+        :param count: Total repeats
+        :type folded: array.array
+        :type run: int
+        :type count: int
+        """
+        while count:
+            repeats = min(count, 255)
+            folded.append(run | repeats << 8)
+            count -= repeats
+
 
 class Map(object):
     """
     Tempo map
+
+    Changes are tracked: the revision is incremented on every modification
+    and the content digest is only computed again after a modification.
+    The start offset and length are storage layout, not content.
     """
+    # Attributes making the map content, besides bars
+    _CONTENT = ('name', 'looping', 'count_in')
+
+    _revision = 0
+
     def __init__(self, bars=None, name=''.ljust(16, '\x00'),
                  looping=False, count_in=0):
         self.start_offset = 0
         self.length = 0
-        self.bars = []  # List of bars (max 1018)
-        if bars is not None:
-            self.bars = bars
+        self.bars = bars  # Bars (max 1018)
         self.name = name
         self.looping = looping
         if not 0 <= count_in <= 8:
             raise TypeError("Count-in must be between 0 and 8")
         self.count_in = count_in
+        self._digest = None
+        self._digest_revision = None
+        self._snapshot = None
+        self._snapshot_revision = None
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name in self._CONTENT:
+            self._revision += 1
 
     def __eq__(self, other):
-        return (isinstance(other, self.__class__)
-                and self.__dict__ == other.__dict__
-                and all([bar == otherbar for bar, otherbar in zip(self.bars, other.bars)]))
+        return isinstance(other, self.__class__) and self.digest == other.digest
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    __hash__ = None
+
+    @property
+    def revision(self):
+        """
+        Modification counter
+
+        :rtype: int
+        """
+        return self._revision + self._bars.revision
+
+    @property
+    def digest(self):
+        """
+        Content hash
+
+        :rtype: bytes
+        """
+        revision = self.revision
+        if self._digest_revision != revision:
+            # Python 2 names may be bytes
+            name = self.name if isinstance(self.name, bytes) else self.name.encode('utf-8')
+            content = hashlib.sha1(name)
+            content.update(struct.pack('<BB', self.looping, self.count_in))
+            content.update(self._bars.tobytes())
+            self._digest = content.digest()
+            self._digest_revision = revision
+        return self._digest
+
+    @property
+    def bars(self):
+        """
+        Map bars
+
+        :rtype: Bars
+        """
+        return self._bars
+
+    @bars.setter
+    def bars(self, bars):
+        if not isinstance(bars, Bars):
+            bars = Bars(bars)
+        old = self.__dict__.get('_bars')
+        if old is not None:
+            # Keep the revision increasing
+            self._revision += old.revision + 1
+        self._bars = bars
+
+    def snapshot(self):
+        """
+        Immutable copy
+
+        Consecutive snapshots of an unmodified map are the same object.
+
+        :rtype: MapSnapshot
+        """
+        revision = self.revision
+        if self._snapshot_revision != revision:
+            self._snapshot = MapSnapshot(self)
+            self._snapshot_revision = revision
+        return self._snapshot
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """
+        Editable map from a snapshot
+
+        :param snapshot: Map snapshot
+        :type snapshot: MapSnapshot
+        :rtype: Map
+        """
+        tempomap = cls(snapshot.bars, snapshot.name, snapshot.looping, snapshot.count_in)
+        tempomap.start_offset = snapshot.start_offset
+        tempomap.length = snapshot.length
+        tempomap._snapshot = snapshot
+        tempomap._digest = snapshot.digest
+        tempomap._digest_revision = tempomap._snapshot_revision = tempomap.revision
+        return tempomap
+
+    def optimize(self):
+        """
+        Fold runs of equal bars into repeats
+
+        See Bars.optimize().
+
+        :return: Number of removed bars
+        :rtype: int
+        """
+        removed = self._bars.optimize()
+        if removed:
+            logging.debug("Folded " + str(removed) + " bars")
+        return removed
+
+    def prune(self):
+        """
+        Remove the bars following the first held bar
+
+        See Bars.prune().
+
+        :return: Number of removed bars
+        :rtype: int
+        """
+        removed = self._bars.prune()
+        if removed:
+            logging.debug("Pruned " + str(removed) + " bars")
+        return removed
+
     def reset(self):
         """
         Resets the map
@@ -85,10 +591,14 @@ class Map(object):
 class File(object):
     """
     Tempo file
+
+    Changes are tracked like maps changes. Replace maps with set_map().
     """
-    # TODO: load and save file
+    # Load and save with the storage module
     MAGIC = [0x42, 0x42, 0x53]  # == 'BBS'
 
+    _revision = 0
+
     def __init__(self, maps=None):
         self.version = 2
         self.size = 0  # in bits (TODO: compute)
@@ -108,16 +618,79 @@ class File(object):
         if not 0 <= maps_count <= 9:
             raise TypeError("Files can only have 0 to 9 maps")
         self.maps_count = maps_count
+        self.entries_count = maps_count
+
+    def __setattr__(self, name, value):
+        if name == 'maps':
+            # Keep the revision increasing
+            self._revision += sum(tempomap.revision for tempomap in self.__dict__.get('maps', [])) + 1
+        elif name == 'version':
+            self._revision += 1
+        object.__setattr__(self, name, value)
 
     def __eq__(self, other):
-        return (isinstance(other, self.__class__)
-                and self.__dict__ == other.__dict__
-                and self.maps == other.maps
-                and all([tmap == othertmap for tmap, othertmap in zip(self.maps, other.maps)]))
+        return isinstance(other, self.__class__) and self.digest == other.digest
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    __hash__ = None
+
+    @property
+    def revision(self):
+        """
+        Modification counter
+
+        :rtype: int
+        """
+        return self._revision + sum(tempomap.revision for tempomap in self.maps)
+
+    @property
+    def digest(self):
+        """
+        Content hash
+
+        Only the digests of modified maps are computed again.
+
+        :rtype: bytes
+        """
+        return _file_digest(self.version, [tempomap.digest for tempomap in self.maps])
+
+    def snapshot(self):
+        """
+        Immutable copy
+
+        Unmodified maps are shared with the previous snapshot, bars are shared until modified.
+
+        :rtype: Snapshot
+        """
+        return Snapshot(self.version, [tempomap.snapshot() for tempomap in self.maps], self.size)
+
+    def restore(self, snapshot):
+        """
+        Go back to a snapshot
+
+        :param snapshot: File snapshot
+        :type snapshot: Snapshot
+        """
+        self.version = snapshot.version
+        self.size = snapshot.size
+        self.maps = [Map.from_snapshot(tempomap) for tempomap in snapshot.maps]
+        self.maps_count = len(self.maps)
+        self.entries_count = self.maps_count
+
+    def set_map(self, index, tempomap):
+        """
+        Replace a map
+
+        :param index: Map index
+        :param tempomap: New map
+        :type index: int
+        :type tempomap: Map
+        """
+        self._revision += self.maps[index].revision + 1
+        self.maps[index] = tempomap
+
     def set_version(self, version):
         """
         Set tempo maps structure version
@@ -129,3 +702,180 @@ class File(object):
             raise TypeError("Unknown tempo maps version: " + str(version))
         logging.debug("Tempo maps version " + str(version))
         self.version = version
+
+
+class MapSnapshot(object):
+    """
+    Immutable tempo map copy
+
+    Bars are shared with the map until it modifies them.
+    """
+    __slots__ = ('name', 'looping', 'count_in', 'start_offset', 'length', 'digest', '_bars')
+
+    def __init__(self, tempomap):
+        """
+        Snapshot a map
+
+        :param tempomap: Tempo map
+        :type tempomap: Map
+        """
+        self.name = tempomap.name
+        self.looping = tempomap.looping
+        self.count_in = tempomap.count_in
+        self.start_offset = tempomap.start_offset
+        self.length = tempomap.length
+        self.digest = tempomap.digest
+        self._bars = Bars(tempomap.bars)
+
+    @property
+    def bars(self):
+        """
+        Copy of the bars, sharing the snapshot buffer until modified
+
+        :rtype: Bars
+        """
+        return Bars(self._bars)
+
+    @property
+    def size(self):
+        """
+        Bars buffer size
+
+        :return: Size (in bytes)
+        :rtype: int
+        """
+        return len(self._bars._data) * self._bars._data.itemsize
+
+
+class Snapshot(object):
+    """Immutable tempo file copy"""
+    __slots__ = ('version', 'maps', 'size', 'digest')
+
+    def __init__(self, version, maps, size=0):
+        """
+        Initialize snapshot
+
+        :param version: Tempo maps structure version
+        :param maps: Maps snapshots
+        :param size: Tempo file size
+        :type version: int
+        :type maps: list[MapSnapshot]
+        :type size: int
+        """
+        self.version = version
+        self.size = size
+        self.maps = tuple(maps)
+        self.digest = _file_digest(version, [tempomap.digest for tempomap in self.maps])
+
+
+class History(object):
+    """
+    Bounded undo and redo history of tempo file snapshots
+
+    Snapshots share unmodified maps and bars buffers: memory is only accounted once per buffer.
+    The oldest snapshots are evicted when there are too many or when they use too much memory.
+    """
+
+    # Maximum snapshots
+    LIMIT = 100
+    # Maximum bars buffers memory
+    MEMORY = 4 * 1024 * 1024  # in bytes
+
+    def __init__(self, limit=LIMIT, memory=MEMORY):
+        """
+        Initialize history
+
+        :param limit: Maximum snapshots
+        :param memory: Maximum bars buffers memory (in bytes)
+        :type limit: int
+        :type memory: int
+        """
+        self.limit = limit
+        self.memory_limit = memory
+        self.memory = 0  # Bars buffers memory (in bytes)
+        self._undo = deque()  # Snapshots, the current one last
+        self._redo = []  # Undone snapshots, the next one last
+        self._buffers = {}  # [references, size] by bars buffer id
+
+    @property
+    def current(self):
+        """
+        Current snapshot
+
+        :rtype: Snapshot | None
+        """
+        if self._undo:
+            return self._undo[-1]
+        return None
+
+    @property
+    def can_undo(self):
+        """:rtype: bool"""
+        return len(self._undo) > 1
+
+    @property
+    def can_redo(self):
+        """:rtype: bool"""
+        return bool(self._redo)
+
+    def record(self, snapshot):
+        """
+        Record a new state, forgetting undone ones
+
+        :param snapshot: File snapshot
+        :type snapshot: Snapshot
+        :return: False when the state did not change
+        :rtype: bool
+        """
+        if self._undo and self._undo[-1].digest == snapshot.digest:
+            return False
+        while self._redo:
+            self._release(self._redo.pop())
+        self._undo.append(snapshot)
+        self._retain(snapshot)
+        while len(self._undo) > 1 and (len(self._undo) > self.limit or self.memory > self.memory_limit):
+            logging.debug("Evicting the oldest tempo maps snapshot")
+            self._release(self._undo.popleft())
+        return True
+
+    def undo(self):
+        """
+        Go back to the previous state
+
+        :return: Previous snapshot or None when there is nothing to undo
+        :rtype: Snapshot | None
+        """
+        if not self.can_undo:
+            return None
+        self._redo.append(self._undo.pop())
+        return self._undo[-1]
+
+    def redo(self):
+        """
+        Go forward to the next undone state
+
+        :return: Next snapshot or None when there is nothing to redo
+        :rtype: Snapshot | None
+        """
+        if not self.can_redo:
+            return None
+        self._undo.append(self._redo.pop())
+        return self._undo[-1]
+
+    def _retain(self, snapshot):
+        """Account for the memory of a recorded snapshot"""
+        for tempomap in snapshot.maps:
+            key = id(tempomap._bars._data)
+            if key in self._buffers:
+                self._buffers[key][0] += 1
+            else:
+                self._buffers[key] = [1, tempomap.size]
+                self.memory += tempomap.size
+
+    def _release(self, snapshot):
+        """Account for the memory of a forgotten snapshot"""
+        for tempomap in snapshot.maps:
+            key = id(tempomap._bars._data)
+            self._buffers[key][0] -= 1
+            if not self._buffers[key][0]:
+                self.memory -= self._buffers.pop(key)[1]
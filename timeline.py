@@ -0,0 +1,212 @@
+# -*- coding: utf-8 *-*
+"""BBS1 tempo maps timing"""
+# A tool to communicate with Peterson's BBS-1 metronome
+# Copyright (C) 2012-2015 Raphaël Doursenaud <rdoursenaud@free.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import struct
+from bisect import bisect_right
+
+try:
+    # noinspection PyUnresolvedReferences
+    import numpy
+except ImportError:
+    # Only needed to speed up large maps
+    numpy = None
+
+"""
+Timing model
+============
+
+Each stored bar is played as many times as its repeats.
+A bar with 0 repeats is held: it is played until the metronome is stopped
+and the following bars are never reached.
+The tempo (BPM * 100) counts beats of the bar beat value.
+
+Time 0 is the first downbeat, after any count-in.
+Bars and beats are numbered from 0 over the whole played map.
+"""
+
+# Seconds in a minute times the tempo scale
+_MINUTE = 60.0 * 100
+
+
+class Timeline(object):
+    """
+    Tempo map timing index
+
+    Repeats are not expanded: cumulative bars, beats and times are computed once per stored bar
+    and lookups bisect them.
+    """
+
+    def __init__(self, tempomap):
+        """
+        Index a tempo map
+
+        :param tempomap: Tempo map
+        :type tempomap: tempo.Map
+        :raises TypeError: A bar has a null tempo
+        """
+        self.looping = tempomap.looping
+        self.revision = tempomap.revision  # Map revision the timeline was computed from
+        self.hold = None  # Index of the held stored bar
+        raw = tempomap.bars.tobytes()
+        if numpy is not None:
+            self._index_numpy(raw)
+        else:
+            self._index(raw)
+        self.bars_count = self._bar_starts[-1]  # Played bars, without the held bar
+        self.beats_count = self._beat_starts[-1]  # Played beats, without the held bar
+        self.duration = self._time_starts[-1]  # in seconds, without the held bar
+
+    def _index(self, raw):
+        """
+        Compute cumulative positions
+
+        :param raw: Bars in the storage format
+        :type raw: bytes
+        """
+        self._bar_starts = bar_starts = [0]
+        self._beat_starts = beat_starts = [0]
+        self._time_starts = time_starts = [0.0]
+        self._beats = []
+        self._bar_times = []
+        for index, value in enumerate(struct.unpack('<' + str(len(raw) // 4) + 'I', raw)):
+            beats = (value >> 4 & 0x0f) or 16
+            repeats = value >> 8 & 0xff
+            tempo = value >> 16
+            if not tempo:
+                raise TypeError("Null tempo in bar #" + str(index))
+            bar_time = beats * _MINUTE / tempo
+            self._beats.append(beats)
+            self._bar_times.append(bar_time)
+            if not repeats:
+                self.hold = index
+                break
+            bar_starts.append(bar_starts[-1] + repeats)
+            beat_starts.append(beat_starts[-1] + repeats * beats)
+            time_starts.append(time_starts[-1] + repeats * bar_time)
+
+    def _index_numpy(self, raw):
+        """NumPy cumulative positions"""
+        values = numpy.frombuffer(raw, dtype='<u4')
+        beats = (values >> 4 & 0x0f).astype(numpy.int64)
+        beats[beats == 0] = 16
+        repeats = (values >> 8 & 0xff).astype(numpy.int64)
+        tempos = values >> 16
+        held = numpy.flatnonzero(repeats == 0)
+        if held.size:
+            self.hold = int(held[0])
+            end = self.hold + 1
+        else:
+            end = len(values)
+        beats, repeats, tempos = beats[0:end], repeats[0:end], tempos[0:end]
+        null = numpy.flatnonzero(tempos == 0)
+        if null.size:
+            raise TypeError("Null tempo in bar #" + str(int(null[0])))
+        bar_times = beats * _MINUTE / tempos
+        played = end if self.hold is None else self.hold
+        self._beats = beats.tolist()
+        self._bar_times = bar_times.tolist()
+        self._bar_starts = [0] + numpy.cumsum(repeats[0:played]).tolist()
+        self._beat_starts = [0] + numpy.cumsum((repeats * beats)[0:played]).tolist()
+        self._time_starts = [0.0] + numpy.cumsum((repeats * bar_times)[0:played]).tolist()
+
+    def _wrap(self, position, length):
+        """
+        Bring a position past the end of a looping map back into the map
+
+        :param position: Bar number, beat number or time
+        :param length: Position at the end of the map
+        :return: (loops, position in the map)
+        :rtype: (int, int | float)
+        :raises IndexError: Position out of the map
+        """
+        if position < 0:
+            raise IndexError("Position before the start of the map")
+        if position < length or self.hold is not None:
+            return 0, position
+        if not self.looping or not length:
+            raise IndexError("Position past the end of the map")
+        loops = position // length
+        return int(loops), position - loops * length
+
+    def entry(self, bar):
+        """
+        Stored bar played at a bar number
+
+        :param bar: Bar number
+        :type bar: int
+        :return: Stored bar index
+        :rtype: int
+        :raises IndexError: Bar out of the map
+        """
+        bar = self._wrap(bar, self.bars_count)[1]
+        if bar >= self.bars_count:
+            return self.hold
+        return bisect_right(self._bar_starts, bar) - 1
+
+    def time_at_bar(self, bar):
+        """
+        Time of a bar downbeat
+
+        :param bar: Bar number
+        :type bar: int
+        :return: Time (in seconds)
+        :rtype: float
+        :raises IndexError: Bar out of the map
+        """
+        loops, bar = self._wrap(bar, self.bars_count)
+        index = self.entry(bar)
+        return (loops * self.duration + self._time_starts[index]
+                + (bar - self._bar_starts[index]) * self._bar_times[index])
+
+    def time_at_beat(self, beat):
+        """
+        Time of a beat
+
+        :param beat: Beat number
+        :type beat: int
+        :return: Time (in seconds)
+        :rtype: float
+        :raises IndexError: Beat out of the map
+        """
+        loops, beat = self._wrap(beat, self.beats_count)
+        if beat >= self.beats_count:
+            index = self.hold
+        else:
+            index = bisect_right(self._beat_starts, beat) - 1
+        beat_time = self._bar_times[index] / self._beats[index]
+        return loops * self.duration + self._time_starts[index] + (beat - self._beat_starts[index]) * beat_time
+
+    def position_at(self, time):
+        """
+        Bar and beat played at a time
+
+        :param time: Time (in seconds)
+        :type time: float
+        :return: (bar number, beat in the bar)
+        :rtype: (int, int)
+        :raises IndexError: Time out of the map
+        """
+        loops, time = self._wrap(time, self.duration)
+        if time >= self.duration:
+            index = self.hold
+        else:
+            index = bisect_right(self._time_starts, time) - 1
+        elapsed, offset = divmod(time - self._time_starts[index], self._bar_times[index])
+        # Rounding may put the offset on the next beat
+        beat = min(int(offset * self._beats[index] / self._bar_times[index]), self._beats[index] - 1)
+        return loops * self.bars_count + self._bar_starts[index] + int(elapsed), beat
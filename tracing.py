@@ -0,0 +1,189 @@
+# -*- coding: utf-8 *-*
+"""BBS1 protocol tracing"""
+# A tool to communicate with Peterson's BBS-1 metronome
+# Copyright (C) 2012-2015 Raphaël Doursenaud <rdoursenaud@free.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Events are only built when a sink is subscribed.
+# Emitters guard each event with the module level flag:
+#     if tracing.enabled:
+#         tracing.emit(tracing.FRAME_OUT, msg)
+
+import logging
+import struct
+import threading
+import time
+from binascii import hexlify
+
+##
+# Events
+##
+FRAME_IN = 0x01  # frame
+FRAME_OUT = 0x02  # frame
+MESSAGE = 0x03  # message type, payload command
+PAGE = 0x04  # page ID
+BAR = 0x05  # map index, bar index, beats per bar, beat value, repeats, tempo
+
+NAMES = {
+    FRAME_IN: 'frame in',
+    FRAME_OUT: 'frame out',
+    MESSAGE: 'message',
+    PAGE: 'page',
+    BAR: 'bar',
+}
+
+# Frames are recorded as is, other events as 16 bits unsigned fields
+_FRAMES = (FRAME_IN, FRAME_OUT)
+
+# Binary trace record header: timestamp, event, payload length
+_RECORD = struct.Struct('<dBH')
+
+enabled = False
+_sinks = []
+_lock = threading.Lock()
+
+
+def subscribe(sink):
+    """
+    Start delivering events to a sink
+
+    :param sink: Called with the event and its fields
+    :type sink: function
+    """
+    global enabled
+    with _lock:
+        _sinks.append(sink)
+        enabled = True
+
+
+def unsubscribe(sink):
+    """
+    Stop delivering events to a sink
+
+    :param sink: Subscribed sink
+    :type sink: function
+    """
+    global enabled
+    with _lock:
+        _sinks.remove(sink)
+        enabled = bool(_sinks)
+
+
+def emit(event, *fields):
+    """
+    Deliver an event to all sinks
+
+    :param event: Event type
+    :param fields: Event fields
+    :type event: int
+    """
+    for sink in list(_sinks):
+        sink(event, *fields)
+
+
+class LogSink(object):
+    """Human readable events in the log"""
+
+    def __init__(self, logger=None, level=logging.DEBUG):
+        """
+        Initialize sink
+
+        :param logger: Logger, defaults to the root logger
+        :param level: Logging level
+        :type logger: logging.Logger
+        :type level: int
+        """
+        if logger is None:
+            logger = logging.getLogger()
+        self.logger = logger
+        self.level = level
+
+    def __call__(self, event, *fields):
+        if not self.logger.isEnabledFor(self.level):
+            return
+        self.logger.log(self.level, self.format(event, fields))
+
+    @staticmethod
+    def format(event, fields):
+        """
+        Human readable event
+
+        :param event: Event type
+        :param fields: Event fields
+        :type event: int
+        :type fields: tuple
+        :rtype: str
+        """
+        if event == FRAME_IN:
+            return "<- " + hexlify(bytearray(fields[0])).decode('ascii')
+        elif event == FRAME_OUT:
+            return "-> " + hexlify(bytearray(fields[0])).decode('ascii')
+        elif event == MESSAGE:
+            return "Message type " + hex(fields[0]) + " command " + str(fields[1])
+        elif event == PAGE:
+            return "Page #" + str(fields[0])
+        elif event == BAR:
+            return "Map #" + str(fields[0]) + " bar #" + str(fields[1]) + ": " \
+                + str(fields[2]) + "/" + str(fields[3]) + " x" + str(fields[4]) \
+                + " @ " + str(fields[5] / 100.0) + " BPM"
+        return NAMES.get(event, hex(event)) + " " + str(fields)
+
+
+class BinarySink(object):
+    """
+    Compact binary trace
+
+    Each record is a timestamp, the event type and the payload length followed by the payload.
+    """
+
+    def __init__(self, stream):
+        """
+        Initialize sink
+
+        :param stream: Writable binary stream
+        :type stream: file
+        """
+        self.stream = stream
+        self._lock = threading.Lock()
+
+    def __call__(self, event, *fields):
+        if event in _FRAMES:
+            payload = bytes(bytearray(fields[0]))
+        else:
+            payload = struct.pack('<' + 'H' * len(fields), *[field or 0 for field in fields])
+        record = _RECORD.pack(time.time(), event, len(payload)) + payload
+        with self._lock:
+            self.stream.write(record)
+
+    @staticmethod
+    def read(stream):
+        """
+        Read back a binary trace
+
+        :param stream: Readable binary stream
+        :type stream: file
+        :return: Generator of (timestamp, event, fields)
+        :rtype: (float, int, tuple)
+        """
+        while True:
+            header = stream.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                return
+            timestamp, event, length = _RECORD.unpack(header)
+            payload = stream.read(length)
+            if event in _FRAMES:
+                yield timestamp, event, (bytearray(payload),)
+            else:
+                yield timestamp, event, struct.unpack('<' + 'H' * (length // 2), payload)
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 *-*
+"""BBS1 MIDI transports"""
+# A tool to communicate with Peterson's BBS-1 metronome
+# Copyright (C) 2012-2015 Raphaël Doursenaud <rdoursenaud@free.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+
+try:
+    # noinspection PyUnresolvedReferences
+    from pygame import midi
+except ImportError:
+    # Only needed by the pygame transport
+    midi = None
+
+# pygame MIDI is shared by all transports
+_midi_lock = threading.Lock()
+_midi_users = 0
+# Transports with open ports
+_ports_lock = threading.Lock()
+_open_transports = set()
+
+
+def _midi_acquire():
+    """Initialize pygame MIDI on first use"""
+    global _midi_users
+    with _midi_lock:
+        if _midi_users == 0:
+            logging.debug('Initializing Pygame MIDI')
+            midi.init()
+        _midi_users += 1
+
+
+def _midi_release():
+    """Quit pygame MIDI after last use"""
+    global _midi_users
+    with _midi_lock:
+        _midi_users -= 1
+        if _midi_users == 0:
+            logging.debug('Quitting Pygame MIDI')
+            midi.quit()
+
+
+def midi_reinit(current=None):
+    """
+    Restart pygame MIDI
+
+    PortMidi only enumerates devices on initialization: this is the only way to see newly plugged devices.
+    Restarting invalidates every open port and ports IDs may change,
+    so pygame MIDI is only restarted when no other transport has open ports.
+
+    :param current: Transport being reconnected, its ports are closed and must be reopened
+    :type current: Transport
+    :return: Restart status
+    :rtype: bool
+    """
+    if isinstance(current, PygameTransport):
+        current._close_ports()
+    with _midi_lock:
+        with _ports_lock:
+            busy = any(transport is not current for transport in _open_transports)
+        if busy:
+            logging.debug('MIDI ports in use: not restarting Pygame MIDI')
+            return False
+        if _midi_users > 0:
+            logging.debug('Restarting Pygame MIDI')
+            midi.quit()
+            midi.init()
+        return True
+
+
+class Transport(object):
+    """
+    MIDI transport interface
+
+    Moves raw SysEx bytes between Communication and a device.
+    """
+
+    def open(self):
+        """
+        Open the device ports
+
+        :raises IOError: The device could not be found
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Close the device ports and release the backend"""
+        raise NotImplementedError
+
+    def reopen(self):
+        """
+        Reopen the device ports after a communication loss
+
+        :raises IOError: The device could not be found
+        """
+        self.open()
+
+    def write(self, msg):
+        """
+        Send a complete SysEx message
+
+        :param msg: Message
+        :type msg: bytes | bytearray
+        """
+        raise NotImplementedError
+
+    def poll(self):
+        """
+        Check for pending input
+
+        :return: Input data availability
+        :rtype: bool
+        """
+        raise NotImplementedError
+
+    def read(self, size):
+        """
+        Read pending input
+
+        :param size: Maximum number of events to read
+        :type size: int
+        :return: Raw input bytes
+        :rtype: bytearray
+        """
+        raise NotImplementedError
+
+
+class PygameTransport(Transport):
+    """pygame.midi transport to a BBS-1 plugged over USB"""
+
+    PORT_NAME = 'BodyBeatSYNC'
+
+    def __init__(self, dev_in=None, dev_out=None):
+        """
+        Initialize pygame MIDI
+
+        :param dev_in: Input port ID, defaults to the first BBS-1 found
+        :param dev_out: Output port ID, defaults to the first BBS-1 found
+        :type dev_in: int
+        :type dev_out: int
+        """
+        if midi is None:
+            print("This script needs pygame to run")
+            raise ImportError("No module named pygame")
+        self.dev_in = dev_in
+        self.dev_out = dev_out
+        self.midi_in = None
+        self.midi_out = None
+        self._write_sys_ex = None
+        self._closed = False
+        _midi_acquire()
+
+    @classmethod
+    def find_ports(cls):
+        """
+        Find every BBS-1 input and output ports pair
+
+        :return: (input port ID, output port ID) for each device
+        :rtype: (int, int)[]
+        """
+        _midi_acquire()
+        try:
+            names = []
+            inputs = {}
+            outputs = {}
+            for i in range(0, midi.get_count()):
+                info = midi.get_device_info(i)
+                name = str(info[1])
+                if cls.PORT_NAME not in name:
+                    continue
+                if name not in names:
+                    names.append(name)
+                # Input
+                if info[2] >= 1:
+                    inputs.setdefault(name, []).append(i)
+                # Output
+                if info[3] >= 1:
+                    outputs.setdefault(name, []).append(i)
+        finally:
+            _midi_release()
+
+        # Devices sharing the same port name are paired in enumeration order
+        ports = []
+        for name in names:
+            ports += zip(inputs.get(name, []), outputs.get(name, []))
+        return ports
+
+    def close(self):
+        """Close ports and release pygame MIDI"""
+        if self._closed:
+            return
+        self._closed = True
+        self._close_ports()
+        _midi_release()
+
+    def _close_ports(self):
+        """Close input and output"""
+        with _ports_lock:
+            _open_transports.discard(self)
+        if self.midi_in is not None:
+            self.midi_in.close()
+            self.midi_in = None
+        if self.midi_out is not None:
+            self.midi_out.close()
+            self.midi_out = None
+            self._write_sys_ex = None
+
+    def reopen(self):
+        """Reopen the same ports without restarting pygame MIDI"""
+        self._close_ports()
+        try:
+            self.open()
+        except midi.MidiException as error:
+            raise IOError(str(error))
+
+    def open(self):
+        """Connect to the BBS-1"""
+        logging.debug('Attempting MIDI connection')
+
+        if self.dev_in is None or self.dev_out is None:
+            # Search for the first BodyBeatSync input and output ports
+            ports = self.find_ports()
+            if not ports:
+                error = "Couldn't find BodyBeatSync's input and output ports"
+                logging.warning(error)
+                raise IOError(error)
+            self.dev_in, self.dev_out = ports[0]
+
+        # Open input and output
+        logging.debug('Opening MIDI ports')
+        with _ports_lock:
+            _open_transports.add(self)
+        self.midi_in = midi.Input(self.dev_in)
+        self.midi_out = midi.Output(self.dev_out)
+        # PortMidi takes bytes-like messages as is on both Python 2 and 3
+        self._write_sys_ex = self.midi_out.write_sys_ex
+
+    def write(self, msg):
+        self._write_sys_ex(0, msg)
+
+    def poll(self):
+        return self.midi_in.poll()
+
+    def read(self, size):
+        data = bytearray()
+        for event in self.midi_in.read(size):
+            data.extend(event[0])
+        return data
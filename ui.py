@@ -16,17 +16,28 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from copy import deepcopy
-
 import communication
 import device
+import discovery
+import firmware
 import logging
+import os
+import smf
+import storage
+import sysex
+import tempo
+
+try:
+    import aio
+except (ImportError, SyntaxError):
+    # We must be running Python 2: device calls stay synchronous
+    aio = None
 
 try:
     # noinspection PyPackageRequirements,PyUnresolvedReferences
     import gi
     gi.require_version('Gtk', '3.0')
-    from gi.repository import Gtk, Gio
+    from gi.repository import Gtk, Gio, GLib
 except ImportError:
     print("This script needs pygobject to run")
     raise
@@ -44,8 +55,12 @@ class Bbs1App(Gtk.Application):
         self.fw_vers = ''
         self.com = None
         self.device = None
+        self.adevice = None  # Awaitable device
+        self.loop = None  # Device calls event loop
+        self.discovery = discovery.DeviceDiscovery()
         self.tempofile = None
-        self.tempofile_cache = None
+        self.device_snapshot = None  # Tempo maps on the device
+        self.history = tempo.History()
         self.clear_confirm = True  # Ask for confirmation before clearing device
 
         Gtk.Application.__init__(self, application_id='apps.bbs1',
@@ -55,10 +70,18 @@ class Bbs1App(Gtk.Application):
         logging.debug('Loading glade file')
         self.builder = Gtk.Builder()
         self.builder.add_from_file('bbs1.glade')
+        self.builder.get_object('midifilefilter').set_name("MIDI files")
+        self.builder.get_object('tempofilefilter').set_name("BBS-1 tempo maps")
+
+        # Device calls event loop
+        if aio is not None:
+            self.loop = aio.GLibEventLoop()
+            self.loop.start()
 
         # Signals
         self.builder.connect_signals(self)
         self.connect('activate', self.on_activate)
+        self.connect('shutdown', self.on_shutdown)
 
     def on_activate(self, data=None):
         """
@@ -83,6 +106,30 @@ class Bbs1App(Gtk.Application):
 
         self.msg_print("Initializing")
         self.init_communication()
+        self.discovery.watch(lambda: GLib.idle_add(self.on_hotplug))
+
+    def on_shutdown(self, data=None):
+        """
+        Application shutdown
+
+        :param data: Optional data
+        """
+        self.discovery.stop()
+        if self.loop is not None:
+            self.loop.stop()
+
+    def on_hotplug(self, data=None):
+        """
+        MIDI devices plugged or unplugged
+
+        :param data: Optional data
+        :return: False to remove the GLib idle source
+        :rtype: bool
+        """
+        self.msg_print("MIDI devices changed")
+        if self.device is None:
+            self.init_communication()
+        return False
 
     def msg_print(self, msg):
         """Print a message in the statusbar
@@ -100,6 +147,9 @@ class Bbs1App(Gtk.Application):
         :param data: Optional data
         """
         logging.debug('Initializing communication')
+        if self.device is not None and self._reconnect():
+            return
+
         try:
             self.com.__del__()
         except AttributeError:
@@ -107,7 +157,7 @@ class Bbs1App(Gtk.Application):
             pass
 
         try:
-            self.com = communication.Communication()
+            self.com = communication.Communication(transport=self.discovery.transport())
         except IOError:
             self.msg_print("Failed to initialize communication")
             self.show_alert_communication()
@@ -115,6 +165,24 @@ class Bbs1App(Gtk.Application):
             self.msg_print("Communication initialized")
             self.init_device()
 
+    def _reconnect(self):
+        """
+        Reconnect to the known device without restarting MIDI communication
+
+        :return: Reconnection status
+        :rtype: bool
+        """
+        if self.adevice is not None:
+            self.adevice.close()
+            self.adevice = None
+        if not self.discovery.reconnect(self.device):
+            return False
+        if self.loop is not None:
+            self.adevice = aio.AsyncBbs1(self.device, self.loop.loop)
+        self.msg_print("BBS-1 reconnected")
+        self.connect_device()
+        return True
+
     def show_alert_communication(self):
         """Show an alert reporting failed communication initialization"""
         comm_alert = self.builder.get_object('comm_alert')
@@ -132,6 +200,12 @@ class Bbs1App(Gtk.Application):
         """
 
         # Destroy any previous device
+        try:
+            self.adevice.close()
+        except AttributeError:
+            # self.adevice may not exist. This is not an issue: keep going
+            pass
+        self.adevice = None
         try:
             self.device.__del__()
         except AttributeError:
@@ -141,9 +215,12 @@ class Bbs1App(Gtk.Application):
         try:
             self.device = device.Bbs1(self.com)
         except IOError:
+            self.device = None
             self.msg_print("BBS-1 not found")
             self.show_alert_init()
         else:
+            if self.loop is not None:
+                self.adevice = aio.AsyncBbs1(self.device, self.loop.loop)
             self.msg_print("BBS-1 found! Connecting…")
             self.connect_device()
 
@@ -156,20 +233,66 @@ class Bbs1App(Gtk.Application):
         else:
             self.quit()
 
+    def _run(self, command, callback, error_callback=None, *args):
+        """
+        Run a device command without freezing the GUI when possible
+
+        :param command: Device command name
+        :param callback: Called with the command result
+        :param error_callback: Called with the raised exception
+        :param args: Command arguments
+        :type command: str
+        :type callback: function
+        :type error_callback: function
+        """
+        if self.adevice is not None:
+            self.loop.submit(getattr(self.adevice, command)(*args), callback, error_callback)
+            return
+
+        try:
+            result = getattr(self.device, command)(*args)
+        except Exception as error:
+            if error_callback is None:
+                raise
+            error_callback(error)
+        else:
+            callback(result)
+
     def connect_device(self):
         """Connect to the device"""
-        if self.device.present():
-            mode = self.device.get_mode()
-            self.msg_print("BSS-1 connected! (" + mode + " mode)")
-            self.hw_vers.set_text(self.device.get_hardware_version())
-            self.fw_vers.set_text(self.device.get_firmware_version())
-            if mode == 'normal':
-                self.normal()
-            else:
-                self.firmware()
-        else:
+        self._run('identify', self._on_identified, self._on_connect_error)
+
+    def _on_identified(self, identity):
+        """
+        Device identification callback
+
+        :param identity: (mode, hardware version, firmware version) or None when not present
+        :type identity: (str, str, str) | None
+        """
+        if identity is None:
             self.msg_print("BBS-1 not connected!")
             self.show_alert_connect()
+            return
+
+        mode, hw_vers, fw_vers = identity
+        self.msg_print("BSS-1 connected! (" + mode + " mode)")
+        self.hw_vers.set_text(hw_vers)
+        self.fw_vers.set_text(fw_vers)
+        if mode == 'normal':
+            self.normal()
+        else:
+            self.firmware()
+
+    def _on_connect_error(self, error):
+        """
+        Device communication error callback
+
+        :param error: Raised exception
+        :type error: Exception
+        """
+        logging.warning(error)
+        self.msg_print("BBS-1 not responding!")
+        self.show_alert_connect()
 
     def show_alert_connect(self):
         """Show an alert reporting failed device communication"""
@@ -186,17 +309,139 @@ class Bbs1App(Gtk.Application):
 
     def firmware(self):
         """Firmware mode handling"""
-        # TODO
-        raise NotImplementedError
+        journal = firmware.FlashJournal(os.path.join(GLib.get_user_cache_dir(), 'bbs1-firmware.journal'))
+        path = journal.pending()
+        if path is not None and os.path.isfile(path):
+            # Resume an interrupted transfer
+            self.msg_print("Resuming firmware transfer")
+        else:
+            dialog = Gtk.FileChooserDialog("Select a firmware image", self.window, Gtk.FileChooserAction.OPEN,
+                                           (Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
+                                            Gtk.STOCK_OPEN, Gtk.ResponseType.OK))
+            response = dialog.run()
+            path = dialog.get_filename()
+            dialog.destroy()
+            if response != Gtk.ResponseType.OK:
+                self.msg_print("BBS-1 waiting for a firmware update")
+                return
+
+        try:
+            image = firmware.FirmwareImage(path)
+        except (IOError, OSError) as error:
+            logging.warning(error)
+            self.msg_print("Unable to read the firmware image!")
+            return
+
+        def done(result=None):
+            image.close()
+            self.msg_print("Firmware sent")
+            self.connect_device()
+
+        def failed(error):
+            image.close()
+            self._on_connect_error(error)
+
+        self.msg_print("Sending firmware…")
+        self._run('send_firmware', done, failed, image, journal)
 
     def on_action_new_activate(self, menuitem, data=None):
         self._unimplemented()
 
     def on_action_open_activate(self, menuitem, data=None):
-        self._unimplemented()
+        """
+        Import tempo maps from a tempo maps or MIDI file
+
+        :param menuitem: The menuitem that received the signal
+        :param data: Optional data
+        :type menuitem: gtk.MenuItem
+        """
+        tempofilefilter = self.builder.get_object('tempofilefilter')
+        dialog = Gtk.FileChooserDialog("Open a file", self.window, Gtk.FileChooserAction.OPEN,
+                                       (Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
+                                        Gtk.STOCK_OPEN, Gtk.ResponseType.OK))
+        dialog.add_filter(tempofilefilter)
+        dialog.add_filter(self.builder.get_object('midifilefilter'))
+        response = dialog.run()
+        path = dialog.get_filename()
+        native = dialog.get_filter() == tempofilefilter
+        dialog.destroy()
+        if response != Gtk.ResponseType.OK:
+            return
+        if native:
+            self._import_maps(path, 0, self.tempofile.maps_count, lambda tempo_path: storage.load(tempo_path).maps)
+        else:
+            self._import_maps(path, 0, self.tempofile.maps_count)
+
+    def on_file_set(self, button, data=None):
+        """
+        Import one tempo map from a MIDI file
+
+        :param button: Widget that selected the file
+        :param data: Optional data
+        :type button: gtk.FileChooserButton
+        """
+        self._import_maps(button.get_filename(), int(button.get_name()) - 1, 1)
+
+    def _import_maps(self, path, first, count, load=smf.load):
+        """
+        Replace tempo maps with the ones of a file
+
+        :param path: File path
+        :param first: First replaced map index
+        :param count: Maximum replaced maps
+        :param load: Maps loading function
+        :type path: str
+        :type first: int
+        :type count: int
+        :type load: function
+        """
+        try:
+            tempomaps = load(path)
+        except (IOError, OSError, TypeError) as error:
+            logging.warning(error)
+            self.msg_print("Unable to read the file!")
+            return
+        if len(tempomaps) > count:
+            logging.warning("Ignoring " + str(len(tempomaps) - count) + " tempo maps")
+        for i, tempomap in enumerate(tempomaps[0:count]):
+            # Maps from other tools often repeat identical bars
+            tempomap.optimize()
+            self.tempofile.set_map(first + i, tempomap)
+        self._edited()
 
     def on_action_save_as_activate(self, menuitem, data=None):
-        self._unimplemented()
+        """
+        Export tempo maps to a tempo maps or MIDI file
+
+        :param menuitem: The menuitem that received the signal
+        :param data: Optional data
+        :type menuitem: gtk.MenuItem
+        """
+        tempofilefilter = self.builder.get_object('tempofilefilter')
+        dialog = Gtk.FileChooserDialog("Save as", self.window, Gtk.FileChooserAction.SAVE,
+                                       (Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
+                                        Gtk.STOCK_SAVE, Gtk.ResponseType.OK))
+        dialog.add_filter(tempofilefilter)
+        dialog.add_filter(self.builder.get_object('midifilefilter'))
+        dialog.set_do_overwrite_confirmation(True)
+        response = dialog.run()
+        path = dialog.get_filename()
+        native = dialog.get_filter() == tempofilefilter
+        dialog.destroy()
+        if response != Gtk.ResponseType.OK:
+            return
+        if not os.path.splitext(path)[1]:
+            path += storage.EXTENSION if native else '.mid'
+        try:
+            if native:
+                storage.save(path, self.tempofile)
+            else:
+                smf.save(path, self.tempofile.maps)
+        except (IOError, OSError, TypeError) as error:
+            logging.warning(error)
+            self.msg_print("Unable to write the file!")
+            return
+        self.msg_print("Tempo maps saved")
 
     def on_action_refresh_activate(self, menuitem, data=None):
         """
@@ -210,41 +455,133 @@ class Bbs1App(Gtk.Application):
 
     def _refresh(self):
         """Refresh UI informations"""
-        self.tempofile = self.device.get_tempomaps()
-        self.tempofile_cache = deepcopy(self.tempofile)
-        logging.debug("Successfully cached tempo file: " + str(self.tempofile == self.tempofile_cache))
+        self._run('get_tempomaps', self._on_tempomaps, self._on_tempomaps_error, self._on_map)
+
+    def _on_map(self, index, tempomap):
+        """
+        Tempo map reception callback, called while the dump is still arriving
+
+        :param index: Map index
+        :param tempomap: Received map
+        :type index: int
+        :type tempomap: tempo.Map
+        """
+        # May be called outside of the GLib main loop
+        GLib.idle_add(self._show_map, index, tempomap)
+
+    def _show_map(self, index, tempomap):
+        """
+        Display one tempo map
+
+        :param index: Map index
+        :param tempomap: Tempo map
+        :type index: int
+        :type tempomap: tempo.Map
+        :return: False to remove the GLib idle source
+        :rtype: bool
+        """
+        igtk = str(index + 1)
+        entryname = 'entry' + igtk
+        entry = self.builder.get_object(entryname)
+        entry.handler_block_by_func(self.on_changed)
+        entry.set_text(tempomap.name)
+        entry.handler_unblock_by_func(self.on_changed)
+        spinbuttonname = 'spinbutton' + igtk
+        spinbutton = self.builder.get_object(spinbuttonname)
+        spinbutton.handler_block_by_func(self.on_changed)
+        spinbutton.set_value(tempomap.count_in)
+        spinbutton.handler_unblock_by_func(self.on_changed)
+        switchname = 'switch' + igtk
+        switch = self.builder.get_object(switchname)
+        switch.handler_block_by_func(self.on_changed)
+        switch.set_state(tempomap.looping)
+        switch.handler_unblock_by_func(self.on_changed)
+        return False
+
+    def _on_tempomaps(self, tempofile):
+        """
+        Tempo maps reception callback
+
+        :param tempofile: Tempo file read from the device
+        :type tempofile: tempo.File
+        """
+        self.tempofile = tempofile
+        self.device_snapshot = self.tempofile.snapshot()
+        self.history = tempo.History()
+        self.history.record(self.device_snapshot)
         self._refresh_ui()
 
-    def _refresh_ui(self):
-        # Compute and display free space
-        # Free space is 4kB * 9 = 36kB
-        # <=> 1018 bars * 9 = 9162
-        free_space = 36864  # in bytes
+    def _on_tempomaps_error(self, error):
+        """
+        Tempo maps reception error callback
+
+        Maps shown while the dump was arriving are replaced by the edited ones:
+        the partial dump is not adopted, applying it would overwrite the maps never received.
+
+        :param error: Raised exception
+        :type error: Exception
+        """
+        # After the maps shown on reception
+        GLib.idle_add(self._show_maps)
+        self._on_connect_error(error)
 
+    def _show_maps(self):
+        """
+        Display the edited tempo maps
+
+        :return: False to remove the GLib idle source
+        :rtype: bool
+        """
+        tempofile = self.tempofile if self.tempofile is not None else tempo.File()
+        for i in range(0, tempofile.maps_count):
+            self._show_map(i, tempofile.maps[i])
+        return False
+
+    def _refresh_ui(self):
         for i in range(0, self.tempofile.maps_count):
-            igtk = str(i + 1)
-            entryname = 'entry' + igtk
-            entry = self.builder.get_object(entryname)
-            entry.handler_block_by_func(self.on_changed)
-            entry.set_text(self.tempofile.maps[i].name)
-            entry.handler_unblock_by_func(self.on_changed)
-            spinbuttonname = 'spinbutton' + igtk
-            spinbutton = self.builder.get_object(spinbuttonname)
-            spinbutton.handler_block_by_func(self.on_changed)
-            spinbutton.set_value(self.tempofile.maps[i].count_in)
-            spinbutton.handler_unblock_by_func(self.on_changed)
-            switchname = 'switch' + igtk
-            switch = self.builder.get_object(switchname)
-            switch.handler_block_by_func(self.on_changed)
-            switch.set_state(self.tempofile.maps[i].looping)
-            switch.handler_unblock_by_func(self.on_changed)
-            free_space -= self.tempofile.maps[i].length
-
-        fraction_space = free_space / 36864
+            self._show_map(i, self.tempofile.maps[i])
+
+        # Compute and display free space, the header and maps entries use storage too
+        free_space = sysex.STORAGE_SIZE - sysex.SysexMessage.tempo_maps_size(self.tempofile)  # in bytes
+        fraction_space = max(0.0, float(free_space) / sysex.STORAGE_SIZE)
         logging.debug('Space available: ' + str(fraction_space))
         self.builder.get_object('free_space').set_fraction(fraction_space)
 
-        self.builder.get_object('menu_apply').set_sensitive(not self.tempofile == self.tempofile_cache)
+        # Only modified maps digests are computed again
+        self.builder.get_object('menu_apply').set_sensitive(self.tempofile.digest != self.device_snapshot.digest)
+        self.builder.get_object('menu_undo').set_sensitive(self.history.can_undo)
+        self.builder.get_object('menu_redo').set_sensitive(self.history.can_redo)
+
+    def _edited(self):
+        """Record an edition in the history"""
+        self.history.record(self.tempofile.snapshot())
+        self._refresh_ui()
+
+    def on_action_undo_activate(self, menuitem, data=None):
+        """
+        Undo the last edition
+
+        :param menuitem: The menuitem that received the signal
+        :param data: Optional data
+        :type menuitem: gtk.MenuItem
+        """
+        snapshot = self.history.undo()
+        if snapshot is not None:
+            self.tempofile.restore(snapshot)
+        self._refresh_ui()
+
+    def on_action_redo_activate(self, menuitem, data=None):
+        """
+        Redo the last undone edition
+
+        :param menuitem: The menuitem that received the signal
+        :param data: Optional data
+        :type menuitem: gtk.MenuItem
+        """
+        snapshot = self.history.redo()
+        if snapshot is not None:
+            self.tempofile.restore(snapshot)
+        self._refresh_ui()
 
     def on_action_clear_activate(self, menuitem, data=None):
         """
@@ -266,8 +603,7 @@ class Bbs1App(Gtk.Application):
         """
         Clear all tempo maps
         """
-        self.device.clear_tempomaps()
-        self._refresh()
+        self._run('clear_tempomaps', lambda result: self._refresh(), self._on_connect_error)
 
     def on_check_clear_toggled(self, widget, data=None):
         """
@@ -280,7 +616,30 @@ class Bbs1App(Gtk.Application):
         self.clear_confirm = not widget.get_active()
 
     def on_action_apply_activate(self, menuitem, data=None):
-        self._unimplemented()
+        """
+        Send modified tempo maps to the device
+
+        :param menuitem: The menuitem that received the signal
+        :param data: Optional data
+        :type menuitem: gtk.MenuItem
+        """
+        try:
+            sysex.SysexMessage.check_tempo_maps_size(self.tempofile)
+        except TypeError as error:
+            logging.warning(error)
+            self.msg_print("Tempo maps do not fit in the BBS-1!")
+            return
+        self.msg_print("Sending tempo maps…")
+        self._run('send_tempomaps', self._on_tempomaps_sent, self._on_connect_error, self.tempofile)
+
+    def _on_tempomaps_sent(self, result=None):
+        """
+        Tempo maps sent callback
+
+        :param result: Unused
+        """
+        self.msg_print("Tempo maps sent")
+        self._refresh()
 
     def on_action_about_activate(self, menuitem, data=None):
         """
@@ -304,7 +663,7 @@ class Bbs1App(Gtk.Application):
         """
         map_index = int(button.get_name()) - 1
         self.tempofile.maps[map_index].reset()
-        self._refresh_ui()
+        self._edited()
 
     def on_changed(self, widget, data=None):
         """
@@ -335,7 +694,7 @@ class Bbs1App(Gtk.Application):
                           + str(self.tempofile.maps[map_index].name))
         else:
             raise TypeError("Unexpected widget")
-        self._refresh_ui()
+        self._edited()
 
     def _unimplemented(self):
         unimplemented = self.builder.get_object('unimplemented_dialog')